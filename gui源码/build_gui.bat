@@ -0,0 +1,4 @@
+@echo off
+rem 打包GUI，结果在 dist\gui_message_forwarder\ 中（需要 pip install pyinstaller）
+cd /d "%~dp0"
+pyinstaller --noconfirm gui_message_forwarder.spec
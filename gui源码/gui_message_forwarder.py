@@ -1,38 +1,78 @@
 import json
-import requests
 import os
 import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime
-from urllib.parse import urlencode
+import collections
 import tkinter as tk
-from tkinter import ttk, scrolledtext
+from tkinter import ttk, scrolledtext, messagebox
 import threading
 
 # 获取当前脚本所在目录
 if getattr(sys, 'frozen', False):
-    # 打包后的可执行文件路径
+    # 打包后的可执行文件路径；转发引擎已由 gui_message_forwarder.spec 打入可执行文件
     application_path = os.path.dirname(sys.executable)
 else:
     # 脚本文件路径
     application_path = os.path.dirname(os.path.abspath(__file__))
+    # 转发引擎与CLI共用，源码位于同级的 python源码 目录（打包时由spec加入分析路径）
+    sys.path.insert(0, os.path.join(os.path.dirname(application_path), "python源码"))
+
+from forwarder_core import (CONFIG_CHOICES, ConfigWatcher, DEFAULT_CONFIG, ForwarderConfig, ForwarderEngine, UpstreamPool,
+                            expand_extra_targets, parse_routes)
 
 # 配置文件路径（与可执行文件同一目录）
 CONFIG_FILE = os.path.join(application_path, "config.txt")
 
-# 全局配置变量
-config = {}
-target_config = {}
-
-# 转发服务默认值
-defaults = {
+# 转发服务默认值，界面上没有的高级选项仅通过config.txt配置
+defaults = dict(DEFAULT_CONFIG)
+defaults.update({
     "local_host": "127.0.0.1",
     "local_port": "9784",
     "local_token": "114514",
+    "max_workers": "16",
     "target_host": "127.0.0.1",
     "target_port": "9785",
-    "target_token": "114514"
-}
+    "target_token": "114514",
+    "extra_targets": "",  # 其他Lagrange目标，host:port[:token] 以逗号分隔
+    "log_max_lines": "5000",  # 日志框最多保留的行数，超出后删除最早的行
+    "log_refresh_ms": "100"  # 日志框刷新间隔（毫秒）
+})
+
+class LogBuffer:
+    """线程安全的日志缓冲区
+
+    任意线程的print和日志输出只写入这里，由Tk主线程定时批量取出显示，
+    避免在后台线程中操作Tk控件。缓冲区有长度上限，超出时丢弃最早的内容并计数。
+    """
+    def __init__(self, max_pending=10000):
+        self._lock = threading.Lock()
+        self._pending = collections.deque(maxlen=max(1, int(max_pending)))
+        self._dropped = 0
+
+    def write(self, text):
+        if not text:
+            return
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self._dropped += 1
+            self._pending.append(text)
+
+    def flush(self):
+        pass
+
+    def resize(self, max_pending):
+        """调整长度上限，缩小时丢弃最早的内容并计数"""
+        with self._lock:
+            pending = collections.deque(self._pending, maxlen=max(1, int(max_pending)))
+            self._dropped += len(self._pending) - len(pending)
+            self._pending = pending
+
+    def drain(self):
+        """取出全部待显示内容，返回 (文本, 被丢弃的片段数)"""
+        with self._lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+            dropped, self._dropped = self._dropped, 0
+        return text, dropped
 
 class GUIApp:
     def __init__(self, root):
@@ -41,17 +81,23 @@ class GUIApp:
         
         # 转发服务状态
         self.server_running = False
-        self.server_thread = None
-        self.server = None
+        self.engine = None
+        self.stop_thread = None  # 后台停止转发服务的线程，停止期间不为None
+        self.reload_thread = None  # 后台重新加载配置的线程，加载期间不为None
+        self.pending_config = None  # 重新加载期间又有新配置时，完成后再应用
+        self.closing = False
+        # 上次的配置加载完成前界面上是默认值，不能启动或保存（否则会用默认值覆盖config.txt）
+        self.loading = True
         
-        # 加载上次的配置
-        self.load_config()
+        self.config_watcher = ConfigWatcher(CONFIG_FILE, lambda data: self.load_config())
         
-        # 创建主界面
+        # 先用默认值创建主界面，窗口显示后再在后台线程中加载上次的配置
         self.create_main_frame()
+        self.root.after(2000, self.watch_config)
         
         # 重定向print到日志框
         self.redirect_print_to_log()
+        self.load_config_async()
         
         # 窗口关闭时保存配置
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
@@ -70,6 +116,9 @@ class GUIApp:
         
         # 转发配置（右）
         self.create_target_config(config_frame)
+
+        # 多账号路由
+        self.create_route_config(main_frame)
         
         # 日志输出
         self.create_log_output(main_frame)
@@ -96,6 +145,29 @@ class GUIApp:
         self.local_token.grid(row=2, column=1, sticky="ew", pady=2, padx=5)
         self.local_token.insert(0, defaults["local_token"])  # 使用字典中的默认值
 
+        ttk.Label(frame, text="MaxWorkers:").grid(row=3, column=0, sticky="e", pady=2)
+        self.max_workers = ttk.Entry(frame)
+        self.max_workers.grid(row=3, column=1, sticky="ew", pady=2, padx=5)
+        self.max_workers.insert(0, defaults["max_workers"])  # 使用字典中的默认值
+
+        ttk.Label(frame, text="传输方式:").grid(row=4, column=0, sticky="e", pady=2)
+        self.local_transport = ttk.Combobox(frame, values=CONFIG_CHOICES["local_transport"], state="readonly")
+        self.local_transport.grid(row=4, column=1, sticky="ew", pady=2, padx=5)
+        self.local_transport.set(defaults["local_transport"])
+
+        ttk.Label(frame, text="事件端口:").grid(row=5, column=0, sticky="e", pady=2)
+        self.event_port = ttk.Entry(frame)
+        self.event_port.grid(row=5, column=1, sticky="ew", pady=2, padx=5)
+        self.event_port.insert(0, defaults["event_port"])  # 接收Lagrange上报事件的端口
+
+        ttk.Label(frame, text="OlivOS事件端口:").grid(row=6, column=0, sticky="e", pady=2)
+        self.olivos_event_port = ttk.Entry(frame)
+        self.olivos_event_port.grid(row=6, column=1, sticky="ew", pady=2, padx=5)
+        self.olivos_event_port.insert(0, defaults["olivos_event_port"])
+
+        self.event_enabled = tk.BooleanVar(value=str(defaults["event_enabled"]).lower() in ("1", "true", "yes", "on"))
+        ttk.Checkbutton(frame, text="转发上报事件到OlivOS", variable=self.event_enabled).grid(row=7, column=1, sticky="w", pady=2, padx=5)
+
         # 设置列权重使输入框可以拉伸
         frame.columnconfigure(1, weight=1)
 
@@ -118,54 +190,253 @@ class GUIApp:
         self.target_token.grid(row=2, column=1, sticky="ew", pady=2, padx=5)
         self.target_token.insert(0, defaults["target_token"])  # 使用字典中的默认值
 
+        ttk.Label(frame, text="其他目标:").grid(row=3, column=0, sticky="e", pady=2)
+        self.extra_targets = ttk.Entry(frame)
+        self.extra_targets.grid(row=3, column=1, sticky="ew", pady=2, padx=5)
+        self.extra_targets.insert(0, defaults["extra_targets"])  # host:port[:token]，逗号分隔
+
+        ttk.Label(frame, text="多目标策略:").grid(row=4, column=0, sticky="e", pady=2)
+        self.target_strategy = ttk.Combobox(frame, values=UpstreamPool.STRATEGIES, state="readonly")
+        self.target_strategy.grid(row=4, column=1, sticky="ew", pady=2, padx=5)
+        self.target_strategy.set(defaults["target_strategy"])
+
+        ttk.Label(frame, text="传输方式:").grid(row=5, column=0, sticky="e", pady=2)
+        self.target_transport = ttk.Combobox(frame, values=CONFIG_CHOICES["target_transport"], state="readonly")
+        self.target_transport.grid(row=5, column=1, sticky="ew", pady=2, padx=5)
+        self.target_transport.set(defaults["target_transport"])
+
+        self.target_broadcast = tk.BooleanVar(value=str(defaults["target_broadcast"]).lower() in ("1", "true", "yes", "on"))
+        ttk.Checkbutton(frame, text="广播到所有目标", variable=self.target_broadcast).grid(row=6, column=1, sticky="w", pady=2, padx=5)
+
         # 设置列权重使输入框可以拉伸
         frame.columnconfigure(1, weight=1)
     
+    def create_route_config(self, parent):
+        frame = ttk.LabelFrame(parent, text="多账号路由（不匹配任何路由的请求使用上面的配置）", padding=10)
+        frame.pack(fill=tk.X, pady=(0, 10))
+
+        self.route_table = ttk.Treeview(frame, columns=("name", "selector", "target"), show="headings", height=4)
+        self.route_table.heading("name", text="名称")
+        self.route_table.heading("selector", text="选择条件")
+        self.route_table.heading("target", text="转发目标")
+        self.route_table.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.route_table.bind("<Double-1>", lambda event: self.edit_route())
+
+        buttons = ttk.Frame(frame)
+        buttons.pack(side=tk.LEFT, fill=tk.Y, padx=(5, 0))
+        ttk.Button(buttons, text="添加", command=self.add_route).pack(fill=tk.X, pady=2)
+        ttk.Button(buttons, text="编辑", command=self.edit_route).pack(fill=tk.X, pady=2)
+        ttk.Button(buttons, text="删除", command=self.delete_route).pack(fill=tk.X, pady=2)
+        self.refresh_routes()
+
+    def refresh_routes(self):
+        # 路由表保存在 defaults["routes"] 中，随其他配置一起保存与应用
+        try:
+            routes = parse_routes(defaults.get("routes") or [])
+        except ValueError as e:
+            print(f"路由表无效: {e}")
+            routes = []
+        defaults["routes"] = routes
+        self.route_table.delete(*self.route_table.get_children())
+        for route in routes:
+            selector = [f"端口 {route['port']}" if route["port"] else "", route["path_prefix"],
+                        "令牌 " + route["token"] if route["token"] else ""]
+            target = f"{route.get('target_host', '同上')}:{route.get('target_port', '同上')}"
+            self.route_table.insert("", tk.END, values=(route["name"], ", ".join(filter(None, selector)), target))
+
+    def selected_route(self):
+        selection = self.route_table.selection()
+        return self.route_table.index(selection[0]) if selection else None
+
+    def add_route(self):
+        self.open_route_dialog(None)
+
+    def edit_route(self):
+        index = self.selected_route()
+        if index is not None:
+            self.open_route_dialog(index)
+
+    def delete_route(self):
+        index = self.selected_route()
+        if index is not None:
+            del defaults["routes"][index]
+            self.refresh_routes()
+
+    def open_route_dialog(self, index):
+        """添加（index 为None）或编辑一条路由，未填写的转发目标沿用上面的配置"""
+        route = dict(defaults["routes"][index]) if index is not None else {}
+        dialog = tk.Toplevel(self.root)
+        dialog.title("编辑路由" if index is not None else "添加路由")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        fields = [("name", "名称:"), ("port", "监听端口:"), ("path_prefix", "路径前缀:"), ("token", "接收令牌:"),
+                  ("target_host", "目标Host:"), ("target_port", "目标Port:"), ("target_token", "目标AccessToken:")]
+        entries = {}
+        for row, (key, label) in enumerate(fields):
+            ttk.Label(dialog, text=label).grid(row=row, column=0, sticky="e", pady=2, padx=5)
+            entry = ttk.Entry(dialog, width=40)
+            entry.grid(row=row, column=1, sticky="ew", pady=2, padx=5)
+            value = route.pop(key, "")
+            entry.insert(0, "" if value in ("", 0) else str(value))
+            entries[key] = entry
+        # 其他要覆盖的配置项，例如 {"dedup_enabled": true}
+        ttk.Label(dialog, text="其他配置(JSON):").grid(row=len(fields), column=0, sticky="ne", pady=2, padx=5)
+        extra = tk.Text(dialog, width=40, height=4)
+        extra.grid(row=len(fields), column=1, sticky="ew", pady=2, padx=5)
+        extra.insert("1.0", json.dumps(route, ensure_ascii=False) if route else "")
+
+        def confirm():
+            try:
+                text = extra.get("1.0", tk.END).strip()
+                item = json.loads(text) if text else {}
+                if not isinstance(item, dict):
+                    raise ValueError("其他配置应为JSON对象")
+                item.update((key, entry.get().strip()) for key, entry in entries.items() if entry.get().strip())
+                routes = list(defaults["routes"])
+                if index is None:
+                    routes.append(item)
+                else:
+                    routes[index] = item
+                defaults["routes"] = parse_routes(routes)
+            except ValueError as e:
+                messagebox.showerror("路由无效", str(e), parent=dialog)
+                return
+            self.refresh_routes()
+            dialog.destroy()
+
+        buttons = ttk.Frame(dialog)
+        buttons.grid(row=len(fields) + 1, column=0, columnspan=2, pady=(5, 5))
+        ttk.Button(buttons, text="确定", command=confirm).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons, text="取消", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+        dialog.columnconfigure(1, weight=1)
+
     def create_log_output(self, parent):
         frame = ttk.LabelFrame(parent, text="转发服务日志", padding=10)
         frame.pack(fill=tk.BOTH, expand=True)
         
         self.log_text = scrolledtext.ScrolledText(frame, width=80, height=20, wrap=tk.WORD)
         self.log_text.pack(fill=tk.BOTH, expand=True)
+
+        # 日志框行数上限与刷新间隔
+        self.log_max_lines = max(1, int(defaults.get("log_max_lines", 5000)))
+        self.log_refresh_ms = max(10, int(defaults.get("log_refresh_ms", 100)))
+        self.log_buffer = LogBuffer(self.log_max_lines * 2)  # 加载配置后按 log_max_lines 调整
+        self.log_paused = tk.BooleanVar(value=False)
     
     def create_control_buttons(self, parent):
         frame = ttk.Frame(parent)
         frame.pack(fill=tk.X, pady=(10, 0))
         
-        self.start_button = ttk.Button(frame, text="开启转发服务", command=self.toggle_server)
+        # 启动、保存与应用按钮在配置加载完成后才可用
+        self.start_button = ttk.Button(frame, text="开启转发服务", command=self.toggle_server, state=tk.DISABLED)
         self.start_button.pack(side=tk.LEFT, padx=5)
         
         ttk.Button(frame, text="清空日志", command=self.clear_log).pack(side=tk.LEFT, padx=5)
-        ttk.Button(frame, text="保存配置", command=self.save_config).pack(side=tk.RIGHT, padx=5)
+        ttk.Checkbutton(frame, text="暂停日志", variable=self.log_paused).pack(side=tk.LEFT, padx=5)
+        self.save_button = ttk.Button(frame, text="保存配置", command=self.save_config, state=tk.DISABLED)
+        self.save_button.pack(side=tk.RIGHT, padx=5)
+        self.apply_button = ttk.Button(frame, text="应用配置", command=self.apply_config, state=tk.DISABLED)
+        self.apply_button.pack(side=tk.RIGHT, padx=5)
+
+        # 运行指标摘要，服务运行时每秒刷新
+        self.metrics_label = ttk.Label(parent, text="转发服务未运行")
+        self.metrics_label.pack(fill=tk.X, pady=(5, 0))
+        self.root.after(1000, self.refresh_metrics)
     
     def redirect_print_to_log(self):
-        import sys
-        class PrintRedirector:
-            def __init__(self, text_widget):
-                self.text_widget = text_widget
-            
-            def write(self, text):
-                self.text_widget.insert(tk.END, text)
-                self.text_widget.see(tk.END)
-            
-            def flush(self):
-                pass
-        
-        sys.stdout = PrintRedirector(self.log_text)
-        sys.stderr = PrintRedirector(self.log_text)
+        # print只写入线程安全的缓冲区，由主线程定时刷新到日志框
+        sys.stdout = self.log_buffer
+        sys.stderr = self.log_buffer
+        self.root.after(self.log_refresh_ms, self.drain_log)
+
+    def drain_log(self):
+        try:
+            # 暂停时日志留在缓冲区（超出上限丢弃最早的），方便查看当前内容
+            if not self.log_paused.get():
+                text, dropped = self.log_buffer.drain()
+                if dropped:
+                    text = f"\n... 日志过多，已省略 {dropped} 段输出 ...\n" + text
+                if text:
+                    self.append_log(text)
+        finally:
+            self.root.after(self.log_refresh_ms, self.drain_log)
+
+    def append_log(self, text):
+        # 单批内容超过上限时只插入最后的部分
+        if text.count("\n") > self.log_max_lines:
+            text = "\n".join(text.split("\n")[-self.log_max_lines - 1:])
+        self.log_text.insert(tk.END, text)
+
+        # 删除超出行数上限的最早内容
+        line_count = int(self.log_text.index("end-1c").split(".")[0])
+        excess = line_count - self.log_max_lines
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+        self.log_text.see(tk.END)
     
-    def load_config(self):
+    def refresh_metrics(self):
+        try:
+            if self.engine is not None:
+                snapshot = self.engine.metrics.snapshot()
+                counters = snapshot["counters"]
+                stages = snapshot["stages"]
+                self.metrics_label.config(text=(
+                    f"收到 {counters.get('received', 0)}  转发 {counters.get('forwarded', 0)}  "
+                    f"拒绝 {counters.get('rejected', 0)}  失败 {counters.get('upstream_failed', 0)}  "
+                    f"回调 {counters.get('callback_sent', 0)}/{counters.get('callback_failed', 0)}  |  "
+                    f"平均耗时(ms) 解析 {stages['parse']['avg_ms']:.1f}  "
+                    f"上游 {stages['upstream']['avg_ms']:.1f}  回调 {stages['callback']['avg_ms']:.1f}  "
+                    f"写回 {stages['write']['avg_ms']:.1f}  总计 {stages['request']['avg_ms']:.1f}"
+                ))
+        finally:
+            self.root.after(1000, self.refresh_metrics)
+
+    @staticmethod
+    def read_config():
+        """读取并校验config.txt，返回其中的配置项；不操作界面，可在后台线程中调用"""
+        data = {}
         try:
             if os.path.exists(CONFIG_FILE):
                 with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    # 更新默认值
-                    defaults.update(data)
-                    print(f"从 {CONFIG_FILE} 加载配置成功")
+                print(f"从 {CONFIG_FILE} 加载配置成功")
             else:
                 print(f"配置文件 {CONFIG_FILE} 不存在，使用默认配置")
-            
-            # 填充到界面
+        except Exception as e:
+            print(f"加载配置文件失败: {e}")
+            print("将使用默认配置")
+            return {}
+        # 提前校验，有误时在启动服务前就能在日志中看到
+        try:
+            ForwarderConfig.from_dict(expand_extra_targets(dict(defaults, **data)))
+        except ValueError as e:
+            print(f"配置错误: {e}")
+        return data
+
+    def load_config_async(self):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(self.read_config()), name="load-config", daemon=True)
+        thread.start()
+
+        def poll():
+            if thread.is_alive():
+                self.root.after(20, poll)
+                return
+            defaults.update(result)
+            self.fill_config()
+            self.loading = False
+            for button in (self.start_button, self.save_button, self.apply_button):
+                button.config(state=tk.NORMAL)
+        self.root.after(20, poll)
+
+    def load_config(self):
+        defaults.update(self.read_config())
+        self.fill_config()
+
+    def fill_config(self):
+        """把 defaults 中的配置填充到界面"""
+        try:
             if hasattr(self, 'local_host'):
                 self.local_host.delete(0, tk.END)
                 self.local_host.insert(0, defaults["local_host"])
@@ -175,6 +446,9 @@ class GUIApp:
                 
                 self.local_token.delete(0, tk.END)
                 self.local_token.insert(0, defaults["local_token"])
+
+                self.max_workers.delete(0, tk.END)
+                self.max_workers.insert(0, defaults["max_workers"])
                 
                 self.target_host.delete(0, tk.END)
                 self.target_host.insert(0, defaults["target_host"])
@@ -184,19 +458,52 @@ class GUIApp:
                 
                 self.target_token.delete(0, tk.END)
                 self.target_token.insert(0, defaults["target_token"])
+
+                self.extra_targets.delete(0, tk.END)
+                self.extra_targets.insert(0, defaults["extra_targets"])
+
+                self.target_strategy.set(defaults["target_strategy"])
+                self.local_transport.set(defaults["local_transport"])
+                self.target_transport.set(defaults["target_transport"])
+                self.target_broadcast.set(str(defaults["target_broadcast"]).lower() in ("1", "true", "yes", "on"))
+
+                self.event_port.delete(0, tk.END)
+                self.event_port.insert(0, defaults["event_port"])
+
+                self.olivos_event_port.delete(0, tk.END)
+                self.olivos_event_port.insert(0, defaults["olivos_event_port"])
+
+                self.event_enabled.set(str(defaults["event_enabled"]).lower() in ("1", "true", "yes", "on"))
+
+                self.refresh_routes()
+
+                # 日志框行数上限与刷新间隔，缓冲区长度随行数上限调整
+                self.log_max_lines = max(1, int(defaults.get("log_max_lines", 5000)))
+                self.log_refresh_ms = max(10, int(defaults.get("log_refresh_ms", 100)))
+                self.log_buffer.resize(self.log_max_lines * 2)
         except Exception as e:
-            print(f"加载配置文件失败: {e}")
-            print("将使用默认配置")
+            print(f"填充配置失败: {e}")
     
     def save_config(self):
-        config = {
+        # 保留config.txt中界面上没有的高级选项
+        config = dict(defaults)
+        config.update({
             "local_host": self.local_host.get(),
             "local_port": self.local_port.get(),
             "local_token": self.local_token.get(),
+            "max_workers": self.max_workers.get(),
             "target_host": self.target_host.get(),
             "target_port": self.target_port.get(),
-            "target_token": self.target_token.get()
-        }
+            "target_token": self.target_token.get(),
+            "extra_targets": self.extra_targets.get(),
+            "target_strategy": self.target_strategy.get(),
+            "target_broadcast": self.target_broadcast.get(),
+            "local_transport": self.local_transport.get(),
+            "target_transport": self.target_transport.get(),
+            "event_enabled": self.event_enabled.get(),
+            "event_port": self.event_port.get(),
+            "olivos_event_port": self.olivos_event_port.get()
+        })
         
         try:
             # 确保目录存在
@@ -204,6 +511,8 @@ class GUIApp:
             
             with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=2, ensure_ascii=False)
+            # 自己保存引起的文件变化不需要重新加载
+            self.config_watcher.ignore()
             print(f"配置已保存到 {CONFIG_FILE}")
         except Exception as e:
             print(f"保存配置失败: {e}")
@@ -217,212 +526,168 @@ class GUIApp:
         else:
             self.start_server()
     
-    def start_server(self):
-        global config, target_config
+    def build_config(self):
+        """按界面上的字段与config.txt中的高级选项生成转发配置，字段不完整或无效时抛出ValueError"""
+        # 获取所有字段值
+        fields = {
+            "local_host": self.local_host.get().strip(),
+            "local_port": self.local_port.get().strip(),
+            "local_token": self.local_token.get().strip(),
+            "target_host": self.target_host.get().strip(),
+            "target_port": self.target_port.get().strip(),
+            "target_token": self.target_token.get().strip()
+        }
 
+        # 验证必填字段
+        if not all(fields.values()):
+            raise ValueError("所有配置字段都必须填写!")
+
+        options = dict(defaults)
+        options.update(fields)
+        options["max_workers"] = self.max_workers.get().strip() or DEFAULT_CONFIG["max_workers"]
+        options["target_strategy"] = self.target_strategy.get()
+        options["target_broadcast"] = self.target_broadcast.get()
+        options["local_transport"] = self.local_transport.get()
+        options["target_transport"] = self.target_transport.get()
+        options["event_enabled"] = self.event_enabled.get()
+        options["event_port"] = self.event_port.get().strip() or DEFAULT_CONFIG["event_port"]
+        options["olivos_event_port"] = self.olivos_event_port.get().strip() or DEFAULT_CONFIG["olivos_event_port"]
+
+        # 填写了其他目标时，界面上的目标作为第一个，与其他目标一起轮换
+        options["extra_targets"] = self.extra_targets.get()
+        options = expand_extra_targets(options)
+
+        # 日志文件与待发送队列文件的相对路径以程序所在目录为基准
+        for key in ("log_file", "outbox_path"):
+            path = options.get(key, "")
+            if path and not os.path.isabs(path):
+                options[key] = os.path.join(application_path, path)
+
+        return ForwarderConfig.from_dict(options)
+
+    def apply_config(self):
+        """保存配置，服务运行中时不停止服务直接切换到新配置"""
         try:
-            # 获取所有字段值
-            local_host = self.local_host.get().strip()
-            local_port = self.local_port.get().strip()
-            local_token = self.local_token.get().strip()
-            target_host = self.target_host.get().strip()
-            target_port = self.target_port.get().strip()
-            target_token = self.target_token.get().strip()
-
-            # 验证必填字段
-            if not all([local_host, local_port, local_token, target_host, target_port, target_token]):
-                print("错误: 所有配置字段都必须填写!")
+            config = self.build_config()
+        except ValueError as e:
+            print(f"配置错误: {e}")
+            return
+        self.save_config()
+        self.reload_engine(config)
+
+    def reload_engine(self, config):
+        # 重新加载可能要等待待发送队列、上报事件监听等组件停止，在后台线程中进行，界面不卡住
+        if self.engine is None:
+            return
+        if self.reload_thread is not None:
+            # 上一次还没完成，完成后再应用最新的配置
+            self.pending_config = config
+            return
+        engine = self.engine
+
+        def reload():
+            try:
+                changed = engine.reload(config)
+            except (OSError, ValueError) as e:
+                print(f"应用配置失败，继续使用原配置: {e}")
                 return
+            if changed:
+                print(f"已应用新配置: {', '.join(sorted(changed))}")
+            else:
+                print("配置没有变化")
+        self.reload_thread = threading.Thread(target=reload, name="reload-forwarder", daemon=True)
+        self.reload_thread.start()
+        self.root.after(50, self.poll_reload)
+
+    def poll_reload(self):
+        if self.reload_thread.is_alive():
+            self.root.after(50, self.poll_reload)
+            return
+        self.reload_thread = None
+        config, self.pending_config = self.pending_config, None
+        if config is not None:
+            self.reload_engine(config)
+
+    def watch_config(self):
+        # 在其他程序中修改config.txt后，重新加载到界面，服务运行中时同时应用；
+        # 修改来自文件本身，只应用不保存，不改写用户编辑的文件
+        try:
+            # 加载完成前不检查，加载期间的修改在加载完成后的下一次检查中处理
+            if not self.loading and self.config_watcher.check() and self.engine is not None:
+                try:
+                    config = self.build_config()
+                except ValueError as e:
+                    print(f"配置错误: {e}")
+                else:
+                    self.reload_engine(config)
+        finally:
+            self.root.after(2000, self.watch_config)
 
-            config = {
-                "Host": local_host,
-                "Port": int(local_port),
-                "AccessToken": local_token
-            }
-
-            target_config = {
-                "Host": target_host,
-                "Port": int(target_port),
-                "AccessToken": target_token
-            }
+    def start_server(self):
+        try:
+            config = self.build_config()
 
             # 保存配置
             self.save_config()
 
-            # 创建转发服务并启动接口线程
-            self.server_thread = threading.Thread(target=self.run_server, daemon=True)
-            self.server_thread.start()
+            # 创建转发引擎，绑定端口后在后台线程处理请求；启动成功后才记下，失败时不留下半启动的引擎
+            engine = ForwarderEngine(config)
+            engine.start()
+            self.engine = engine
 
             self.server_running = True
             self.start_button.config(text="停止转发服务")
-            print(f"转发服务已启动，监听 {config['Host']}:{config['Port']}")
+            print(f"转发服务已启动，监听 {config.local_host}:{config.local_port}")
 
         except ValueError as e:
             print(f"配置错误: {e}")
+        except OSError as e:
+            print(f"转发服务错误: {e}")
     
     def stop_server(self):
-        if self.server:
-            # 关闭转发服务
-            self.server.shutdown()
-            self.server.server_close()
-            self.server = None
-        
+        # 停止时要等进行中的请求与回调发送完（至多 shutdown_timeout 秒），在后台线程中进行，界面不卡住
+        if self.stop_thread is not None:
+            return
+        engine, self.engine = self.engine, None
+        self.start_button.config(text="正在停止转发服务...", state=tk.DISABLED)
+        self.metrics_label.config(text="转发服务正在停止")
+
+        def stop():
+            try:
+                if engine is not None:
+                    # 关闭转发服务，写完剩余日志
+                    engine.stop()
+            except Exception as e:
+                print(f"停止转发服务失败: {e}")
+        self.stop_thread = threading.Thread(target=stop, name="stop-forwarder", daemon=True)
+        self.stop_thread.start()
+        self.root.after(50, self.poll_stop)
+
+    def poll_stop(self):
+        # 后台线程不操作Tk控件，由主线程定时检查停止是否完成后再更新界面
+        if self.stop_thread.is_alive():
+            self.root.after(50, self.poll_stop)
+            return
+        self.stop_thread = None
         self.server_running = False
-        self.start_button.config(text="启动转发服务")
-        print("转发服务已停止")
-    
-    def run_server(self):
-        class RequestHandler(BaseHTTPRequestHandler):
-            def _send_response(self, code, data):
-                self.send_response(code)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(data).encode('utf-8'))
-
-            def _parse_body(self):
-                content_length = int(self.headers.get('Content-Length', 0))
-                raw_body = self.rfile.read(content_length).decode('utf-8')
-                try:
-                    return json.loads(raw_body)
-                except:
-                    return raw_body
-
-            def do_POST(self):
-                # 获取并记录原始数据
-                body = self._parse_body()
-                print_log("收到原始数据", body)
-
-                # 认证验证
-                if self.headers.get('Authorization') != f"Bearer {config['AccessToken']}":
-                    self._send_response(401, {"status": "unauthorized"})
-                    return
-
-                # 处理数据
-                if not isinstance(body, dict):
-                    self._send_response(400, {"status": "invalid JSON"})
-                    return
-
-                # 保存原始路径和参数
-                original_path = self.path
-                clean_path = original_path.split('?')[0]
-
-                # 构造转发路径
-                forward_path = original_path.replace(
-                    f"access_token={config['AccessToken']}",
-                    f"access_token={target_config['AccessToken']}",
-                    1
-                ) if f"access_token={config['AccessToken']}" in original_path else (
-                    clean_path + "?" + urlencode({"access_token": target_config['AccessToken']})
-                )
-
-                # 构建转发数据（保持原有逻辑不变）
-                modified_data = {
-                    "message_type": body.get("message_type"),
-                    "message": body.get("message"),
-                    "auto_escape": body.get("auto_escape", False)
-                }
-    
-                if "user_id" in body:
-                    modified_data["user_id"] = body["user_id"]
-                    
-                if "group_id" in body:
-                    modified_data["group_id"] = body["group_id"]
-                
-                if modified_data["message_type"] == "group":
-                    modified_data["group_id"] = body.get("group_id")
-                    modified_data.pop("user_id", None)
-    
-                # 记录转发信息
-                print_log("转发构造数据", {
-                    "path": forward_path,
-                    "data": modified_data
-                })
-
-                # 发送转发请求
-                try:
-                    response = requests.post(
-                        url=f"http://{target_config['Host']}:{target_config['Port']}{forward_path}",
-                        json=modified_data,
-                        headers={'Content-Type': 'application/json'},
-                        timeout=5
-                    )
-
-                    response_data = response.json()
-                    print_log("转发响应", {
-                        "status": response.status_code,
-                        "data": response_data
-                    })
-
-                    # 检查是否有返回数据需要回调
-                    if response_data.get("status") == "ok" and response_data.get("data"):
-                        # 构造回调路径（保持原路径结构，使用原始token）
-                        callback_path = original_path if f"access_token={config['AccessToken']}" in original_path else (
-                            clean_path + "?" + urlencode({"access_token": config['AccessToken']})
-                        )
-
-                        # 构造回调数据
-                        callback_data = {
-                            "status": "ok",
-                            "retcode": 0,
-                            "data": response_data["data"],
-                            "echo": body.get("echo")
-                        }
-
-                        # 发送回调（使用原始接收配置）
-                        try:
-                            requests.post(
-                                url=f"http://{config['Host']}:{config['Port']}{callback_path}",
-                                json=callback_data,
-                                headers={'Content-Type': 'application/json'},
-                                timeout=5
-                            )
-                            
-                            print_log("回调发送", {
-                                "path": callback_path,
-                                "data": callback_data
-                            })
-                        except Exception as e:
-                            print_log("回调发送失败", {
-                                "error": str(e),
-                                "path": callback_path
-                            })
-
-                    # 返回原始响应
-                    self._send_response(200, response_data)
-
-                except Exception as e:
-                    error_response = {
-                        "status": "failed",
-                        "retcode": 1000,
-                        "data": None,
-                        "message": str(e),
-                        "echo": body.get("echo")
-                    }
-                    print_log("转发异常", {
-                        "error": str(e),
-                        "target": f"{target_config['Host']}:{target_config['Port']}{forward_path}"
-                    })
-                    self._send_response(502, error_response)
-                    
-        
-        def print_log(title, data):
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            print(f"\n[{timestamp}] \n=== {title} ===")
-            print(json.dumps(data, indent=2, ensure_ascii=False))
-        
-        try:
-            self.server = HTTPServer((config['Host'], config['Port']), RequestHandler)
-            print(f"Server running on {config['Host']}:{config['Port']}")
-            self.server.serve_forever()
-        except Exception as e:
-            print(f"转发服务错误: {e}")
-            self.stop_server()
+        if self.closing:
+            self.root.destroy()
+            return
+        self.start_button.config(text="开启转发服务", state=tk.NORMAL)
+        self.metrics_label.config(text="转发服务未运行")
     
     def on_close(self):
-        self.save_config()
+        if self.closing:
+            return
+        self.closing = True
+        # 配置还没加载到界面时不保存，避免用默认值覆盖config.txt
+        if not self.loading:
+            self.save_config()
+        # 服务运行中（或正在停止）时等停止完成后再关闭窗口
         if self.server_running:
             self.stop_server()
-        self.root.destroy()
+        else:
+            self.root.destroy()
 
 def main():
     root = tk.Tk()
@@ -0,0 +1,45 @@
+# -*- mode: python ; coding: utf-8 -*-
+# GUI的PyInstaller打包配置，在本目录中运行 build_gui.bat（或 pyinstaller --noconfirm gui_message_forwarder.spec）
+#
+# 转发引擎 forwarder_core 与 websocket_transport 位于同级的 python源码 目录，与CLI共用；
+# 打包时把该目录加入分析路径，两个模块随GUI一起打入可执行文件，运行时不再依赖 sys.path。
+# 使用目录模式（onedir）而不是单文件：单文件每次启动都要先解压到临时目录，冷启动明显变慢。
+# 打包结果在 dist/gui_message_forwarder/ 中，config.txt 与可执行文件放在同一目录。
+import os
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(SPEC))
+ENGINE_DIR = os.path.join(os.path.dirname(SOURCE_DIR), "python源码")
+
+a = Analysis(
+    [os.path.join(SOURCE_DIR, "gui_message_forwarder.py")],
+    pathex=[ENGINE_DIR],
+    binaries=[],
+    datas=[],
+    # requests 在第一次启动转发服务时才在函数内导入，显式列出以免被静态分析漏掉
+    hiddenimports=["forwarder_core", "websocket_transport", "requests", "requests.adapters", "urllib3.exceptions"],
+    hookspath=[],
+    runtime_hooks=[],
+    excludes=[],
+    noarchive=False,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name="gui_message_forwarder",
+    debug=False,
+    strip=False,
+    upx=False,
+    console=False,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    name="gui_message_forwarder",
+)
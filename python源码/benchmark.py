@@ -0,0 +1,384 @@
+"""转发服务压测工具
+
+在本机启动转发引擎、模拟Lagrange OneBot HTTP/WebSocket接口的桩服务与模拟OlivOS的回调接收端，
+用多个并发客户端发送私聊/群聊 send_msg 请求，统计吞吐量、延迟分位数与错误率。
+不需要真实的机器人即可比较不同配置下的性能、发现性能回退。
+--startup 改为测量冷启动：在新的解释器进程中分别导入引擎、CLI与GUI模块，统计耗时与最慢的依赖。
+
+用法示例:
+    python benchmark.py --requests 5000 --concurrency 32 --max-workers 16
+    python benchmark.py --startup --startup-runs 10
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import websocket_transport
+from forwarder_core import ForwarderConfig, ForwarderEngine
+
+class StubLagrangeHandler(BaseHTTPRequestHandler):
+    """模拟Lagrange的OneBot HTTP与正向WebSocket接口，send_msg 返回自增的 message_id"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle_action(self, body):
+        stub = self.server
+        if stub.delay:
+            time.sleep(stub.delay)
+        with stub.lock:
+            stub.received += 1
+            message_id = stub.received
+        if not body.get("message"):
+            return {"status": "failed", "retcode": 100, "data": None}
+        return {"status": "ok", "retcode": 0, "data": {"message_id": message_id}}
+
+    def do_GET(self):
+        if "access_token=" not in self.path or not websocket_transport.is_upgrade_request(self.headers):
+            self.send_error(400)
+            return
+        conn = websocket_transport.server_handshake(self)
+        while True:
+            text = conn.recv()
+            if text is None:
+                break
+            frame = json.loads(text)
+            response = self._handle_action(frame.get("params", {}))
+            response["echo"] = frame.get("echo")
+            conn.send_text(json.dumps(response))
+        conn.close()
+
+    def do_POST(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(content_length) or b"{}")
+        if "access_token=" not in self.path:
+            data = {"status": "failed", "retcode": 1403, "data": None}
+        else:
+            data = self._handle_action(body)
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class StubCallbackHandler(BaseHTTPRequestHandler):
+    """模拟OlivOS接收回调，只计数"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(content_length)
+        with self.server.lock:
+            self.server.received += 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+def start_stub(host, port, handler_class, delay=0.0):
+    """在后台线程启动桩服务，返回server，用完后调用 shutdown() 与 server_close()"""
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.received = 0
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, name=f"stub-{port}", daemon=True).start()
+    return server
+
+def wait_for(stub, count, timeout=5):
+    """等待桩服务收到 count 个请求，超时后直接返回"""
+    deadline = time.monotonic() + timeout
+    while stub.received < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+def build_payload(index, group_ratio):
+    """第 index 条压测消息，每100条中前 group_ratio*100 条为群聊消息，其余为私聊"""
+    if index % 100 < group_ratio * 100:
+        return {
+            "message_type": "group",
+            "group_id": 100000 + index % 50,
+            "message": f"benchmark group message {index}",
+            "echo": str(index)
+        }
+    return {
+        "message_type": "private",
+        "user_id": 200000 + index % 50,
+        "message": f"benchmark private message {index}",
+        "echo": str(index)
+    }
+
+def percentile(sorted_values, pct):
+    """最近秩法计算分位数，sorted_values 需已升序排列"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+# 冷启动测量的模块: (名称, 所在目录)
+STARTUP_MODULES = (
+    ("forwarder_core", "python源码"),
+    ("message_forwarder", "python源码"),
+    ("gui_message_forwarder", "gui源码"),
+)
+
+def _parse_importtime(stderr, module):
+    """从 -X importtime 的输出中取出 module 的累计导入耗时与其直接依赖的耗时（秒）"""
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 0:
+            if name.strip() == module:
+                return seconds, children
+            children = []
+        elif depth == 1:
+            children.append((name.strip(), seconds))
+    return 0.0, []
+
+def measure_startup(runs=5, modules=STARTUP_MODULES):
+    """在新的解释器进程中导入各模块 runs 次，返回各模块的耗时中位数
+
+    wall 包括解释器自身的启动，import 只计该模块的导入；network 表示导入后是否已加载requests。
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(root, directory) for directory in sorted({d for _, d in modules})]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+
+    def run(code):
+        started = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                                 stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        return time.perf_counter() - started, process
+
+    results = {"interpreter": statistics.median(run("pass")[0] for _ in range(runs)), "modules": {}}
+    for module, _ in modules:
+        walls, imports, slowest, network = [], [], [], False
+        for _ in range(runs):
+            wall, process = run(f"import sys, {module}; print('requests' in sys.modules)")
+            if process.returncode != 0:
+                raise RuntimeError(f"导入 {module} 失败:\n{process.stderr[-2000:]}")
+            seconds, children = _parse_importtime(process.stderr, module)
+            walls.append(wall)
+            imports.append(seconds)
+            slowest = sorted(children, key=lambda item: -item[1])[:5]
+            network = process.stdout.strip().endswith("True")
+        results["modules"][module] = {
+            "wall": statistics.median(walls),
+            "import": statistics.median(imports),
+            "network": network,
+            "slowest": slowest
+        }
+    return results
+
+def print_startup_report(result):
+    print(f"解释器启动: {result['interpreter'] * 1000:.1f} ms")
+    for module, values in result["modules"].items():
+        print(f"{module}: 进程总耗时 {values['wall'] * 1000:.1f} ms  导入 {values['import'] * 1000:.1f} ms"
+              f"{'  (已导入requests)' if values['network'] else ''}")
+        print("    最慢的依赖: " + "  ".join(f"{name} {seconds * 1000:.1f}" for name, seconds in values["slowest"]))
+
+def run_benchmark(total=2000, concurrency=16, group_ratio=0.5, host="127.0.0.1",
+                  forwarder_port=19784, lagrange_port=19785, callback_port=19786,
+                  upstream_delay=0.0, warmup=50, targets=1, **options):
+    """启动转发引擎与桩服务并发送压测请求，返回统计结果字典
+
+    targets 大于1时启动多个桩Lagrange，第一个使用 lagrange_port，其余依次使用 callback_port 之后的端口。
+    options 会传给 ForwarderConfig，用来比较不同的线程数、连接池大小、多目标策略等配置。
+    """
+    lagrange_ports = [lagrange_port] + [callback_port + i for i in range(1, max(1, targets))]
+    if targets > 1:
+        options["targets"] = [{"host": host, "port": port} for port in lagrange_ports]
+    options.setdefault("log_level", "WARNING")
+    config = ForwarderConfig(
+        local_host=host,
+        local_port=forwarder_port,
+        target_host=host,
+        target_port=lagrange_port,
+        callback_host=host,
+        callback_port=callback_port,
+        **options
+    )
+    lagranges = [start_stub(host, port, StubLagrangeHandler, upstream_delay) for port in lagrange_ports]
+    olivos = start_stub(host, callback_port, StubCallbackHandler)
+    engine = ForwarderEngine(config)
+    engine.start()
+
+    url = f"http://{host}:{forwarder_port}/send_msg?access_token={config.local_token}"
+    headers = {'Authorization': f"Bearer {config.local_token}"}
+    local = threading.local()
+    # WebSocket接入时所有客户端线程共用一条连接，响应在连接上直接返回，没有回调
+    ws_client = None
+    if config.local_transport == "ws":
+        ws_client = websocket_transport.OneBotWebSocketClient(host, forwarder_port, config.local_token)
+
+    def send_ws(index):
+        started = time.perf_counter()
+        try:
+            ok = ws_client.call("send_msg", build_payload(index, group_ratio), timeout=10).get("status") in ("ok", "async")
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def send(index):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = session.post(url, json=build_payload(index, group_ratio), headers=headers, timeout=10)
+            ok = response.status_code == 200 and response.json().get("status") in ("ok", "async")
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    if ws_client is not None:
+        send = send_ws
+    expected_callbacks = 0 if ws_client is not None else 1
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            list(executor.map(send, range(warmup)))
+            wait_for(olivos, warmup * expected_callbacks)
+            for lagrange in lagranges:
+                lagrange.received = 0
+            olivos.received = 0
+            started = time.perf_counter()
+            results = list(executor.map(send, range(total)))
+            elapsed = time.perf_counter() - started
+
+        # 等待后台队列中的回调发送完
+        wait_for(olivos, total * expected_callbacks)
+        stages = engine.metrics.snapshot()["stages"]
+    finally:
+        if ws_client is not None:
+            ws_client.close()
+        engine.stop()
+        for stub in lagranges + [olivos]:
+            stub.shutdown()
+            stub.server_close()
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0
+        },
+        "stage_avg_ms": {stage: values["avg_ms"] for stage, values in stages.items()},
+        "upstream_received": sum(lagrange.received for lagrange in lagranges),
+        "upstream_received_by_target": [lagrange.received for lagrange in lagranges],
+        "callbacks_received": olivos.received
+    }
+
+def print_report(result):
+    latency = result["latency_ms"]
+    print(f"请求数: {result['requests']}  并发: {result['concurrency']}  耗时: {result['elapsed']:.2f}s")
+    print(f"吞吐量: {result['throughput']:.1f} 条/秒")
+    print(f"延迟(ms): mean {latency['mean']:.2f}  p50 {latency['p50']:.2f}  "
+          f"p95 {latency['p95']:.2f}  p99 {latency['p99']:.2f}  max {latency['max']:.2f}")
+    print("转发服务各阶段平均耗时(ms): " + "  ".join(
+        f"{stage} {avg:.2f}" for stage, avg in result["stage_avg_ms"].items()))
+    print(f"错误: {result['errors']} ({result['error_rate']:.2%})")
+    print(f"Lagrange收到: {result['upstream_received']}  回调收到: {result['callbacks_received']}")
+    if len(result["upstream_received_by_target"]) > 1:
+        print("各目标收到: " + " / ".join(str(count) for count in result["upstream_received_by_target"]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OlivOS到Lagrange转发服务压测")
+    parser.add_argument("--requests", type=int, default=2000, help="压测请求总数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发客户端数")
+    parser.add_argument("--group-ratio", type=float, default=0.5, help="群聊消息所占比例(0-1)")
+    parser.add_argument("--warmup", type=int, default=50, help="正式计时前的预热请求数")
+    parser.add_argument("--upstream-delay", type=float, default=0.0, help="桩Lagrange每次响应前等待的秒数")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--forwarder-port", type=int, default=19784)
+    parser.add_argument("--lagrange-port", type=int, default=19785)
+    parser.add_argument("--callback-port", type=int, default=19786)
+    parser.add_argument("--max-workers", type=int, default=16, help="转发服务处理线程数")
+    parser.add_argument("--pool-size", type=int, default=16, help="keep-alive连接池大小")
+    parser.add_argument("--coalesce-window-ms", type=int, default=0, help="消息合并窗口（毫秒），0 表示不合并")
+    parser.add_argument("--targets", type=int, default=1, help="桩Lagrange数量")
+    parser.add_argument("--strategy", default="round_robin", help="多目标选择策略")
+    parser.add_argument("--broadcast", action="store_true", help="每条消息发送到所有目标")
+    parser.add_argument("--ingress", choices=("http", "ws"), default="http", help="接收端传输方式")
+    parser.add_argument("--egress", choices=("http", "ws"), default="http", help="发送端传输方式")
+    parser.add_argument("--outbox", default="", help="开启落盘待发送队列并使用该文件（压测前会清空）")
+    parser.add_argument("--log-level", default="WARNING", help="转发服务日志级别")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    parser.add_argument("--startup", action="store_true", help="测量冷启动（模块导入）耗时，不进行压测")
+    parser.add_argument("--startup-runs", type=int, default=5, help="冷启动测量次数，取中位数")
+    parser.add_argument("--startup-budget", type=float, default=1.0,
+                        help="任一模块的进程总耗时超过该秒数时以退出码1结束")
+    args = parser.parse_args(argv)
+    if args.startup:
+        result = measure_startup(max(1, args.startup_runs))
+        if args.json:
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+        else:
+            print_startup_report(result)
+        return int(any(values["wall"] > args.startup_budget for values in result["modules"].values()))
+    outbox = {}
+    if args.outbox:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.outbox + suffix):
+                os.remove(args.outbox + suffix)
+        outbox = {"outbox_enabled": True, "outbox_path": args.outbox}
+
+    result = run_benchmark(
+        total=args.requests,
+        concurrency=args.concurrency,
+        group_ratio=args.group_ratio,
+        host=args.host,
+        forwarder_port=args.forwarder_port,
+        lagrange_port=args.lagrange_port,
+        callback_port=args.callback_port,
+        upstream_delay=args.upstream_delay,
+        warmup=args.warmup,
+        max_workers=args.max_workers,
+        pool_size=args.pool_size,
+        coalesce_window_ms=args.coalesce_window_ms,
+        targets=args.targets,
+        target_strategy=args.strategy,
+        target_broadcast=args.broadcast,
+        local_transport=args.ingress,
+        target_transport=args.egress,
+        log_level=args.log_level,
+        **outbox
+    )
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        print_report(result)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3414 @@
+"""OlivOS到Lagrange转发服务核心
+
+CLI（message_forwarder.py）与GUI（gui_message_forwarder.py）共用的转发引擎，
+包含并发HTTP服务、keep-alive连接池、后台回调投递队列与异步日志。
+"""
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import logging.handlers
+import zlib
+import hmac
+import bisect
+import hashlib
+import random
+import socket
+import sqlite3
+import threading
+import functools
+import collections
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote, unquote, urlencode
+
+import websocket_transport
+
+# requests 导入较慢（约占本模块导入时间的一半），GUI与CLI启动时不导入，
+# 第一次创建连接池（启动转发服务）时由 import_network() 导入
+requests = None
+HTTPAdapter = None
+NewConnectionError = None
+
+def import_network():
+    """导入requests与urllib3，已导入时直接返回"""
+    global requests, HTTPAdapter, NewConnectionError
+    if requests is not None:
+        return
+    import requests as module
+    from requests.adapters import HTTPAdapter as adapter
+    from urllib3.exceptions import NewConnectionError as new_connection_error
+    HTTPAdapter, NewConnectionError = adapter, new_connection_error
+    # 最后设置 requests，其他线程看到它已导入时另外两个名称也已可用
+    requests = module
+
+# 安装了 orjson 时用它解析与序列化请求/响应体，否则使用标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(data):
+        """序列化为UTF-8编码的bytes"""
+        return orjson.dumps(data, default=_json_default)
+else:
+    json_loads = json.loads
+
+    def json_dumps(data):
+        """序列化为UTF-8编码的bytes"""
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+# 转发服务默认配置，键名与GUI的config.txt一致
+DEFAULT_CONFIG = {
+    "local_host": "127.0.0.1",  # 接收端监听地址
+    "local_port": 9784,
+    "local_token": "114514",  # 接收端验证令牌
+    "target_host": "127.0.0.1",  # Lagrange地址
+    "target_port": 9785,
+    "target_token": "114514",  # 发送端验证令牌
+    "targets": [],  # 多个Lagrange目标，如 [{"host": "127.0.0.1", "port": 9785, "token": "114514"}]，留空则只使用上面的单个目标
+    "target_strategy": "round_robin",  # 多目标选择策略: round_robin 轮询 / least_inflight 进行中请求最少 / sticky_group 同一群或私聊固定目标
+    "target_broadcast": False,  # True 时每条消息同时发送到所有可用目标
+    "health_check_interval": 10.0,  # 多目标时的健康检查间隔秒数，0 表示不检查
+    "local_transport": "http",  # 接收端传输方式: http 只接受HTTP POST / ws 同时接受OneBot正向WebSocket连接
+    "local_reuse_port": False,  # 允许多个进程同时监听同一端口（SO_REUSEPORT，仅Linux/BSD），多进程运行时使用
+    "target_transport": "http",  # 发送端传输方式: http 每条消息一次HTTP POST / ws 与Lagrange保持正向WebSocket长连接
+    "target_ws_path": "/",  # 发送端WebSocket连接路径
+    "routes": [],  # 多账号路由表，每条为 {"name", 选择条件 port / path_prefix / token, 要覆盖的配置项}，见 parse_routes
+    "event_enabled": False,  # 是否开启上报事件转发（Lagrange → OlivOS）
+    "event_host": "127.0.0.1",  # 接收Lagrange上报事件的监听地址
+    "event_port": 9786,
+    "event_token": "",  # Lagrange上报使用的令牌（Authorization 或 access_token），留空不校验
+    "event_secret": "",  # Lagrange上报的签名密钥（X-Signature），留空不校验
+    "olivos_event_host": "127.0.0.1",  # OlivOS接收上报事件的地址
+    "olivos_event_port": 55001,
+    "olivos_event_token": "",  # 转发给OlivOS时使用的令牌，留空不附带
+    "olivos_event_secret": "",  # 转发给OlivOS时的签名密钥，留空不签名
+    "event_workers": 2,  # 后台事件投递线程数
+    "event_queue_size": 10000,  # 待投递事件队列上限
+    "event_backpressure_timeout": 2.0,  # 事件队列满时让Lagrange的上报请求最多等待的秒数，仍然满则返回503
+    "callback_host": "",  # 回调发送地址，留空则回调到接收端监听地址
+    "callback_port": 0,  # 回调发送端口，为0则使用接收端监听端口
+    "max_workers": 16,  # 并发处理请求的最大线程数
+    "shutdown_timeout": 5.0,  # 停止服务时等待进行中的请求与回调队列发送完的最长秒数
+    "upstream_connect_timeout": 3.0,  # 连接Lagrange的超时秒数
+    "upstream_read_timeout": 5.0,  # 等待Lagrange响应的超时秒数
+    "upstream_retries": 2,  # 连接失败（消息确定未送达）时的最大重试次数
+    "upstream_retry_backoff": 0.2,  # 重试等待上限秒数，每次翻倍，实际等待在0到上限间随机
+    "breaker_failure_threshold": 5,  # 连续失败多少次后熔断，0 表示不熔断
+    "breaker_reset_timeout": 10.0,  # 熔断多少秒后放行一个探测请求
+    "pool_size": 16,  # 每个目标的keep-alive连接池大小
+    "pool_idle_timeout": 60.0,  # 连接池空闲多少秒后关闭重建
+    "coalesce_window_ms": 0,  # 合并同一会话连续文本消息的等待窗口（毫秒），0 表示不合并
+    "coalesce_max_messages": 10,  # 单次合并的最大消息条数
+    "coalesce_max_chars": 2000,  # 合并后消息的最大字符数
+    "rate_limit_global": 0.0,  # 发往Lagrange的总速率（条/秒），0 表示不限速
+    "rate_limit_global_burst": 10,  # 总速率允许的突发条数
+    "rate_limit_group": 0.0,  # 每个群的速率（条/秒），0 表示不限速
+    "rate_limit_group_burst": 5,
+    "rate_limit_user": 0.0,  # 每个私聊对象的速率（条/秒），0 表示不限速
+    "rate_limit_user_burst": 5,
+    "rate_limit_max_wait": 10.0,  # 超出速率时最多排队等待的秒数，超时按转发失败处理
+    "rate_limit_private_first": True,  # 排队时私聊消息优先于群消息发送
+    "action_transforms": {},  # 按动作名覆盖 ACTION_TRANSFORMS 中的请求体改写规则，值为 null 表示原样透传
+    "response_cache_enabled": False,  # 缓存只读查询动作（get_group_list 等）的响应
+    "response_cache_ttls": {},  # 按动作名覆盖 CACHE_TTLS 中的缓存秒数，0 表示不缓存该动作
+    "response_cache_max_entries": 5000,  # 最多缓存的响应条数，超出时淘汰最久未使用的
+    "response_cache_max_bytes": 32 * 1024 * 1024,  # 缓存响应体的总大小上限
+    "dedup_enabled": False,  # 在时间窗口内识别重复的发送请求（OlivOS超时重试），直接返回第一次的响应
+    "dedup_window": 10.0,  # 重复请求的识别窗口（秒）
+    "dedup_max_entries": 10000,  # 窗口内最多记住的请求数，超出时忘记最早的
+    "dedup_actions": "send_msg,send_private_msg,send_group_msg",  # 参与去重的动作，逗号分隔
+    "dedup_by_content": True,  # 没有echo的请求按消息类型、目标与内容识别重复；False 时只按echo
+    "outbox_enabled": False,  # 落盘待发送队列：消息先写入本地文件再由后台发送，Lagrange重启期间不丢消息
+    "outbox_path": "outbox.db",  # 待发送队列文件（SQLite）路径
+    "outbox_actions": "send_msg,send_private_msg,send_group_msg",  # 经过待发送队列的动作，逗号分隔
+    "outbox_workers": 4,  # 发送线程数，同一群或私聊对象的消息总由同一线程按顺序发送
+    "outbox_flush_interval_ms": 0,  # 合并写入的等待时间（毫秒），0 表示只合并上次提交期间到达的写入
+    "outbox_max_bytes": 256 * 1024 * 1024,  # 队列文件达到该大小后拒绝新消息，0 表示不限制
+    "outbox_max_age": 86400.0,  # 超过该秒数仍未发出的消息被丢弃，0 表示不过期
+    "callback_workers": 2,  # 后台回调投递线程数
+    "callback_queue_size": 1000,  # 回调队列最大长度
+    "callback_retries": 3,  # 回调失败后的最大重试次数
+    "callback_retry_backoff": 0.5,  # 首次重试等待秒数，之后每次翻倍
+    "callback_overflow": "drop_oldest",  # 队列满时的策略: drop_oldest 丢弃最旧 / drop_new 丢弃新回调
+    "log_level": "DEBUG",  # DEBUG 输出完整收发数据，INFO 及以上只记录运行状态与错误
+    "log_compact": False,  # True 时每条日志输出为单行JSON
+    "log_file": "",  # 日志文件路径，留空则只输出到控制台
+    "log_file_max_bytes": 10 * 1024 * 1024,  # 单个日志文件达到该大小后轮转
+    "log_file_backups": 5,  # 保留的历史日志文件数
+    "log_queue_size": 10000,  # 待写日志队列上限，写入跟不上时丢弃新日志
+}
+
+# 只能取固定值的配置项
+CONFIG_CHOICES = {
+    "target_strategy": ("round_robin", "least_inflight", "sticky_group"),
+    "local_transport": ("http", "ws"),
+    "target_transport": ("http", "ws"),
+    "callback_overflow": ("drop_oldest", "drop_new"),
+}
+
+def parse_targets(value):
+    """解析转发目标列表
+
+    接受 [{"host": ..., "port": ..., "token": ...}] 形式的列表，或 "host:port[:token]" 以逗号/换行分隔的字符串，
+    返回 [{"host", "port", "token"}] 列表，token 为空时使用 target_token。
+    """
+    if isinstance(value, str):
+        value = [item.strip() for item in value.replace("\n", ",").split(",") if item.strip()]
+    targets = []
+    for item in value:
+        if isinstance(item, str):
+            host, _, rest = item.partition(":")
+            port, _, token = rest.partition(":")
+            item = {"host": host, "port": port, "token": token}
+        if not item.get("host") or not item.get("port"):
+            raise ValueError(f"转发目标缺少地址或端口: {item!r}")
+        targets.append({"host": str(item["host"]), "port": int(item["port"]), "token": str(item.get("token") or "")})
+    return targets
+
+def expand_extra_targets(options):
+    """展开config.txt中GUI使用的 extra_targets（host:port[:token] 以逗号分隔）
+
+    不为空时 target_host/target_port/target_token 作为第一个目标，与其他目标一起组成 targets，返回新的字典。
+    """
+    extra_targets = parse_targets(options.get("extra_targets") or "")
+    if not extra_targets:
+        return options
+    options = dict(options)
+    options["targets"] = [{
+        "host": options.get("target_host", DEFAULT_CONFIG["target_host"]),
+        "port": options.get("target_port", DEFAULT_CONFIG["target_port"]),
+        "token": options.get("target_token", DEFAULT_CONFIG["target_token"])
+    }] + extra_targets
+    return options
+
+def parse_action_transforms(value):
+    """解析动作改写规则，在这里编译一次，规则无效时配置校验即失败"""
+    value = _coerce(value, {})
+    ActionTransforms(value)
+    return value
+
+def parse_response_cache_ttls(value):
+    """解析按动作名覆盖的缓存秒数，返回 {动作名: 秒数}，空值按0（不缓存）处理"""
+    ttls = {}
+    for action, ttl in _coerce(value, {}).items():
+        try:
+            ttls[action] = float(ttl or 0)
+        except (TypeError, ValueError):
+            raise ValueError(f"动作 {action} 的缓存秒数无效: {ttl!r}")
+    return ttls
+
+def parse_log_level(value):
+    """日志级别统一为大写，未知级别在配置校验时即失败"""
+    level = str(value).strip().upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError(f"未知的日志级别: {value!r}")
+    return level
+
+# 路由可以覆盖的配置项；监听地址、处理线程、连接池、回调队列、上报事件、待发送队列与日志由所有路由共用
+ROUTE_KEYS = (
+    "local_token", "target_host", "target_port", "target_token", "targets", "target_strategy", "target_broadcast",
+    "health_check_interval", "target_transport", "target_ws_path", "callback_host", "callback_port",
+    "upstream_connect_timeout", "upstream_read_timeout", "upstream_retries", "upstream_retry_backoff",
+    "breaker_failure_threshold", "breaker_reset_timeout", "coalesce_window_ms", "coalesce_max_messages",
+    "coalesce_max_chars", "rate_limit_global", "rate_limit_global_burst", "rate_limit_group", "rate_limit_group_burst",
+    "rate_limit_user", "rate_limit_user_burst", "rate_limit_max_wait", "rate_limit_private_first",
+    "action_transforms", "response_cache_enabled", "response_cache_ttls", "response_cache_max_entries",
+    "response_cache_max_bytes", "dedup_enabled", "dedup_window", "dedup_max_entries", "dedup_actions",
+    "dedup_by_content",
+)
+
+def parse_routes(value):
+    """解析路由表
+
+    接受列表或JSON字符串，每条路由是带 name 与至少一个选择条件的字典：
+    port 在该端口上单独监听（与 local_port 相同时共用主监听），path_prefix 按请求路径前缀选择（转发时去掉前缀），
+    token 按接收端令牌选择（同时作为该路由的 local_token）。其余键为要覆盖的 ROUTE_KEYS 中的配置项。
+    返回整理后的路由列表，名称或选择条件重复、缺少选择条件或含有不能覆盖的配置项时抛出ValueError。
+    """
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip() else []
+    if not isinstance(value, list):
+        raise ValueError("路由表应为列表")
+    routes = []
+    names = set()
+    selectors = set()
+    for item in value:
+        if not isinstance(item, dict):
+            raise ValueError(f"路由应为字典: {item!r}")
+        route = dict(item)
+        name = str(route.pop("name", "") or "").strip()
+        if not name:
+            raise ValueError(f"路由缺少名称: {item!r}")
+        if name in names:
+            raise ValueError(f"路由名称重复: {name}")
+        port = int(route.pop("port", 0) or 0)
+        path_prefix = str(route.pop("path_prefix", "") or "").strip().rstrip("/")
+        if path_prefix and not path_prefix.startswith("/"):
+            path_prefix = "/" + path_prefix
+        token = str(route.pop("token", "") or "")
+        if not (port or path_prefix or token):
+            raise ValueError(f"路由 {name} 需要 port、path_prefix、token 中的至少一个选择条件")
+        if token and "local_token" in route:
+            raise ValueError(f"路由 {name} 的 token 即为接收端令牌，不能再设置 local_token")
+        unknown = set(route) - set(ROUTE_KEYS)
+        if unknown:
+            raise ValueError(f"路由 {name} 不能设置: {', '.join(sorted(unknown))}")
+        if (port, path_prefix, token) in selectors:
+            raise ValueError(f"路由 {name} 的选择条件与其他路由相同")
+        names.add(name)
+        selectors.add((port, path_prefix, token))
+        routes.append(dict(route, name=name, port=port, path_prefix=path_prefix, token=token))
+    return routes
+
+# 需要专门解析的配置项
+CONFIG_PARSERS = {
+    "targets": parse_targets,
+    "routes": parse_routes,
+    "action_transforms": parse_action_transforms,
+    "response_cache_ttls": parse_response_cache_ttls,
+    "log_level": parse_log_level,
+}
+
+def _coerce(value, default):
+    """把配置值转换为与默认值相同的类型（config.txt中的数字与布尔值可能是字符串）"""
+    if isinstance(default, dict):
+        if isinstance(value, str):
+            value = json.loads(value) if value.strip() else {}
+        if not isinstance(value, dict):
+            raise ValueError(value)
+        return dict(value)
+    if isinstance(default, bool):
+        if isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return bool(value)
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return str(value)
+
+class ForwarderConfig:
+    """转发服务配置
+
+    字段与 DEFAULT_CONFIG 一一对应，未给出的字段使用默认值，
+    数字与布尔值会按默认值的类型转换，类型不对时抛出ValueError。
+    """
+    def __init__(self, **options):
+        unknown = set(options) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"未知配置项: {', '.join(sorted(unknown))}")
+        for key, default in DEFAULT_CONFIG.items():
+            value = options.get(key, default)
+            parser = CONFIG_PARSERS.get(key)
+            try:
+                setattr(self, key, parser(value) if parser is not None else _coerce(value, default))
+            except (TypeError, ValueError) as e:
+                if parser is not None:
+                    raise ValueError(f"配置项 {key} 无效: {e}")
+                raise ValueError(f"配置项 {key} 的值无效: {value!r}")
+        for key, choices in CONFIG_CHOICES.items():
+            if getattr(self, key) not in choices:
+                raise ValueError(f"配置项 {key} 只能是 {' / '.join(choices)}")
+        # 路由覆盖的配置项同样要有效
+        for route in self.routes:
+            if route["port"] == self.local_port and not (route["path_prefix"] or route["token"]):
+                raise ValueError(f"路由 {route['name']} 只按端口选择时不能使用主监听端口 {self.local_port}")
+            self.route_config(route)
+
+    @classmethod
+    def from_dict(cls, data):
+        """从config.txt格式的字典构造，忽略其中与转发引擎无关的键"""
+        return cls(**{key: value for key, value in data.items() if key in DEFAULT_CONFIG})
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in DEFAULT_CONFIG}
+
+    def route_config(self, route):
+        """路由 route（routes 中的一项）合并覆盖项后的完整配置"""
+        options = self.to_dict()
+        options.update((key, value) for key, value in route.items() if key in ROUTE_KEYS)
+        # 只改了单个目标时不沿用顶层的多目标列表
+        if "targets" not in route and {"target_host", "target_port"} & set(route):
+            options["targets"] = []
+        if route["port"]:
+            options["local_port"] = route["port"]
+        if route["token"]:
+            options["local_token"] = route["token"]
+        options["routes"] = []
+        try:
+            return ForwarderConfig(**options)
+        except ValueError as e:
+            raise ValueError(f"路由 {route['name']}: {e}")
+
+    def upstreams(self):
+        """返回全部转发目标 [(host, port, token)]，未配置 targets 时只有 target_host/target_port 一个"""
+        if not self.targets:
+            return [(self.target_host, self.target_port, self.target_token)]
+        return [(t["host"], t["port"], t["token"] or self.target_token) for t in self.targets]
+
+logger = logging.getLogger("forwarder")
+
+class ConfigWatcher:
+    """定时检查config.txt格式的配置文件，修改时间或大小变化后读取并调用 on_change(dict)
+
+    文件不存在或内容不是合法JSON时只记录日志，等下一次修改再重试。
+    ignore() 记下文件当前状态，用于跳过程序自己保存配置引起的变化。
+    """
+    def __init__(self, path, on_change, interval=2.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._stat = self._current()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _current(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def ignore(self):
+        self._stat = self._current()
+
+    def check(self):
+        """检查一次，文件有变化且读取成功时调用 on_change 并返回True"""
+        stat = self._current()
+        if stat is None or stat == self._stat:
+            return False
+        self._stat = stat
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("配置文件内容应为JSON对象")
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取配置文件 {self.path} 失败: {e}")
+            return False
+        try:
+            self.on_change(data)
+        except Exception:
+            logger.exception(f"应用配置文件 {self.path} 失败")
+            return False
+        return True
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="config-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.interval + 1)
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval):
+            self.check()
+
+# 区分"没有附带数据"和"附带的数据为None"
+_NO_PAYLOAD = object()
+
+class LogFormatter(logging.Formatter):
+    """在后台写日志线程中格式化日志记录
+
+    默认输出与原先print_log一致的带缩进多行格式，compact=True 时每条记录输出为单行JSON。
+    """
+    def __init__(self, compact=False):
+        super().__init__()
+        self.compact = compact
+
+    def format(self, record):
+        timestamp = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        title = record.getMessage()
+        data = getattr(record, "payload", _NO_PAYLOAD)
+        if self.compact:
+            entry = {"time": timestamp, "level": record.levelname, "event": title}
+            if data is not _NO_PAYLOAD:
+                entry["data"] = data
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=_json_default)
+        if data is _NO_PAYLOAD:
+            text = f"[{timestamp}] {title}"
+        else:
+            text = f"\n[{timestamp}] \n=== {title} ===\n" + json.dumps(data, indent=2, ensure_ascii=False, default=_json_default)
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """请求线程只把日志记录放入队列，格式化与输出全部交给后台写日志线程"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 不在调用线程中格式化，直接把原始记录交给后台线程
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level="DEBUG", compact=False, log_file="", max_bytes=10 * 1024 * 1024,
+                  backup_count=5, queue_size=10000, stream=None, install=True):
+    """配置异步日志管线，返回退出时需要stop()的QueueListener
+
+    install=False 时只建好输出与队列而不替换当前日志管线，之后用 install_logging() 启用
+    """
+    level = parse_log_level(level)
+    formatter = LogFormatter(compact)
+    handlers = [logging.StreamHandler(stream or sys.stdout)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    listener = logging.handlers.QueueListener(queue.Queue(maxsize=max(1, int(queue_size))), *handlers)
+    if install:
+        install_logging(listener, level)
+    return listener
+
+def install_logging(listener, level="DEBUG"):
+    """让日志记录写入该管线的队列并启动输出线程"""
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(AsyncQueueHandler(listener.queue))
+    logger.setLevel(parse_log_level(level))
+    logger.propagate = False
+    listener.start()
+
+def stop_logging(listener):
+    """写完队列中剩余的日志后关闭所有输出"""
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+def _json_default(value):
+    """日志中透传的原始请求体按文本输出"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+def print_log(title, data, level=logging.DEBUG):
+    """记录一条带数据的日志
+
+    数据在后台线程中才会被序列化，放入日志后调用方不应再修改它；
+    级别未开启时直接返回，不产生任何格式化开销。
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, title, extra={"payload": data})
+
+class RelayedResponse(dict):
+    """Lagrange返回的响应：解析出的字段供判断状态与构造回调，raw 为原始响应体
+
+    原样返回给调用方时直接写出 raw，不再重新序列化；需要修改字段时复制为普通dict。
+    """
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        super().__init__(json_loads(raw))
+        self.raw = raw
+
+# 按动作名改写请求体的规则，没有列出的动作原样透传原始请求体
+#   fields   只保留这些字段（按此顺序），不写则保留全部字段
+#   defaults 请求中没有该字段时使用的值（同时保证字段出现）
+#   rename   字段改名 {原名: 新名}
+#   when     [{"field": 字段, "equals": 值, "drop": [要去掉的字段], "defaults": {...}}]，条件成立时额外处理
+ACTION_TRANSFORMS = {
+    # 保持原有 send_msg 的构造规则：群消息只带 group_id
+    "send_msg": {
+        "fields": ["message_type", "message", "auto_escape", "user_id", "group_id"],
+        "defaults": {"message_type": None, "message": None, "auto_escape": False},
+        "when": [{"field": "message_type", "equals": "group", "drop": ["user_id"], "defaults": {"group_id": None}}]
+    },
+}
+
+def _compile_transform(spec):
+    """把一条声明式改写规则编译为 body -> dict 的函数"""
+    fields = tuple(spec["fields"]) if spec.get("fields") else None
+    defaults = tuple(dict(spec.get("defaults") or {}).items())
+    rename = tuple(dict(spec.get("rename") or {}).items())
+    conditions = tuple(
+        (rule["field"], rule.get("equals"), tuple(rule.get("drop") or ()), tuple(dict(rule.get("defaults") or {}).items()))
+        for rule in spec.get("when") or ()
+    )
+    default_map = dict(defaults)
+
+    def transform(body):
+        if fields is None:
+            data = dict(body)
+            for key, value in defaults:
+                data.setdefault(key, value)
+        else:
+            data = {}
+            for key in fields:
+                if key in body:
+                    data[key] = body[key]
+                elif key in default_map:
+                    data[key] = default_map[key]
+        for field, equals, drop, extra in conditions:
+            if data.get(field) == equals:
+                for key in drop:
+                    data.pop(key, None)
+                for key, value in extra:
+                    data[key] = body.get(key, value)
+        for old, new in rename:
+            if old in data:
+                data[new] = data.pop(old)
+        return data
+    return transform
+
+class ActionTransforms:
+    """按动作名查找请求体改写函数
+
+    规则在创建时一次性编译，请求时按路径查表（按路径缓存）。
+    没有规则的动作返回None，调用方应原样透传原始请求体，省去解析与重新序列化。
+    overrides 中的规则覆盖 ACTION_TRANSFORMS 的同名规则，值为空表示该动作改为透传。
+    """
+    def __init__(self, overrides=None, cache_size=1024):
+        table = dict(ACTION_TRANSFORMS)
+        table.update(overrides or {})
+        self._transforms = {}
+        for action, spec in table.items():
+            if not spec:
+                continue
+            try:
+                self._transforms[action.strip('/')] = _compile_transform(spec)
+            except (KeyError, TypeError, AttributeError, ValueError):
+                raise ValueError(f"动作 {action} 的改写规则无效: {spec!r}")
+        self.get = functools.lru_cache(maxsize=cache_size)(self._get)
+
+    @staticmethod
+    def action(path):
+        return path.partition('?')[0].strip('/')
+
+    def _get(self, path):
+        return self._transforms.get(self.action(path))
+
+class PathRewriter:
+    """转发路径与回调路径的改写
+
+    令牌相关的字符串与目标URL前缀在创建时一次性算好，配置变化时重新创建即可。
+    target 为 (host, port, token)，用于多目标时为每个目标单独创建，默认使用 target_host/target_port/target_token；
+    local_token 默认为 local_token，上报事件方向改用 event_token。
+    查询串按参数解析，只替换名为 access_token 且值等于接收端令牌的参数，
+    其他参数原样保留；同一请求路径的改写结果会被缓存，重复的接口路径只需一次查表。
+    """
+    def __init__(self, config, target=None, local_token=None, cache_size=1024):
+        target_host, target_port, target_token = target or (config.target_host, config.target_port, config.target_token)
+        self.local_token = config.local_token if local_token is None else local_token
+        self.expected_auth = f"Bearer {self.local_token}"
+        self.target_prefix = f"http://{target_host}:{target_port}"
+        self.callback_prefix = f"http://{config.callback_host or config.local_host}:{config.callback_port or config.local_port}"
+        self._forward_param = "access_token=" + quote(target_token, safe='')
+        self._forward_query = urlencode({"access_token": target_token})
+        self._callback_query = urlencode({"access_token": self.local_token})
+        self._token_param = "access_token=" + quote(self.local_token, safe='')
+        self.rewrite = functools.lru_cache(maxsize=cache_size)(self._rewrite)
+
+    def authorized(self, authorization, path):
+        """Authorization 头或查询串中的 access_token 与接收端令牌一致"""
+        return authorization == self.expected_auth or self._token_param in path.partition('?')[2].split('&')
+
+    def _rewrite(self, path):
+        """返回 (不含查询串的路径, 转发路径, 回调路径)"""
+        clean_path, _, query = path.partition('?')
+        params = query.split('&') if query else []
+        for i, param in enumerate(params):
+            name, _, value = param.partition('=')
+            if name == "access_token" and unquote(value) == self.local_token:
+                # 带有接收端令牌时只替换该参数，回调沿用原路径
+                params[i] = self._forward_param
+                return clean_path, clean_path + "?" + "&".join(params), path
+        return (
+            clean_path,
+            clean_path + "?" + self._forward_query,
+            clean_path + "?" + self._callback_query
+        )
+
+@functools.lru_cache(maxsize=1024)
+def _strip_access_token(path):
+    """去掉查询串中的 access_token 参数，其他参数原样保留"""
+    clean_path, _, query = path.partition('?')
+    params = [param for param in query.split('&') if param and param.partition('=')[0] != "access_token"]
+    return clean_path + "?" + "&".join(params) if params else clean_path
+
+class ForwarderMetrics:
+    """转发服务的计数器与各阶段耗时直方图
+
+    计数器通过 attach() 挂到引擎的事件钩子上累加，耗时由请求处理与回调线程调用 observe() 记录。
+    render() 输出Prometheus文本格式，供 GET /metrics 使用；snapshot() 返回给GUI显示的汇总。
+    """
+    # 直方图桶上限（秒）
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    COUNTERS = {
+        "received": "收到的请求数",
+        "forwarded": "成功转发到Lagrange的消息数",
+        "rejected": "被拒绝的请求数（按状态码）",
+        "upstream_failed": "转发到Lagrange失败的消息数（返回502）",
+        "callback_sent": "成功发送的回调数",
+        "callback_failed": "重试后仍失败的回调数",
+        "callback_dropped": "因队列已满被丢弃的回调数",
+        "coalesced": "被合并发送的消息数",
+        "event_received": "收到的上报事件数",
+        "event_rejected": "认证失败的上报事件数",
+        "event_sent": "成功投递给OlivOS的上报事件数",
+        "event_failed": "重试后仍投递失败的上报事件数",
+        "event_dropped": "因队列已满被丢弃的上报事件数",
+        "outbox_queued": "写入待发送队列的消息数",
+        "outbox_rejected": "因待发送队列已满被拒绝的消息数",
+        "outbox_sent": "从待发送队列成功发出的消息数",
+        "outbox_retries": "待发送消息等待Lagrange恢复的重试次数",
+        "outbox_expired": "过期丢弃的待发送消息数",
+        "outbox_failed": "结果不确定而不再重试的待发送消息数",
+        "duplicates_suppressed": "识别为重复、直接返回第一次响应的请求数",
+        "cache_hits": "由响应缓存直接返回的查询数",
+        "cache_misses": "响应缓存未命中、发往Lagrange的查询数",
+        "rate_limited": "排队超时未能发送的消息数",
+        "upstream_retries": "连接Lagrange失败后的重试次数",
+        "circuit_rejected": "熔断期间直接失败的消息数",
+    }
+    STAGES = {
+        "parse": "读取并解析请求体",
+        "queue": "等待限速令牌",
+        "upstream": "请求Lagrange并解析响应",
+        "callback": "单次回调请求",
+        "event": "单次上报事件投递请求",
+        "outbox": "写入待发送队列并落盘",
+        "write": "写回响应",
+        "request": "完整处理一次转发请求",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._counters = collections.Counter()
+        self._histograms = {stage: [0] * (len(self.BUCKETS) + 1) for stage in self.STAGES}
+        self._sums = dict.fromkeys(self.STAGES, 0.0)
+
+    def inc(self, name, code=None, amount=1):
+        with self._lock:
+            self._counters[(name, code)] += amount
+
+    def _count(self, name, **fields):
+        self.inc(name)
+
+    def observe(self, stage, seconds):
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            self._histograms[stage][index] += 1
+            self._sums[stage] += seconds
+
+    def attach(self, engine):
+        """把计数器挂到引擎事件上"""
+        engine.on("received", lambda **fields: self.inc("received"))
+        engine.on("rejected", lambda code, **fields: self.inc("rejected", code))
+        engine.on("forwarded", lambda **fields: self.inc("forwarded"))
+        engine.on("forward_failed", lambda **fields: self.inc("upstream_failed"))
+        engine.on("callback_sent", lambda **fields: self.inc("callback_sent"))
+        engine.on("callback_failed", lambda **fields: self.inc("callback_failed"))
+        engine.on("callback_dropped", lambda **fields: self.inc("callback_dropped"))
+        engine.on("outbox_retry", lambda **fields: self.inc("outbox_retries"))
+        engine.on("duplicate_suppressed", lambda **fields: self.inc("duplicates_suppressed"))
+        engine.on("cache_hit", lambda **fields: self.inc("cache_hits"))
+        engine.on("cache_miss", lambda **fields: self.inc("cache_misses"))
+        for event in ("event_received", "event_rejected", "event_sent", "event_failed", "event_dropped",
+                      "outbox_queued", "outbox_rejected", "outbox_sent", "outbox_expired", "outbox_failed"):
+            engine.on(event, functools.partial(self._count, event))
+        engine.on("rate_limited", lambda **fields: self.inc("rate_limited"))
+        engine.on("upstream_retry", lambda **fields: self.inc("upstream_retries"))
+        engine.on("circuit_rejected", lambda **fields: self.inc("circuit_rejected"))
+        engine.on("coalesced", lambda messages, **fields: self.inc("coalesced", amount=messages))
+
+    def snapshot(self):
+        """返回各计数器的值与各阶段的次数、平均耗时（毫秒）"""
+        with self._lock:
+            counters = collections.Counter()
+            for (name, _), value in self._counters.items():
+                counters[name] += value
+            stages = {
+                stage: {
+                    "count": sum(buckets),
+                    "avg_ms": self._sums[stage] / sum(buckets) * 1000 if sum(buckets) else 0.0
+                }
+                for stage, buckets in self._histograms.items()
+            }
+        return {"uptime": time.time() - self.started, "counters": dict(counters), "stages": stages}
+
+    def _copy(self):
+        with self._lock:
+            return (dict(self._counters), {stage: list(buckets) for stage, buckets in self._histograms.items()},
+                    dict(self._sums))
+
+    def render(self, gauges=None, routes=None):
+        """输出Prometheus文本格式
+
+        gauges 为额外的 {名称: (说明, 值)}，值为字典时按键分别输出，键为目标名或 ((标签, 值), ...)。
+        routes 为 {路由名: 该路由的ForwarderMetrics}，各路由的计数与耗时带 route 标签输出，不带该标签的为合计。
+        """
+        sources = [("", self._copy())] + [
+            (f'route="{name}"', metrics._copy()) for name, metrics in (routes or {}).items()]
+
+        lines = []
+        for name, help_text in self.COUNTERS.items():
+            metric = f"forwarder_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for route_label, (counters, _, _) in sources:
+                values = [(code, value) for (key, code), value in counters.items() if key == name]
+                if not values and not route_label:
+                    lines.append(f"{metric} 0")
+                for code, value in sorted(values, key=lambda item: str(item[0])):
+                    labels = ",".join(filter(None, (route_label, "" if code is None else f'code="{code}"')))
+                    lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+
+        metric = "forwarder_stage_seconds"
+        lines.append(f"# HELP {metric} 各处理阶段耗时: " + "，".join(
+            f"{stage}={help_text}" for stage, help_text in self.STAGES.items()))
+        lines.append(f"# TYPE {metric} histogram")
+        for route_label, (_, histograms, sums) in sources:
+            prefix = route_label + "," if route_label else ""
+            for stage, buckets in histograms.items():
+                cumulative = 0
+                if route_label and not sum(buckets):
+                    continue
+                for bound, count in zip(self.BUCKETS, buckets):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{prefix}stage="{stage}",le="{bound}"}} {cumulative}')
+                cumulative += buckets[-1]
+                lines.append(f'{metric}_bucket{{{prefix}stage="{stage}",le="+Inf"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{prefix}stage="{stage}"}} {sums[stage]:.6f}')
+                lines.append(f'{metric}_count{{{prefix}stage="{stage}"}} {cumulative}')
+
+        for name, (help_text, value) in (gauges or {}).items():
+            metric = f"forwarder_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            if isinstance(value, dict):
+                for key, item_value in value.items():
+                    labels = (",".join(f'{label}="{label_value}"' for label, label_value in key)
+                              if isinstance(key, tuple) else f'target="{key}"')
+                    lines.append(f'{metric}{{{labels}}} {item_value}')
+            else:
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+class PooledSession:
+    """带keep-alive连接池的HTTP会话，可在多个处理线程间共享
+
+    所有请求复用同一个requests.Session的连接池，稳态转发时不再每条消息重新建连；
+    连接池空闲超过 idle_timeout 秒后下次使用时整体重建，避免复用已被对端关闭的旧连接。
+    所有发出HTTP请求的组件都经由连接池，创建连接池时导入requests。
+    """
+    def __init__(self, pool_size=16, idle_timeout=60, hosts=1):
+        import_network()
+        self.pool_size = max(1, int(pool_size))
+        self.hosts = max(1, int(hosts))
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._session = None
+        self._last_used = 0.0
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.hosts, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def post(self, url, **kwargs):
+        stale = None
+        with self._lock:
+            now = time.monotonic()
+            if self._session is not None and self.idle_timeout and now - self._last_used > self.idle_timeout:
+                stale, self._session = self._session, None
+            if self._session is None:
+                self._session = self._new_session()
+            self._last_used = now
+            session = self._session
+        if stale is not None:
+            stale.close()
+        return session.post(url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+class CallbackDispatcher:
+    """后台投递队列
+
+    转发请求只负责把回调放入队列并立即返回响应，由独立的工作线程发送回调，
+    失败时按指数退避重试。队列有长度上限，满时按 overflow 策略丢弃最旧或最新的回调。
+    emit 为可选的事件回调，签名与 ForwarderEngine.emit 相同，metrics 用于记录每次请求的耗时。
+    kind 为 event 时用于向OlivOS投递上报事件，发出的事件与耗时指标以 kind 为前缀，label 用于日志。
+    """
+    def __init__(self, session, workers=2, max_size=1000, max_retries=3,
+                 retry_backoff=0.5, overflow="drop_oldest", emit=None, metrics=None,
+                 kind="callback", label="回调"):
+        self.session = session
+        self.workers = max(1, int(workers))
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = retry_backoff
+        self.overflow = overflow
+        self.emit = emit or (lambda event, **fields: None)
+        self.metrics = metrics
+        self.kind = kind
+        self.label = label
+        self.queue = queue.Queue(maxsize=max(1, int(max_size)))
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop_event.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"{self.kind}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        pending = self.queue.qsize()
+        if pending:
+            print_log(f"{self.label}队列关闭", {"dropped": pending}, logging.WARNING)
+
+    def join(self, timeout):
+        """等待队列中（包括正在发送）的数据全部处理完，超时返回False"""
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def submit(self, url, path, data, headers=None, block=0):
+        """放入一条待发送数据，返回是否入队成功
+
+        data 为 bytes 时原样作为请求体发送，否则在投递线程中按JSON序列化；headers 为额外的请求头。
+        block 大于0时队列满会先等待至多 block 秒（对上游形成背压），仍然满再按 overflow 策略处理。
+        """
+        item = (url, path, data, headers)
+        if block:
+            try:
+                self.queue.put(item, timeout=block)
+                return True
+            except queue.Full:
+                pass
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                if self.overflow != "drop_oldest":
+                    print_log(f"{self.label}队列已满，丢弃{self.label}", {"path": path, "data": data}, logging.WARNING)
+                    self.emit(f"{self.kind}_dropped", path=path)
+                    return False
+            try:
+                dropped = self.queue.get_nowait()
+                self.queue.task_done()
+                print_log(f"{self.label}队列已满，丢弃最旧{self.label}", {"path": dropped[1], "data": dropped[2]}, logging.WARNING)
+                self.emit(f"{self.kind}_dropped", path=dropped[1])
+            except queue.Empty:
+                pass
+
+    def _worker(self):
+        while not self._stop_event.is_set():
+            try:
+                url, path, data, headers = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._deliver(url, path, data, headers)
+            finally:
+                self.queue.task_done()
+
+    def _deliver(self, url, path, data, headers=None):
+        started = time.perf_counter()
+        request_headers = {'Content-Type': 'application/json'}
+        if headers:
+            request_headers.update(headers)
+        payload = data if isinstance(data, bytes) else json_dumps(data)
+        for attempt in range(self.max_retries + 1):
+            attempt_started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    url=url,
+                    data=payload,
+                    headers=request_headers,
+                    timeout=5
+                )
+                if self.metrics is not None:
+                    self.metrics.observe(self.kind, time.perf_counter() - attempt_started)
+                if response.status_code < 500:
+                    print_log(f"{self.label}发送", {
+                        "path": path,
+                        "data": data
+                    })
+                    self.emit(f"{self.kind}_sent", path=path, attempts=attempt + 1,
+                              elapsed=time.perf_counter() - started)
+                    return
+                error = f"HTTP {response.status_code}"
+            except Exception as e:
+                error = str(e)
+
+            if attempt < self.max_retries:
+                # 指数退避后重试，服务停止时立即放弃等待
+                if self._stop_event.wait(self.retry_backoff * (2 ** attempt)):
+                    break
+
+        print_log(f"{self.label}发送失败", {
+            "error": error,
+            "path": path,
+            "attempts": attempt + 1
+        }, logging.WARNING)
+        self.emit(f"{self.kind}_failed", path=path, error=error, attempts=attempt + 1,
+                  elapsed=time.perf_counter() - started)
+
+class _Batch:
+    """等待合并发送的一组消息"""
+    def __init__(self, path, data):
+        self.path = path
+        self.first = data
+        self.messages = [data["message"]]
+        self.chars = len(data["message"])
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MessageCoalescer:
+    """把同一会话在短时间内连续发送的文本消息合并为一次转发
+
+    按请求路径、message_type、group_id/user_id 与 auto_escape 分组。每组第一条消息的处理线程
+    等待 window 秒（或组内消息达到条数/字符数上限）后，用换行拼接组内消息发送一次，
+    同组的其他处理线程阻塞等待并共享这次的响应。send 签名与 ForwarderEngine.post_upstream 相同。
+    """
+    def __init__(self, send, window=0.05, max_messages=10, max_chars=2000, emit=None):
+        self.send = send
+        self.window = window
+        self.max_messages = max(1, int(max_messages))
+        self.max_chars = max(1, int(max_chars))
+        self.emit = emit or (lambda event, **fields: None)
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    @staticmethod
+    def eligible(data):
+        """只合并私聊与群聊的纯文本消息"""
+        return isinstance(data.get("message"), str) and data.get("message_type") in ("group", "private")
+
+    def submit(self, path, data):
+        """转发一条消息，返回 (状态码, 响应数据)，转发失败时抛出与 send 相同的异常"""
+        target = data.get("group_id") if data["message_type"] == "group" else data.get("user_id")
+        key = (path, data["message_type"], target, data.get("auto_escape"))
+        message = data["message"]
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is not None and batch.chars + 1 + len(message) > self.max_chars:
+                # 加入后会超出字符上限，先让当前组立即发送，本条另起一组
+                del self._batches[key]
+                batch.full.set()
+                batch = None
+            if batch is None:
+                batch = self._batches[key] = _Batch(path, data)
+                leader = True
+            else:
+                batch.messages.append(message)
+                batch.chars += 1 + len(message)
+                leader = False
+            if len(batch.messages) >= self.max_messages and self._batches.get(key) is batch:
+                del self._batches[key]
+                batch.full.set()
+
+        if leader:
+            self._flush(key, batch)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.result
+
+    def _flush(self, key, batch):
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+        count = len(batch.messages)
+        data = batch.first
+        if count > 1:
+            data = dict(data, message="\n".join(batch.messages))
+            print_log("合并消息", {"path": batch.path, "count": count, "data": data})
+            self.emit("coalesced", path=batch.path, messages=count)
+        try:
+            batch.result = self.send(batch.path, data)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，burst 为桶容量"""
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """距离有一个可用令牌还需等待的秒数，需先调用 refill()"""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class RateLimitExceeded(Exception):
+    pass
+
+class OutboundScheduler:
+    """发往Lagrange的令牌桶限速
+
+    总速率、每个群、每个私聊对象分别限速，rate 为0的一级不限速。
+    data 为会话字段（见 _session_fields），没有 message_type 或目标id的请求（群管理等动作）只受总速率限制。
+    超出速率的请求在调用线程中排队等待，最多等待 max_wait 秒，超时抛出 RateLimitExceeded。
+    private_first=True 时，等待总速率令牌的私聊消息优先取得令牌，群消息要等它们取完才能发送。
+    """
+    # 分群/分人的令牌桶超过该数量时清理已经补满的桶
+    MAX_BUCKETS = 10000
+
+    def __init__(self, global_rate=0.0, global_burst=10, group_rate=0.0, group_burst=5,
+                 user_rate=0.0, user_burst=5, max_wait=10.0, private_first=True):
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(global_rate, global_burst, now) if global_rate > 0 else None
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.max_wait = max_wait
+        self.private_first = private_first
+        self._cond = threading.Condition()
+        self._buckets = {}
+        # 正在等待总速率令牌的私聊消息数
+        self._private_waiting = 0
+
+    @property
+    def enabled(self):
+        return self.global_bucket is not None or self.group_rate > 0 or self.user_rate > 0
+
+    def _bucket_for(self, data, now):
+        message_type = data.get("message_type")
+        if message_type == "group":
+            rate, burst, key = self.group_rate, self.group_burst, ("group", data.get("group_id"))
+        elif message_type:
+            rate, burst, key = self.user_rate, self.user_burst, ("user", data.get("user_id"))
+        else:
+            return None
+        if rate <= 0 or key[1] is None:
+            return None
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _prune(self, now):
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+    def acquire(self, data):
+        """为一条消息取得发送令牌，返回排队等待的秒数"""
+        private = self.private_first and data.get("message_type") not in (None, "group")
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        waiting_global = False
+        with self._cond:
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket = self._bucket_for(data, now)
+                    wait = 0.0
+                    if bucket is not None:
+                        bucket.refill(now)
+                        wait = bucket.wait_time()
+                    global_wait = 0.0
+                    if self.global_bucket is not None:
+                        self.global_bucket.refill(now)
+                        global_wait = self.global_bucket.wait_time()
+                        if not private and self._private_waiting and global_wait == 0:
+                            # 把现有令牌留给排队的私聊消息
+                            global_wait = 1 / self.global_bucket.rate
+                    if private and global_wait > 0 and not waiting_global:
+                        self._private_waiting += 1
+                        waiting_global = True
+                    elif waiting_global and global_wait == 0:
+                        self._private_waiting -= 1
+                        waiting_global = False
+
+                    wait = max(wait, global_wait)
+                    if wait == 0:
+                        if bucket is not None:
+                            bucket.tokens -= 1
+                        if self.global_bucket is not None:
+                            self.global_bucket.tokens -= 1
+                        return now - started
+                    if now + wait > deadline:
+                        raise RateLimitExceeded(f"等待发送超过 {self.max_wait} 秒")
+                    self._cond.wait(wait)
+            finally:
+                if waiting_global:
+                    self._private_waiting -= 1
+                self._cond.notify_all()
+
+def _connect_failed(error):
+    """ConnectionError是否发生在建立连接阶段（请求确定没有发出）"""
+    if isinstance(error, (requests.exceptions.ConnectTimeout, websocket_transport.WebSocketConnectError)):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """转发目标的熔断器
+
+    连续失败 failure_threshold 次后进入熔断（open），期间的请求立即失败；
+    熔断 reset_timeout 秒后进入半开（half_open），只放行一个探测请求，
+    探测成功则恢复（closed），失败则重新熔断。状态变化时发出 circuit_changed 事件。
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0, emit=None, name=""):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.emit = emit or (lambda event, **fields: None)
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            level = logging.INFO if state == self.CLOSED else logging.WARNING
+            print_log("转发目标熔断状态变化", {"target": self.name, "state": state, "failures": self.failures}, level)
+            self.emit("circuit_changed", target=self.name, state=state)
+
+    def ready(self):
+        """不占用探测机会，粗略判断当前是否可能放行请求"""
+        return self.state != self.OPEN or time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def allow(self):
+        """返回本次请求是否可以发送，熔断中直接返回False"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def cancel(self):
+        """allow() 放行的请求最终没有发出时调用，半开状态下让出探测机会"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+class Upstream:
+    """一个Lagrange转发目标：地址、路径改写、熔断器、健康状态与进行中的请求数"""
+    def __init__(self, config, host, port, token, emit=None, on_event=None):
+        self.name = f"{host}:{port}"
+        self.rewriter = PathRewriter(config, (host, port, token))
+        self.breaker = None
+        if config.breaker_failure_threshold > 0:
+            self.breaker = CircuitBreaker(config.breaker_failure_threshold, config.breaker_reset_timeout,
+                                          emit=emit, name=self.name)
+        self.healthy = True
+        self.inflight = 0
+        self.ws_client = None
+        if config.target_transport == "ws":
+            self.ws_client = websocket_transport.OneBotWebSocketClient(
+                host, port, token, path=config.target_ws_path, connect_timeout=config.upstream_connect_timeout,
+                on_event=on_event
+            )
+
+    def close(self):
+        if self.ws_client is not None:
+            self.ws_client.close()
+
+    def available(self):
+        return self.healthy and (self.breaker is None or self.breaker.ready())
+
+class UpstreamPool:
+    """多个Lagrange目标的选择与健康检查
+
+    choose() 按策略挑选目标：round_robin 轮询，least_inflight 选进行中请求最少的，
+    sticky_group 按 group_id（私聊按 user_id）做一致性哈希，目标增减时大部分会话仍落在原目标。
+    健康检查未通过的目标暂时移出轮换，全部不健康时仍会尝试所有目标，熔断中的目标则会跳过。
+    目标多于一个且 check_interval > 0 时，后台线程定期调用各目标的 get_status 检查健康状态。
+    """
+    STRATEGIES = CONFIG_CHOICES["target_strategy"]
+
+    def __init__(self, upstreams, session, strategy="round_robin", check_interval=10.0,
+                 check_timeout=3.0, emit=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"未知的多目标选择策略: {strategy}")
+        self.upstreams = upstreams
+        self.session = session
+        self.strategy = strategy
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.emit = emit or (lambda event, **fields: None)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def primary(self):
+        return self.upstreams[0]
+
+    def any_available(self):
+        return any(upstream.available() for upstream in self.upstreams)
+
+    def choose(self, data, exclude=()):
+        """挑选一个目标并占用其熔断器的放行机会，没有可用目标时返回None"""
+        candidates = [u for u in self.upstreams if u not in exclude]
+        candidates = [u for u in candidates if u.healthy] or candidates
+        for upstream in self._order(candidates, data):
+            if upstream.breaker is None or upstream.breaker.allow():
+                return upstream
+        return None
+
+    def _order(self, candidates, data):
+        if len(candidates) <= 1:
+            return candidates
+        if self.strategy == "least_inflight":
+            return sorted(candidates, key=lambda u: u.inflight)
+        if self.strategy == "sticky_group":
+            if data.get("message_type") == "group":
+                key = f"group:{data.get('group_id')}"
+            else:
+                key = f"user:{data.get('user_id')}"
+            return sorted(candidates, key=lambda u: zlib.crc32(f"{key}|{u.name}".encode('utf-8')), reverse=True)
+        with self._lock:
+            start = self._next % len(candidates)
+            self._next += 1
+        return candidates[start:] + candidates[:start]
+
+    def acquire(self, upstream):
+        with self._lock:
+            upstream.inflight += 1
+
+    def release(self, upstream):
+        with self._lock:
+            upstream.inflight -= 1
+
+    def start(self):
+        if len(self.upstreams) > 1 and self.check_interval > 0:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._health_loop, name="health-check", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(self.check_timeout + 1)
+            self._thread = None
+        for upstream in self.upstreams:
+            upstream.close()
+
+    def _health_loop(self):
+        while not self._stop_event.wait(self.check_interval):
+            for upstream in self.upstreams:
+                self._check(upstream)
+
+    def _check(self, upstream):
+        try:
+            if upstream.ws_client is not None:
+                response = upstream.ws_client.call("get_status", {}, timeout=self.check_timeout)
+                healthy = response.get("status") == "ok"
+            else:
+                healthy = self._check_http(upstream)
+        except Exception:
+            healthy = False
+        if healthy != upstream.healthy:
+            upstream.healthy = healthy
+            print_log("转发目标健康状态变化", {"target": upstream.name, "healthy": healthy},
+                      logging.INFO if healthy else logging.WARNING)
+            self.emit("target_health", target=upstream.name, healthy=healthy)
+
+    def _check_http(self, upstream):
+        response = self.session.post(
+            url=upstream.rewriter.target_prefix + upstream.rewriter.rewrite("/get_status")[1],
+            json={},
+            headers={'Content-Type': 'application/json'},
+            timeout=self.check_timeout
+        )
+        return response.status_code < 500
+
+# 只读查询动作的默认缓存秒数
+CACHE_TTLS = {
+    "get_login_info": 300,
+    "get_version_info": 3600,
+    "get_stranger_info": 300,
+    "get_friend_list": 60,
+    "get_group_list": 60,
+    "get_group_info": 60,
+    "get_group_member_list": 30,
+    "get_group_member_info": 30,
+}
+
+# 修改类动作成功后需要失效的查询动作（有 group_id 时只失效该群的缓存）
+CACHE_INVALIDATIONS = {
+    "set_group_card": ("get_group_member_info", "get_group_member_list"),
+    "set_group_special_title": ("get_group_member_info", "get_group_member_list"),
+    "set_group_admin": ("get_group_member_info", "get_group_member_list"),
+    "set_group_ban": ("get_group_member_info", "get_group_member_list"),
+    "set_group_kick": ("get_group_member_info", "get_group_member_list", "get_group_info"),
+    "set_group_name": ("get_group_info", "get_group_list"),
+    "set_group_leave": ("get_group_info", "get_group_list", "get_group_member_info", "get_group_member_list"),
+    "set_group_add_request": ("get_group_member_list", "get_group_info"),
+    "set_friend_add_request": ("get_friend_list",),
+    "delete_friend": ("get_friend_list", "get_stranger_info"),
+}
+
+# 上报的 notice 事件对应需要失效的查询动作
+CACHE_EVENT_INVALIDATIONS = {
+    "group_increase": ("get_group_member_list", "get_group_member_info", "get_group_info", "get_group_list"),
+    "group_decrease": ("get_group_member_list", "get_group_member_info", "get_group_info", "get_group_list"),
+    "group_admin": ("get_group_member_info", "get_group_member_list"),
+    "group_card": ("get_group_member_info", "get_group_member_list"),
+    "group_ban": ("get_group_member_info", "get_group_member_list"),
+    "friend_add": ("get_friend_list",),
+}
+
+def _normalize_param(name, value):
+    # OlivOS插件传入的ID可能是数字字符串，与整数视为同一参数
+    if name.endswith("_id") and isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+class ResponseCache:
+    """只读查询动作的响应缓存（TTL + LRU）
+
+    以动作名与规范化后的参数（去掉 echo，键排序，数字字符串ID转为整数）为键，只缓存 status 为 ok 的响应。
+    同一个键同时未命中时只有一个请求发往Lagrange，其余请求等待并共用它的结果。
+    条数与响应体总大小超出上限时淘汰最久未使用的条目；修改类动作成功或收到相关 notice 事件时
+    按 CACHE_INVALIDATIONS / CACHE_EVENT_INVALIDATIONS 失效对应缓存，也可以直接调用 invalidate()。
+    参数中带 no_cache 为真的请求不经过缓存。
+    """
+    def __init__(self, ttls=None, max_entries=5000, max_bytes=32 * 1024 * 1024, emit=None):
+        table = dict(CACHE_TTLS)
+        table.update(ttls or {})
+        self.ttls = {action.strip('/'): float(ttl) for action, ttl in table.items() if ttl and float(ttl) > 0}
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.emit = emit or (lambda event, **fields: None)
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        # 每次失效时递增，加载期间发生过失效的结果不写入缓存
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, path, body):
+        """请求对应的缓存键，不可缓存时返回None"""
+        action = ActionTransforms.action(path)
+        if action not in self.ttls:
+            return None
+        if isinstance(body, bytes):
+            try:
+                body = json_loads(body) if body.strip() else {}
+            except ValueError:
+                return None
+        if not isinstance(body, dict) or body.get("no_cache"):
+            return None
+        params = {name: _normalize_param(name, value) for name, value in body.items() if name != "echo"}
+        try:
+            canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return None
+        return action, params.get("group_id"), canonical
+
+    def get_or_load(self, key, loader):
+        """返回 (状态码, 响应数据)，未命中时调用 loader() 取得并缓存，loader 的异常原样抛出"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                result = entry[1]
+            else:
+                result = None
+                if entry is not None:
+                    self._remove(key)
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = [threading.Event(), None]
+                generation = self._generation
+        if result is not None:
+            self.emit("cache_hit", path=key[0])
+            return result
+
+        if not leader:
+            flight[0].wait()
+            if isinstance(flight[1], Exception):
+                raise flight[1]
+            self.emit("cache_hit", path=key[0])
+            return flight[1]
+
+        self.emit("cache_miss", path=key[0])
+        try:
+            result = loader()
+        except Exception as e:
+            flight[1] = e
+            raise
+        else:
+            flight[1] = result
+            status_code, response_data = result
+            if status_code < 500 and response_data.get("status") == "ok":
+                self._store(key, result, generation)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight[0].set()
+
+    def _store(self, key, result, generation):
+        response_data = result[1]
+        size = len(response_data.raw) if isinstance(response_data, RelayedResponse) else len(json_dumps(response_data))
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttls[key[0]], result, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry[2]
+
+    def invalidate(self, actions=None, group_id=None):
+        """失效缓存：actions 为空时失效全部；给出 group_id 时只失效该群的条目（以及不带 group_id 的条目）"""
+        actions = set(actions) if actions else None
+        group_id = _normalize_param("group_id", group_id)
+        with self._lock:
+            self._generation += 1
+            for key in list(self._entries):
+                if actions is not None and key[0] not in actions:
+                    continue
+                if group_id is not None and key[1] is not None and key[1] != group_id:
+                    continue
+                self._remove(key)
+
+    def after_action(self, path, body):
+        """修改类动作成功后调用，按 CACHE_INVALIDATIONS 失效相关缓存"""
+        actions = CACHE_INVALIDATIONS.get(ActionTransforms.action(path))
+        if actions:
+            self.invalidate(actions, self._group_of(body))
+
+    def after_event(self, event):
+        """收到上报事件时调用，event 为解析后的dict或原始上报的bytes"""
+        if isinstance(event, bytes):
+            # 绝大多数上报是消息，不含 notice 时不必解析
+            if b'notice' not in event:
+                return
+            try:
+                event = json_loads(event)
+            except ValueError:
+                return
+        if not isinstance(event, dict) or event.get("post_type") != "notice":
+            return
+        actions = CACHE_EVENT_INVALIDATIONS.get(event.get("notice_type"))
+        if actions:
+            self.invalidate(actions, event.get("group_id"))
+
+    @staticmethod
+    def _group_of(body):
+        if isinstance(body, bytes):
+            try:
+                body = json_loads(body)
+            except ValueError:
+                return None
+        return body.get("group_id") if isinstance(body, dict) else None
+
+class DuplicateFilter:
+    """重复发送请求的识别
+
+    带 echo 的请求以（动作, echo）为指纹，否则以（动作, 消息类型, 目标, 消息内容）的哈希为指纹。
+    指纹按到达顺序记录在有长度上限的有序表中，超过 window 秒或超出 max_entries 时从最早的开始忘记。
+    窗口内的重复请求不再发送，直接返回第一次的响应；第一次还在发送中时等待它的结果。
+    第一次没有发送成功（5xx、status 不是 ok/async 或发送出错）时不记录，之后的重试照常发送；
+    发送出错时，等待它的重复请求抛出同一个异常。
+    """
+    def __init__(self, actions, window=10.0, max_entries=10000, by_content=True, emit=None):
+        self.actions = frozenset(a.strip().strip('/') for a in actions.split(',') if a.strip())
+        self.window = max(0.0, float(window))
+        self.max_entries = max(1, int(max_entries))
+        self.by_content = by_content
+        self.emit = emit or (lambda event, **fields: None)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def fingerprint(self, path, body):
+        """请求的指纹，不参与去重时返回None"""
+        action = ActionTransforms.action(path)
+        if action not in self.actions:
+            return None
+        if isinstance(body, bytes):
+            try:
+                body = json_loads(body)
+            except ValueError:
+                return None
+        if not isinstance(body, dict):
+            return None
+        echo = body.get("echo")
+        if echo is not None:
+            material = ["echo", action, echo]
+        elif self.by_content:
+            message_type = body.get("message_type")
+            if message_type == "group" or (message_type is None and "group_id" in body):
+                target = body.get("group_id")
+            else:
+                target = body.get("user_id")
+            material = ["content", action, message_type, _normalize_param("target_id", target), body.get("message")]
+        else:
+            return None
+        encoded = json.dumps(material, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+        return hashlib.blake2b(encoded, digest_size=16).digest()
+
+    def run(self, fingerprint, path, sender):
+        """第一次出现的指纹调用 sender() 发送，窗口内的重复直接返回第一次的 (状态码, 响应数据)"""
+        now = time.monotonic()
+        with self._lock:
+            # 有序表按到达时间排列，过期的都在最前面
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[0] > now and len(self._entries) < self.max_entries:
+                    break
+                self._entries.popitem(last=False)
+            entry = self._entries.get(fingerprint)
+            first = entry is None
+            if first:
+                entry = self._entries[fingerprint] = [now + self.window, threading.Event(), None]
+
+        if not first:
+            entry[1].wait()
+            if isinstance(entry[2], Exception):
+                # 第一次发送出错，等待中的重复请求得到同一个错误
+                raise entry[2]
+            self.emit("duplicate_suppressed", path=path)
+            return entry[2]
+
+        result = None
+        try:
+            result = sender()
+            return result
+        except Exception as e:
+            result = e
+            raise
+        finally:
+            entry[2] = result
+            if not isinstance(result, tuple) or result[0] >= 500 or result[1].get("status") not in ("ok", "async"):
+                # 没有发送成功（包括发送出错），允许之后的重试
+                with self._lock:
+                    if self._entries.get(fingerprint) is entry:
+                        del self._entries[fingerprint]
+            entry[1].set()
+
+# 动作名本身表明消息类型的发送动作，请求体中通常不带 message_type
+SESSION_ACTIONS = {"send_group_msg": "group", "send_private_msg": "private"}
+
+def _session_fields(path, data):
+    """限速与按会话选择目标用到的字段 {message_type, group_id, user_id}
+
+    原始请求体在这里解析一次；send_group_msg 等动作按动作名补上 message_type。
+    """
+    if isinstance(data, bytes):
+        try:
+            data = json_loads(data)
+        except ValueError:
+            return {}
+    if not isinstance(data, dict):
+        return {}
+    message_type = data.get("message_type") or SESSION_ACTIONS.get(path.partition('?')[0].strip('/'))
+    return {"message_type": message_type, "group_id": data.get("group_id"), "user_id": data.get("user_id")}
+
+def _session_key(data):
+    """消息所属的会话（群或私聊对象），原始请求体需要解析一次"""
+    if isinstance(data, bytes):
+        try:
+            data = json_loads(data)
+        except ValueError:
+            return ""
+    if not isinstance(data, dict):
+        return ""
+    if data.get("message_type") == "group" or (data.get("message_type") is None and "group_id" in data):
+        return f"group:{data.get('group_id')}"
+    return f"user:{data.get('user_id')}"
+
+class Outbox:
+    """落盘的待发送队列（store-and-forward）
+
+    被接受的消息先追加到SQLite（WAL模式）中，提交后才回复调用方；同时到达的写入合并为一次提交与fsync。
+    后台线程按会话分片，每个分片按写入顺序逐条发送：Lagrange不可用（连接失败、熔断、5xx、排队超时）时
+    停在当前消息上退避重试，同一群或私聊对象的消息不会乱序。发出的消息在之后的提交中删除，
+    进程崩溃或重启后从未删除的消息继续发送（至少一次）。发送结果不确定的失败（如读取超时）不重试。
+    超过 outbox_max_age 秒仍未发出的消息被丢弃，文件超过 outbox_max_bytes 时拒绝新消息。
+    消息记下所属路由的名称，重启后仍经同一路由发送；路由已从配置中删除时丢弃。
+    """
+    # 空闲时的维护间隔（秒）：把WAL写回主文件并回收已删除消息占用的空间
+    MAINTENANCE_INTERVAL = 5.0
+    # 每次从文件中读取的消息条数
+    BATCH = 64
+
+    def __init__(self, config, engine):
+        self.path = config.outbox_path
+        self.actions = frozenset(a.strip().strip('/') for a in config.outbox_actions.split(',') if a.strip())
+        self.workers = max(1, config.outbox_workers)
+        self.flush_interval = max(0, config.outbox_flush_interval_ms) / 1000.0
+        self.max_bytes = config.outbox_max_bytes
+        self.max_age = config.outbox_max_age
+        self.retry_backoff = max(0.05, config.upstream_retry_backoff)
+        self.retry_max = max(1.0, config.breaker_reset_timeout)
+        self.engine = engine
+        self.pending = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        # 待提交的写入与已发出待删除的id
+        self._cond = threading.Condition()
+        self._writes = []
+        self._acked = []
+        # 每次提交后递增，发送线程据此判断是否有新消息
+        self._wake = threading.Condition()
+        self._version = 0
+        self._full = False
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def accepts(self, path):
+        return ActionTransforms.action(path) in self.actions
+
+    def open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = FULL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, path TEXT NOT NULL, "
+                "body BLOB NOT NULL, raw INTEGER NOT NULL, echo TEXT, callback INTEGER NOT NULL, created REAL NOT NULL, "
+                "route TEXT NOT NULL DEFAULT '')"
+            )
+            # 旧版本创建的文件没有 route 列，其中的消息都属于默认路由
+            columns = {row[1] for row in db.execute("PRAGMA table_info(outbox)")}
+            if "route" not in columns:
+                db.execute("ALTER TABLE outbox ADD COLUMN route TEXT NOT NULL DEFAULT ''")
+            db.commit()
+            self.pending = db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        except sqlite3.Error:
+            db.close()
+            raise
+        self._db = db
+        self._update_size()
+        if self.pending:
+            logger.info(f"待发送队列中有 {self.pending} 条未发出的消息，将继续发送")
+
+    def start(self):
+        self._stop_event.clear()
+        threads = [threading.Thread(target=self._flusher, name="outbox-flush", daemon=True)]
+        threads += [
+            threading.Thread(target=self._worker, args=(shard,), name=f"outbox-{shard}", daemon=True)
+            for shard in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        self._threads = threads
+
+    def stop(self):
+        """停止发送，等进行中的发送完成后关闭文件
+
+        每次发送都有超时上限（限速排队与连接、读取超时），这里不另设超时：
+        发送线程仍在发送时关闭文件会丢掉它的删除确认，之后重新打开同一文件时该消息会被再次发送。
+        """
+        with self._cond:
+            self._stop_event.set()
+            self._cond.notify_all()
+        with self._wake:
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        # 写线程最后一次提交之后才发出的消息的删除确认
+        with self._cond:
+            writes, self._writes = self._writes, []
+            acked, self._acked = self._acked, []
+        if (writes or acked) and self._db is not None:
+            self._commit(writes, acked)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self.pending:
+            print_log("待发送队列关闭", {"pending": self.pending}, logging.INFO)
+
+    def append(self, path, data, echo, callback, route=""):
+        """写入一条消息，提交到磁盘后返回True；队列已满、已停止或写入失败时返回False"""
+        raw = isinstance(data, bytes)
+        shard = zlib.crc32(_session_key(data).encode('utf-8'))
+        row = (shard, path, data if raw else json_dumps(data), int(raw),
+               json_dumps(echo).decode('utf-8'), int(callback), time.time(), route)
+        item = [row, False, threading.Event()]
+        with self._cond:
+            if self._full or self._stop_event.is_set():
+                return False
+            self._writes.append(item)
+            self._cond.notify()
+        item[2].wait()
+        return item[1]
+
+    def _flusher(self):
+        last_maintenance = time.monotonic()
+        while True:
+            with self._cond:
+                if not self._writes and not self._acked and not self._stop_event.is_set():
+                    self._cond.wait(self.MAINTENANCE_INTERVAL)
+                stopping = self._stop_event.is_set()
+            if self.flush_interval and not stopping:
+                self._stop_event.wait(self.flush_interval)
+            with self._cond:
+                writes, self._writes = self._writes, []
+                acked, self._acked = self._acked, []
+            if writes or acked:
+                self._commit(writes, acked)
+            if stopping:
+                return
+            if time.monotonic() - last_maintenance >= self.MAINTENANCE_INTERVAL:
+                last_maintenance = time.monotonic()
+                self._maintain()
+
+    def _commit(self, writes, acked):
+        ok = False
+        try:
+            with self._db_lock, self._db:
+                if writes:
+                    self._db.executemany(
+                        "INSERT INTO outbox (shard, path, body, raw, echo, callback, created, route) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [item[0] for item in writes]
+                    )
+                if acked:
+                    self._db.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in acked])
+            ok = True
+        except sqlite3.Error as e:
+            print_log("待发送队列写入失败", {"error": str(e), "writes": len(writes)}, logging.ERROR)
+            if acked:
+                # 删除失败的id下次提交时再删，发送线程不会重复读取它们
+                with self._cond:
+                    self._acked.extend(acked)
+        for item in writes:
+            item[1] = ok
+            item[2].set()
+        if ok:
+            self.pending += len(writes) - len(acked)
+            self._update_size()
+            if writes:
+                with self._wake:
+                    self._version += 1
+                    self._wake.notify_all()
+
+    def _maintain(self):
+        try:
+            with self._db_lock:
+                self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._db.execute("PRAGMA incremental_vacuum")
+        except sqlite3.Error as e:
+            print_log("待发送队列整理失败", {"error": str(e)}, logging.WARNING)
+        self._update_size()
+
+    def _update_size(self):
+        if not self.max_bytes:
+            return
+        size = 0
+        for path in (self.path, self.path + "-wal"):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        full = size >= self.max_bytes
+        if full and not self._full:
+            print_log("待发送队列已满，暂停接受新消息", {"size": size, "pending": self.pending}, logging.WARNING)
+        self._full = full
+
+    def _ack(self, row_id):
+        with self._cond:
+            self._acked.append(row_id)
+            self._cond.notify()
+
+    def _worker(self, shard):
+        cursor = 0
+        while not self._stop_event.is_set():
+            with self._wake:
+                version = self._version
+            try:
+                with self._db_lock:
+                    rows = self._db.execute(
+                        "SELECT id, path, body, raw, echo, callback, created, route FROM outbox "
+                        "WHERE id > ? AND shard % ? = ? ORDER BY id LIMIT ?",
+                        (cursor, self.workers, shard, self.BATCH)
+                    ).fetchall()
+            except sqlite3.Error as e:
+                print_log("待发送队列读取失败", {"error": str(e)}, logging.ERROR)
+                self._stop_event.wait(1)
+                continue
+            if not rows:
+                with self._wake:
+                    if self._version == version:
+                        self._wake.wait(self.MAINTENANCE_INTERVAL)
+                continue
+            for row in rows:
+                if not self._deliver(*row):
+                    return
+                cursor = row[0]
+
+    def _deliver(self, row_id, path, body, raw, echo, callback, created, route_name):
+        """发送一条消息直到成功、确定失败或过期，停止时返回False（消息留在文件中）"""
+        engine = self.engine
+        data = body if raw else json_loads(body)
+        route = engine.route_named(route_name)
+        if route is None:
+            return self._give_up(row_id, path, data, f"路由 {route_name} 已不存在")
+        attempt = 0
+        while not self._stop_event.is_set():
+            age = time.time() - created
+            if self.max_age and age > self.max_age:
+                print_log("待发送消息已过期，丢弃", {"path": path, "data": data, "age": age}, logging.WARNING)
+                engine.emit("outbox_expired", path=path, age=age)
+                self._ack(row_id)
+                return True
+            try:
+                status_code, response_data = engine.post_upstream(path, data, route)
+                if status_code >= 500:
+                    error = f"Lagrange返回 {status_code}"
+                else:
+                    self._ack(row_id)
+                    print_log("待发送消息已发出", {"path": path, "status": status_code, "data": response_data})
+                    engine.emit("outbox_sent", path=path, attempts=attempt + 1, delay=age)
+                    if callback:
+                        engine.send_callback(path, response_data, json_loads(echo), route)
+                    return True
+            except (CircuitOpenError, RateLimitExceeded) as e:
+                error = str(e)
+            except (requests.exceptions.ConnectionError, websocket_transport.WebSocketConnectError) as e:
+                if not _connect_failed(e):
+                    return self._give_up(row_id, path, data, e)
+                error = str(e)
+            except Exception as e:
+                return self._give_up(row_id, path, data, e)
+            attempt += 1
+            engine.emit("outbox_retry", path=path, attempt=attempt, error=error)
+            self._stop_event.wait(min(self.retry_max, self.retry_backoff * (2 ** min(attempt - 1, 16))))
+        return False
+
+    def _give_up(self, row_id, path, data, error):
+        # 结果不确定（可能已送达），不再重试以免重复发送
+        print_log("待发送消息发送失败", {"path": path, "data": data, "error": str(error)}, logging.ERROR)
+        self.engine.emit("outbox_failed", path=path, error=str(error))
+        self._ack(row_id)
+        return True
+
+class EventRelay:
+    """Lagrange → OlivOS 的上报事件转发
+
+    在 event_host:event_port 上单独监听Lagrange的HTTP上报，校验 event_token / event_secret 后
+    把原始请求体放入有界队列并立即返回204，由后台线程按与API方向相同的令牌改写规则发给OlivOS，
+    不解析、不重新序列化。队列满时上报请求最多等待 event_backpressure_timeout 秒，仍然满则返回503，
+    上报事件量再大也不会占用API方向的处理线程与连接池。
+    """
+    def __init__(self, config, session, emit=None, metrics=None):
+        self.config = config
+        self.rewriter = PathRewriter(
+            config,
+            (config.olivos_event_host, config.olivos_event_port, config.olivos_event_token),
+            local_token=config.event_token
+        )
+        self.secret = config.event_secret.encode('utf-8')
+        self.olivos_secret = config.olivos_event_secret.encode('utf-8')
+        self.backpressure_timeout = config.event_backpressure_timeout
+        self.dispatcher = CallbackDispatcher(
+            session,
+            workers=config.event_workers,
+            max_size=config.event_queue_size,
+            max_retries=config.callback_retries,
+            retry_backoff=config.callback_retry_backoff,
+            overflow="drop_new",
+            emit=emit,
+            metrics=metrics,
+            kind="event",
+            label="事件"
+        )
+        self.server = None
+        self._thread = None
+
+    def authorized(self, headers, path, body):
+        if self.config.event_token and not self.rewriter.authorized(headers.get('Authorization'), path):
+            return False
+        if self.secret:
+            signature = "sha1=" + hmac.new(self.secret, body, hashlib.sha1).hexdigest()
+            if not hmac.compare_digest(signature, headers.get('X-Signature', '')):
+                return False
+        return True
+
+    def submit(self, path, body, block=True):
+        """放入一条上报事件（原始请求体），返回是否入队成功
+
+        没有设置 olivos_event_token 时去掉Lagrange上报带的 access_token，不把 event_token 转交给OlivOS。
+        """
+        if self.config.olivos_event_token:
+            forward_path = self.rewriter.rewrite(path)[1]
+        else:
+            forward_path = _strip_access_token(path)
+        headers = None
+        if self.olivos_secret:
+            headers = {'X-Signature': "sha1=" + hmac.new(self.olivos_secret, body, hashlib.sha1).hexdigest()}
+        return self.dispatcher.submit(
+            self.rewriter.target_prefix + forward_path, path, body, headers,
+            block=self.backpressure_timeout if block else 0
+        )
+
+    def start(self, engine):
+        cfg = self.config
+        self.server = PooledHTTPServer(
+            (cfg.event_host, cfg.event_port),
+            EventRequestHandler,
+            max_workers=cfg.event_workers * 2,
+            engine=engine,
+            reuse_port=cfg.local_reuse_port
+        )
+        self.dispatcher.start()
+        self._thread = threading.Thread(target=self.server.serve_forever, name="event-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Event relay running on {cfg.event_host}:{cfg.event_port} -> "
+                    f"{cfg.olivos_event_host}:{cfg.olivos_event_port}")
+
+    def stop(self, timeout=0):
+        """停止监听，timeout 大于0时先等待已收到的事件投递完（至多 timeout 秒）"""
+        if self.server is not None:
+            if self._thread is not None:
+                self.server.shutdown()
+                self._thread.join(5)
+                self._thread = None
+            self.server.server_close()
+            self.server.wait_idle(timeout)
+            self.server = None
+        if timeout > 0:
+            self.dispatcher.join(timeout)
+        self.dispatcher.stop()
+
+class PooledHTTPServer(HTTPServer):
+    """使用有界线程池并发处理请求的HTTPServer
+
+    每个连接交给线程池中的工作线程处理，单个请求的处理流程与原来一致，
+    同时处理的请求数不超过 max_workers，多出的连接在池中排队等待。
+    传入 executor 时与其他监听共用该线程池，关闭监听时不关闭线程池。
+    routes 为该监听上依次尝试匹配的路由，由引擎分配。
+    """
+    # 监听队列长度，突发连接较多时避免被系统直接拒绝
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers=16, engine=None, reuse_port=False, executor=None):
+        self.engine = engine
+        self.reuse_port = reuse_port
+        self.max_workers = max(1, int(max_workers))
+        self.routes = []
+        # 已接受、尚未处理完的连接数（包括在线程池中排队的），停止服务时据此等待
+        self.active = 0
+        self._idle = threading.Condition()
+        # 先建线程池，绑定失败时 server_close() 也能正常执行，抛出原始的绑定错误
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="forwarder"
+        )
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        if self.reuse_port:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                raise OSError("当前系统不支持 SO_REUSEPORT")
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self.active += 1
+        self.executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._idle:
+                self.active -= 1
+                if not self.active:
+                    self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        """等待已接受的连接全部处理完，超时返回False"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self.active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def server_close(self):
+        super().server_close()
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """转发请求处理，通过 self.server.engine 访问引擎的配置、连接池与回调队列
+
+    local_transport 为 ws 时，GET 上的 WebSocket 升级请求作为OneBot正向WebSocket连接处理，
+    该连接在断开前一直占用一个处理线程，连接上收到的动作交给引擎的 ws_executor 并发处理。
+    """
+    # 响应头与响应体分两次写出，不关闭Nagle算法时会与客户端的延迟ACK叠加出约40ms的等待
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # 访问日志同样走异步日志队列，不再同步写stderr
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_response(self, code, data):
+        # Lagrange的响应原样转发，其余响应才序列化
+        payload = data.raw if isinstance(data, RelayedResponse) else json_dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(content_length)
+
+    @staticmethod
+    def _parse_body(raw_body):
+        try:
+            return json_loads(raw_body)
+        except ValueError:
+            return raw_body.decode('utf-8', errors='replace')
+
+    @staticmethod
+    def _is_json_object(raw_body):
+        try:
+            return isinstance(json_loads(raw_body), dict)
+        except ValueError:
+            return False
+
+    def _select_route(self):
+        """按顺序返回第一个匹配的路由与去掉路径前缀后的路径，都不匹配时返回 (None, None)"""
+        authorization = self.headers.get('Authorization')
+        for route in self.server.routes:
+            path = route.match(self.path, authorization)
+            if path is not None:
+                return route, path
+        return None, None
+
+    def do_GET(self):
+        engine = self.server.engine
+        if engine.ws_executor is not None and websocket_transport.is_upgrade_request(self.headers):
+            route, path = self._select_route()
+            if route is None:
+                self._send_response(401, {"status": "unauthorized"})
+                engine.emit("rejected", path=self.path, code=401)
+                return
+            self._serve_websocket(route, path)
+            return
+        # 其他GET只提供 /metrics，不需要认证
+        if self.path.partition('?')[0] != "/metrics":
+            self._send_response(404, {"status": "not found"})
+            return
+        payload = engine.metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        engine = self.server.engine
+        started = time.perf_counter()
+
+        # 获取并记录原始数据，需要改写的动作才解析，其余动作原样透传
+        body = self._read_body()
+        route, path = self._select_route()
+        if route is None:
+            engine.emit("received", path=self.path)
+            self._send_response(401, {"status": "unauthorized"})
+            engine.emit("rejected", path=self.path, code=401)
+            return
+        if route.transforms.get(path) is not None:
+            body = self._parse_body(body)
+        route.observe("parse", time.perf_counter() - started)
+        print_log("收到原始数据", body)
+        route.emit("received", path=path)
+
+        # 认证验证：与WebSocket接入一致，接受 Authorization 头或查询串中的 access_token
+        if not route.rewriter.authorized(self.headers.get('Authorization'), path):
+            self._send_response(401, {"status": "unauthorized"})
+            route.emit("rejected", path=path, code=401)
+            return
+
+        # 处理数据：透传的原始请求体原样发送，但要先确认是有效的JSON对象，无效的请求不发给Lagrange
+        if not (isinstance(body, dict) or isinstance(body, bytes) and self._is_json_object(body)):
+            self._send_response(400, {"status": "invalid JSON"})
+            route.emit("rejected", path=path, code=400)
+            return
+
+        status_code, response_data = engine.forward(path, body, route=route)
+
+        # 返回响应
+        write_started = time.perf_counter()
+        self._send_response(status_code, response_data)
+        finished = time.perf_counter()
+        route.observe("write", finished - write_started)
+        route.observe("request", finished - started)
+
+    def _serve_websocket(self, route, path):
+        """OneBot正向WebSocket接入：每帧一个动作，转发后在同一连接上返回带原echo的响应"""
+        engine = self.server.engine
+        if not route.rewriter.authorized(self.headers.get('Authorization'), path):
+            self._send_response(401, {"status": "unauthorized"})
+            route.emit("rejected", path=path, code=401)
+            return
+        conn = websocket_transport.server_handshake(self)
+        if conn is None:
+            self._send_response(400, {"status": "invalid websocket handshake"})
+            return
+        print_log("WebSocket连接建立", {"client": self.address_string()}, logging.INFO)
+        executor = engine.ws_executor
+        engine.ws_connections.add(conn)
+        try:
+            while True:
+                text = conn.recv()
+                if text is None:
+                    break
+                executor.submit(self._handle_ws_frame, engine, route, conn, text, time.perf_counter())
+        finally:
+            engine.ws_connections.discard(conn)
+            conn.close()
+            print_log("WebSocket连接断开", {"client": self.address_string()}, logging.INFO)
+
+    def _handle_ws_frame(self, engine, route, conn, text, started):
+        try:
+            frame = json_loads(text)
+        except ValueError:
+            frame = text
+        route.observe("parse", time.perf_counter() - started)
+        print_log("收到原始数据", frame)
+        if not isinstance(frame, dict) or not isinstance(frame.get("params", {}), dict):
+            route.emit("received", path="/")
+            route.emit("rejected", path="/", code=400)
+            response_data = {"status": "failed", "retcode": 1400, "data": None, "message": "invalid JSON",
+                             "echo": frame.get("echo") if isinstance(frame, dict) else None}
+        else:
+            path = "/" + str(frame.get("action", "")).strip("/")
+            route.emit("received", path=path)
+            _, response_data = engine.forward(path, frame.get("params", {}), callback=False, route=route)
+            response_data = dict(response_data, echo=frame.get("echo"))
+        write_started = time.perf_counter()
+        try:
+            conn.send_text(json_dumps(response_data).decode('utf-8'))
+        except websocket_transport.WebSocketClosed:
+            return
+        finished = time.perf_counter()
+        route.observe("write", finished - write_started)
+        route.observe("request", finished - started)
+
+class EventRequestHandler(RequestHandler):
+    """接收Lagrange的HTTP上报事件，交给 engine.event_relay 排队转发"""
+    def do_GET(self):
+        self._send_response(404, {"status": "not found"})
+
+    def do_POST(self):
+        engine = self.server.engine
+        relay = engine.event_relay
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length)
+        engine.emit("event_received", path=self.path)
+
+        if relay is None or not relay.authorized(self.headers, self.path, body):
+            self._send_response(401, {"status": "unauthorized"})
+            engine.emit("event_rejected", path=self.path)
+            return
+        if not relay.submit(self.path, body):
+            self._send_response(503, {"status": "busy"})
+            return
+        engine.after_event(body)
+        self.send_response(204)
+        self.end_headers()
+
+def _echo_of(body):
+    """请求中的echo；透传的原始请求体只在需要时才解析"""
+    if isinstance(body, dict):
+        return body.get("echo")
+    try:
+        data = json_loads(body)
+    except ValueError:
+        return None
+    return data.get("echo") if isinstance(data, dict) else None
+
+class Route:
+    """一条 OlivOS → Lagrange 转发路由，多账号时每个账号一条
+
+    config 为合并了路由覆盖项后的完整配置，转发目标、令牌改写、限速、合并、去重、响应缓存与动作改写规则
+    都按路由分别创建；处理线程、连接池与回调队列由所有路由共用。
+    路由发出的事件先交给自己的钩子（metrics 按路由计数），再交给引擎（合计）。
+    没有名称的默认路由使用顶层配置，匹配主监听上其他路由都不匹配的请求。
+    """
+    def __init__(self, engine, config, spec=None):
+        self.engine = engine
+        self.config = config
+        self.name = ""
+        self.port = 0
+        self.path_prefix = ""
+        self.token = ""
+        if spec is not None:
+            self.update(spec)
+        self.transforms = ActionTransforms(config.action_transforms)
+        self.rewriter = None
+        self.upstreams = None
+        self.broadcast_executor = None
+        self.scheduler = None
+        self.coalescer = None
+        self.deduplicator = None
+        self.response_cache = None
+        self._hooks = collections.defaultdict(list)
+        self.metrics = ForwarderMetrics()
+        self.metrics.attach(self)
+
+    def update(self, spec):
+        self.name = spec["name"]
+        self.port = spec["port"]
+        self.path_prefix = spec["path_prefix"]
+        self.token = spec["token"]
+
+    def on(self, event, callback):
+        if event not in ForwarderEngine.EVENTS:
+            raise ValueError(f"未知事件: {event}")
+        self._hooks[event].append(callback)
+
+    def emit(self, event, **fields):
+        for callback in self._hooks.get(event, ()):
+            try:
+                callback(**fields)
+            except Exception:
+                logger.exception(f"事件钩子 {event} 执行失败")
+        self.engine.emit(event, **fields)
+
+    def observe(self, stage, seconds):
+        self.metrics.observe(stage, seconds)
+        self.engine.metrics.observe(stage, seconds)
+
+    def match(self, path, authorization):
+        """请求属于该路由时返回去掉路径前缀后的路径，否则返回None"""
+        prefix = self.path_prefix
+        if prefix:
+            rest = path[len(prefix):]
+            if not path.startswith(prefix) or rest[:1] not in ("", "/", "?"):
+                return None
+            path = rest if rest.startswith("/") else "/" + rest
+        if self.token and not self.rewriter.authorized(authorization, path):
+            return None
+        return path
+
+    def specificity(self):
+        # 前缀越长越先匹配，同前缀时按令牌选择的路由优先
+        return -len(self.path_prefix), not self.token
+
+class ForwarderEngine:
+    """OlivOS到Lagrange的转发引擎
+
+    start() 绑定监听端口并在后台线程中处理请求，serve_forever() 在当前线程中运行直到停止，
+    stop() 关闭监听、停止回调投递并写完剩余日志。
+    on(event, callback) 注册事件钩子，callback 以关键字参数接收事件字段，
+    在请求处理线程中同步调用，应尽快返回。
+    metrics 记录各类计数与各阶段耗时，监听端口上的 GET /metrics 以Prometheus文本格式输出。
+    配置了 routes 时按监听端口、路径前缀或接收端令牌把请求分到各路由，见 Route。
+    """
+    # 引擎会发出的事件
+    EVENTS = (
+        "started",  # host, port, workers
+        "stopped",
+        "received",  # path
+        "rejected",  # path, code
+        "forwarded",  # path, status, elapsed
+        "forward_failed",  # path, error, elapsed
+        "callback_sent",  # path, attempts, elapsed
+        "callback_failed",  # path, error, attempts, elapsed
+        "callback_dropped",  # path
+        "coalesced",  # path, messages
+        "rate_limited",  # path
+        "upstream_retry",  # path, attempt, error
+        "circuit_rejected",  # path
+        "circuit_changed",  # target, state
+        "target_health",  # target, healthy
+        "event_received",  # path
+        "event_rejected",  # path
+        "event_sent",  # path, attempts, elapsed
+        "event_failed",  # path, error, attempts, elapsed
+        "event_dropped",  # path
+        "duplicate_suppressed",  # path
+        "cache_hit",  # path
+        "cache_miss",  # path
+        "outbox_queued",  # path
+        "outbox_rejected",  # path
+        "outbox_sent",  # path, attempts, delay
+        "outbox_retry",  # path, attempt, error
+        "outbox_expired",  # path, age
+        "outbox_failed",  # path, error
+        "reloaded",  # changed
+    )
+
+    def __init__(self, config, log_stream=None):
+        self.config = config
+        self.log_stream = log_stream
+        self.server = None
+        # 默认路由与按配置顺序排列的其他路由（名称 -> Route），start() 时创建
+        self.route = None
+        self.routes = {}
+        # 路由单独监听的端口 -> (监听, 服务线程)
+        self.route_servers = {}
+        self.ws_executor = None
+        self.ws_connections = set()
+        self.event_relay = None
+        self.event_session = None
+        self.outbox = None
+        self.upstream_session = None
+        self.callback_session = None
+        self.callback_dispatcher = None
+        self.log_listener = None
+        self._hooks = collections.defaultdict(list)
+        self.metrics = ForwarderMetrics()
+        self.metrics.attach(self)
+        self._lock = threading.Lock()
+        self._thread = None
+        # 服务线程正在运行 serve_forever 的监听，热重载替换监听时据此交接
+        self._serve_lock = threading.Lock()
+        self._active_server = None
+
+    @property
+    def running(self):
+        return self.server is not None
+
+    def on(self, event, callback):
+        if event not in self.EVENTS:
+            raise ValueError(f"未知事件: {event}")
+        self._hooks[event].append(callback)
+
+    def emit(self, event, **fields):
+        for callback in self._hooks.get(event, ()):
+            try:
+                callback(**fields)
+            except Exception:
+                logger.exception(f"事件钩子 {event} 执行失败")
+
+    def all_routes(self):
+        route = self.route
+        return ([route] if route is not None else []) + list(self.routes.values())
+
+    def route_named(self, name):
+        """按名称查找路由，空名称为默认路由，不存在时返回None"""
+        return self.route if not name else self.routes.get(name)
+
+    def forward(self, path, body, callback=True, route=None):
+        """按动作的改写规则构造转发数据并发送到Lagrange，返回 (HTTP状态码, 响应数据)
+
+        body 为解析后的dict，或没有改写规则的动作的原始请求体（bytes，原样转发）。
+        callback=True 时把带原echo的结果放入回调队列发回接收端（HTTP接入）；
+        WebSocket接入直接在连接上返回响应，不需要回调。
+        route 为请求所属的路由（path 已去掉路由的路径前缀），默认为默认路由。
+        """
+        route = route or self.route
+        rewriter = route.rewriter
+        started = time.perf_counter()
+
+        # 改写转发路径（按请求路径缓存）
+        clean_path, forward_path, _ = rewriter.rewrite(path)
+
+        # 构建转发数据，没有改写规则的动作原样透传
+        transform = route.transforms.get(path)
+        modified_data = transform(body) if transform is not None and isinstance(body, dict) else body
+
+        # 记录转发信息
+        print_log("转发构造数据", {
+            "path": forward_path,
+            "data": modified_data
+        })
+
+        dedup = route.deduplicator
+        fingerprint = dedup.fingerprint(clean_path, body) if dedup is not None else None
+        if fingerprint is None:
+            return self._dispatch(route, path, body, modified_data, callback, started)
+        status_code, response_data = dedup.run(
+            fingerprint, clean_path, lambda: self._dispatch(route, path, body, modified_data, callback, started))
+        # 按内容识别的重复请求可能带着不同的echo
+        if "echo" in response_data and response_data["echo"] != _echo_of(body):
+            response_data = dict(response_data, echo=_echo_of(body))
+        return status_code, response_data
+
+    def _dispatch(self, route, path, body, modified_data, callback, started):
+        """发送构造好的转发数据（或写入待发送队列），返回 (HTTP状态码, 响应数据)"""
+        rewriter = route.rewriter
+        clean_path, forward_path, _ = rewriter.rewrite(path)
+
+        # 开启待发送队列时，消息落盘后即返回，由后台线程发送
+        outbox = self.outbox
+        if outbox is not None and outbox.accepts(clean_path):
+            echo = _echo_of(body)
+            write_started = time.perf_counter()
+            if outbox.append(path, modified_data, echo, callback, route.name):
+                route.observe("outbox", time.perf_counter() - write_started)
+                route.emit("outbox_queued", path=clean_path)
+                return 200, {"status": "async", "retcode": 1, "data": None, "echo": echo}
+            route.emit("outbox_rejected", path=clean_path)
+            return 503, {"status": "failed", "retcode": 1000, "data": None, "message": "待发送队列已满", "echo": echo}
+
+        # 发送转发请求
+        try:
+            coalescer = route.coalescer
+            cache = route.response_cache
+            cache_key = cache.key(clean_path, modified_data) if cache is not None else None
+            if coalescer is not None and isinstance(modified_data, dict) and coalescer.eligible(modified_data):
+                status_code, response_data = coalescer.submit(path, modified_data)
+                # 合并发送时共享同一个响应，按各自的echo返回
+                response_data = dict(response_data, echo=body.get("echo"))
+            elif cache_key is not None:
+                status_code, response_data = cache.get_or_load(
+                    cache_key, lambda: self.post_upstream(path, modified_data, route))
+                # 缓存的响应可能带着第一次请求的echo
+                if "echo" in response_data:
+                    response_data = dict(response_data, echo=_echo_of(body))
+            else:
+                status_code, response_data = self.post_upstream(path, modified_data, route)
+                if cache is not None and status_code < 500 and response_data.get("status") == "ok":
+                    cache.after_action(clean_path, modified_data)
+            print_log("转发响应", {
+                "status": status_code,
+                "data": response_data
+            })
+
+            # 检查是否有返回数据需要回调
+            if callback and response_data.get("status") == "ok" and response_data.get("data"):
+                self.send_callback(path, response_data, _echo_of(body), route)
+
+            route.emit("forwarded", path=clean_path, status=status_code,
+                      elapsed=time.perf_counter() - started)
+            # 返回原始响应
+            return 200, response_data
+
+        except Exception as e:
+            error_response = {
+                "status": "failed",
+                "retcode": 1000,
+                "data": None,
+                "message": str(e),
+                "echo": _echo_of(body)
+            }
+            print_log("转发异常", {
+                "error": str(e),
+                "target": rewriter.target_prefix + forward_path
+            }, logging.ERROR)
+            route.emit("forward_failed", path=clean_path, error=str(e),
+                      elapsed=time.perf_counter() - started)
+            return 502, error_response
+
+    def send_callback(self, path, response_data, echo, route=None):
+        """有返回数据时，把带原echo的结果放入后台队列发回接收端（使用路由的接收配置），不阻塞调用方"""
+        if response_data.get("status") != "ok" or not response_data.get("data"):
+            return
+        # 构造回调数据
+        callback_data = {
+            "status": "ok",
+            "retcode": 0,
+            "data": response_data["data"],
+            "echo": echo
+        }
+        rewriter = (route or self.route).rewriter
+        callback_path = rewriter.rewrite(path)[2]
+        self.callback_dispatcher.submit(
+            rewriter.callback_prefix + callback_path,
+            callback_path,
+            callback_data
+        )
+
+    def post_upstream(self, path, data, route=None):
+        """把一条消息发送到路由 route（默认为默认路由）的Lagrange，返回 (状态码, 响应数据)
+
+        path 为收到请求的原始路径（已去掉路由的路径前缀），按选中目标的令牌改写后转发。
+        data 为bytes时作为原始请求体原样发送，分会话限速或按会话选择目标时从中读取会话字段。
+        所有目标都熔断时抛出 CircuitOpenError，排队超时抛出 RateLimitExceeded。
+        只有连接阶段失败（消息确定没有送达）才会换一个目标重试，读取超时等可能已送达的失败不重试，避免重复发送。
+        """
+        route = route or self.route
+        cfg = route.config
+        pool = route.upstreams
+        if not pool.any_available():
+            route.emit("circuit_rejected", path=path)
+            raise CircuitOpenError("转发目标不可用，已熔断")
+        # 限速与按会话选择目标时才需要会话字段，都不启用时原始请求体不为此解析
+        scheduler = route.scheduler
+        session = {}
+        if scheduler is not None or pool.strategy == "sticky_group" and len(pool.upstreams) > 1:
+            session = _session_fields(path, data)
+        if scheduler is not None:
+            try:
+                route.observe("queue", scheduler.acquire(session))
+            except RateLimitExceeded:
+                route.emit("rate_limited", path=path)
+                raise
+        broadcast_executor = route.broadcast_executor
+        if broadcast_executor is not None:
+            return self._broadcast(route, pool, broadcast_executor, path, data)
+
+        tried = []
+        attempt = 0
+        while True:
+            upstream = pool.choose(session, tried) or (pool.choose(session) if tried else None)
+            if upstream is None:
+                route.emit("circuit_rejected", path=path)
+                raise CircuitOpenError("转发目标不可用，已熔断")
+            try:
+                return self._post_to(route, pool, upstream, path, data)
+            except (requests.exceptions.ConnectionError, websocket_transport.WebSocketConnectError) as e:
+                if attempt >= cfg.upstream_retries or not _connect_failed(e):
+                    raise
+                attempt += 1
+                tried.append(upstream)
+                route.emit("upstream_retry", path=path, attempt=attempt, error=str(e))
+                time.sleep(random.uniform(0, cfg.upstream_retry_backoff * (2 ** (attempt - 1))))
+
+    def _post_to(self, route, pool, upstream, path, data):
+        """通过目标所属的 pool 向其发送一次，调用前需已通过其熔断器的 allow()
+
+        热重载期间已经开始的请求在旧的目标池与连接池上完成。
+        """
+        cfg = route.config
+        breaker = upstream.breaker
+        started = time.perf_counter()
+        try:
+            payload = data if isinstance(data, bytes) else json_dumps(data)
+        except Exception:
+            # 请求没有发出，不算目标的失败，让出半开状态的探测机会
+            if breaker is not None:
+                breaker.cancel()
+            raise
+        pool.acquire(upstream)
+        try:
+            if upstream.ws_client is not None:
+                # WebSocket发送端：动作名取自请求路径，响应按HTTP接口的形式返回
+                action = path.partition('?')[0].strip('/')
+                response_data = upstream.ws_client.call(action, payload, timeout=cfg.upstream_read_timeout)
+                status_code = 200
+            else:
+                response = pool.session.post(
+                    url=upstream.rewriter.target_prefix + upstream.rewriter.rewrite(path)[1],
+                    data=payload,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=(cfg.upstream_connect_timeout, cfg.upstream_read_timeout)
+                )
+                # 只解析一次，原始响应体留给接收端原样返回
+                response_data = RelayedResponse(response.content)
+                status_code = response.status_code
+        except Exception:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        finally:
+            pool.release(upstream)
+
+        route.observe("upstream", time.perf_counter() - started)
+        if breaker is not None:
+            if status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return status_code, response_data
+
+    def _broadcast(self, route, pool, executor, path, data):
+        """同时发送到所有可用目标，返回第一个成功目标（按配置顺序）的响应，全部失败时抛出第一个错误"""
+        upstreams = [u for u in pool.upstreams if u.available()]
+        upstreams = [u for u in upstreams if u.breaker is None or u.breaker.allow()]
+        if not upstreams:
+            route.emit("circuit_rejected", path=path)
+            raise CircuitOpenError("转发目标不可用，已熔断")
+        futures = []
+        try:
+            for upstream in upstreams:
+                futures.append(executor.submit(self._post_to, route, pool, upstream, path, data))
+        except Exception:
+            # 线程池已关闭（热重载替换了它）等情况，没有提交的目标让出探测机会
+            for upstream in upstreams[len(futures):]:
+                if upstream.breaker is not None:
+                    upstream.breaker.cancel()
+            raise
+        results, errors = [], []
+        for upstream, future in zip(upstreams, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print_log("广播发送失败", {"target": upstream.name, "error": str(e)}, logging.WARNING)
+                errors.append(e)
+        for status_code, response_data in results:
+            if status_code < 500:
+                return status_code, response_data
+        if results:
+            return results[0]
+        raise errors[0]
+
+    def after_event(self, event):
+        """按上报事件让各路由的响应缓存失效；不区分事件来自哪个账号，多失效一些不影响正确性"""
+        for route in self.all_routes():
+            if route.response_cache is not None:
+                route.response_cache.after_event(event)
+
+    def _relay_ws_event(self, event):
+        """发送端WebSocket连接上收到的上报事件，开启事件转发时同样交给OlivOS
+
+        在连接的读取线程中调用，不能等待队列空位，否则会阻塞同一连接上的API响应。
+        """
+        self.after_event(event)
+        relay = self.event_relay
+        if relay is None:
+            return
+        self.emit("event_received", path="/")
+        relay.submit("/", json_dumps(event), block=False)
+
+    def metrics_text(self):
+        """Prometheus文本格式的指标，附带回调队列与日志队列的当前状态"""
+        gauges = {}
+        dispatcher = self.callback_dispatcher
+        if dispatcher is not None:
+            gauges["callback_queue_depth"] = ("待发送的回调数", dispatcher.queue.qsize())
+        relay = self.event_relay
+        if relay is not None:
+            gauges["event_queue_depth"] = ("待投递的上报事件数", relay.dispatcher.queue.qsize())
+        outbox = self.outbox
+        if outbox is not None:
+            gauges["outbox_pending"] = ("待发送队列中尚未删除的消息数", outbox.pending)
+        routes = self.all_routes()
+        dedups = [route.deduplicator for route in routes if route.deduplicator is not None]
+        if dedups:
+            gauges["dedup_entries"] = ("去重窗口内记住的请求数", sum(len(dedup) for dedup in dedups))
+        caches = [route.response_cache for route in routes if route.response_cache is not None]
+        if caches:
+            gauges["response_cache_entries"] = ("响应缓存条数", sum(len(cache) for cache in caches))
+            gauges["response_cache_bytes"] = ("响应缓存占用的响应体字节数", sum(cache.size for cache in caches))
+        if routes:
+            # 默认路由的目标只带 target 标签，其他路由的目标另带 route 标签
+            states = {"closed": 0, "open": 1, "half_open": 0.5}
+            healthy, inflight, circuit = {}, {}, {}
+            for route in routes:
+                for u in route.upstreams.upstreams:
+                    key = (("route", route.name), ("target", u.name)) if route.name else u.name
+                    healthy[key] = int(u.healthy)
+                    inflight[key] = u.inflight
+                    if u.breaker is not None:
+                        circuit[key] = states[u.breaker.state]
+            gauges["target_healthy"] = ("转发目标健康检查是否通过", healthy)
+            gauges["target_inflight"] = ("转发目标进行中的请求数", inflight)
+            gauges["circuit_open"] = ("转发目标熔断状态: 0 正常, 1 熔断, 0.5 半开", circuit)
+        for handler in logger.handlers:
+            if isinstance(handler, AsyncQueueHandler):
+                gauges["log_dropped"] = ("因日志队列已满被丢弃的日志数", handler.dropped)
+        return self.metrics.render(gauges, {route.name: route.metrics for route in routes if route.name})
+
+    def _build_upstreams(self, route, cfg, session):
+        """路由的转发目标池，使用所有路由共用的 session 连接池；广播线程池挂在目标池上，热重载时整体替换"""
+        upstream_targets = cfg.upstreams()
+        pool = UpstreamPool(
+            [Upstream(cfg, host, port, token, emit=route.emit, on_event=self._relay_ws_event)
+             for host, port, token in upstream_targets],
+            session,
+            strategy=cfg.target_strategy,
+            check_interval=cfg.health_check_interval,
+            check_timeout=cfg.upstream_connect_timeout,
+            emit=route.emit
+        )
+        broadcast_executor = None
+        if cfg.target_broadcast and len(upstream_targets) > 1:
+            broadcast_executor = ThreadPoolExecutor(
+                max_workers=max(1, cfg.max_workers) * len(upstream_targets),
+                thread_name_prefix="broadcast"
+            )
+        return pool, broadcast_executor
+
+    @staticmethod
+    def _session_hosts(config):
+        # 连接池为每个目标地址保留一组连接
+        targets = set(config.upstreams())
+        for route in config.routes:
+            targets.update(config.route_config(route).upstreams())
+        return len({(host, port) for host, port, _ in targets})
+
+    @staticmethod
+    def _build_scheduler(cfg):
+        scheduler = OutboundScheduler(
+            global_rate=cfg.rate_limit_global,
+            global_burst=cfg.rate_limit_global_burst,
+            group_rate=cfg.rate_limit_group,
+            group_burst=cfg.rate_limit_group_burst,
+            user_rate=cfg.rate_limit_user,
+            user_burst=cfg.rate_limit_user_burst,
+            max_wait=cfg.rate_limit_max_wait,
+            private_first=cfg.rate_limit_private_first
+        )
+        return scheduler if scheduler.enabled else None
+
+    def _build_coalescer(self, route, cfg):
+        if cfg.coalesce_window_ms <= 0:
+            return None
+        return MessageCoalescer(
+            lambda path, data: self.post_upstream(path, data, route),
+            window=cfg.coalesce_window_ms / 1000.0,
+            max_messages=cfg.coalesce_max_messages,
+            max_chars=cfg.coalesce_max_chars,
+            emit=route.emit
+        )
+
+    @staticmethod
+    def _build_deduplicator(route, cfg):
+        if not cfg.dedup_enabled:
+            return None
+        return DuplicateFilter(
+            cfg.dedup_actions,
+            window=cfg.dedup_window,
+            max_entries=cfg.dedup_max_entries,
+            by_content=cfg.dedup_by_content,
+            emit=route.emit
+        )
+
+    @staticmethod
+    def _build_response_cache(route, cfg):
+        if not cfg.response_cache_enabled:
+            return None
+        return ResponseCache(
+            cfg.response_cache_ttls,
+            max_entries=cfg.response_cache_max_entries,
+            max_bytes=cfg.response_cache_max_bytes,
+            emit=route.emit
+        )
+
+    def _build_route(self, cfg, spec, session):
+        """创建路由及其全部组件，目标池尚未启动"""
+        route = Route(self, cfg, spec)
+        route.upstreams, route.broadcast_executor = self._build_upstreams(route, cfg, session)
+        # 路径改写与认证使用第一个目标的规则
+        route.rewriter = route.upstreams.primary.rewriter
+        route.scheduler = self._build_scheduler(cfg)
+        route.coalescer = self._build_coalescer(route, cfg)
+        route.deduplicator = self._build_deduplicator(route, cfg)
+        route.response_cache = self._build_response_cache(route, cfg)
+        return route
+
+    def _build_callbacks(self, cfg):
+        session = PooledSession(cfg.pool_size, cfg.pool_idle_timeout)
+        dispatcher = CallbackDispatcher(
+            session,
+            workers=cfg.callback_workers,
+            max_size=cfg.callback_queue_size,
+            max_retries=cfg.callback_retries,
+            retry_backoff=cfg.callback_retry_backoff,
+            overflow=cfg.callback_overflow,
+            emit=self.emit,
+            metrics=self.metrics
+        )
+        return session, dispatcher
+
+    def _build_event_relay(self, cfg):
+        if not cfg.event_enabled:
+            return None, None
+        # 上报事件方向使用独立的连接池与投递线程
+        session = PooledSession(cfg.pool_size, cfg.pool_idle_timeout)
+        return session, EventRelay(cfg, session, emit=self.emit, metrics=self.metrics)
+
+    def _build_server(self, cfg, port, executor=None):
+        return PooledHTTPServer(
+            (cfg.local_host, port),
+            RequestHandler,
+            max_workers=cfg.max_workers,
+            engine=self,
+            reuse_port=cfg.local_reuse_port,
+            executor=executor
+        )
+
+    @staticmethod
+    def _route_ports(cfg):
+        """需要单独监听的路由端口"""
+        return {route["port"] for route in cfg.routes if route["port"] and route["port"] != cfg.local_port}
+
+    def _assign_routes(self):
+        """按路由的监听端口分配各监听上依次尝试匹配的路由，主监听最后交给默认路由"""
+        routes = sorted(self.routes.values(), key=Route.specificity)
+        cfg = self.config
+        self.server.routes = [r for r in routes if r.port in (0, cfg.local_port)] + [self.route]
+        for port, (server, _) in self.route_servers.items():
+            server.routes = [r for r in routes if r.port == port]
+
+    def _start_route_server(self, port, server):
+        thread = threading.Thread(target=server.serve_forever, name=f"route-server-{port}", daemon=True)
+        thread.start()
+        self.route_servers[port] = (server, thread)
+
+    def _setup_logging(self, cfg, install=True):
+        return setup_logging(
+            level=cfg.log_level,
+            compact=cfg.log_compact,
+            log_file=cfg.log_file,
+            max_bytes=cfg.log_file_max_bytes,
+            backup_count=cfg.log_file_backups,
+            queue_size=cfg.log_queue_size,
+            stream=self.log_stream,
+            install=install
+        )
+
+    def start(self, background=True):
+        """绑定监听端口并启动后台组件，创建组件或绑定失败时清理已启动的部分并抛出异常"""
+        with self._lock:
+            if self.server is not None:
+                raise RuntimeError("转发服务已在运行")
+            cfg = self.config
+
+            self.log_listener = self._setup_logging(cfg)
+
+            route_servers = {}
+            try:
+                # 转发目标（所有路由共用）与回调目标各自使用独立的连接池
+                self.upstream_session = PooledSession(cfg.pool_size, cfg.pool_idle_timeout,
+                                                      hosts=self._session_hosts(cfg))
+                self.route = self._build_route(cfg, None, self.upstream_session)
+                for spec in cfg.routes:
+                    self.routes[spec["name"]] = self._build_route(cfg.route_config(spec), spec, self.upstream_session)
+                if cfg.local_transport == "ws":
+                    self.ws_executor = ThreadPoolExecutor(max_workers=max(1, cfg.max_workers),
+                                                          thread_name_prefix="ws-action")
+                self.callback_session, self.callback_dispatcher = self._build_callbacks(cfg)
+                self.event_session, self.event_relay = self._build_event_relay(cfg)
+                if cfg.outbox_enabled:
+                    self.outbox = Outbox(cfg, self)
+                    self.outbox.open()
+                server = self._build_server(cfg, cfg.local_port)
+                self.server = server
+                # 路由单独监听的端口共用主监听的处理线程池
+                for port in sorted(self._route_ports(cfg)):
+                    route_servers[port] = self._build_server(cfg, port, executor=server.executor)
+                if self.event_relay is not None:
+                    self.event_relay.start(self)
+            except Exception:
+                for route_server in route_servers.values():
+                    route_server.server_close()
+                if self.server is not None:
+                    self.server.server_close()
+                    self.server = None
+                self._release()
+                raise
+
+            for port, route_server in route_servers.items():
+                self._start_route_server(port, route_server)
+            self._assign_routes()
+            self.callback_dispatcher.start()
+            for route in self.all_routes():
+                route.upstreams.start()
+            if self.outbox is not None:
+                self.outbox.start()
+            logger.info(f"Server running on {cfg.local_host}:{cfg.local_port} (workers: {server.max_workers})")
+            for route in self.all_routes():
+                self._log_route(route)
+            self.emit("started", host=cfg.local_host, port=cfg.local_port, workers=server.max_workers)
+
+            if background:
+                self._thread = threading.Thread(target=self._serve, name="forwarder-server", daemon=True)
+                self._thread.start()
+
+    def _log_route(self, route):
+        cfg = route.config
+        pool = route.upstreams
+        if route.name:
+            selectors = [f"port {route.port}" if route.port else "", route.path_prefix,
+                         "token" if route.token else ""]
+            logger.info(f"Route {route.name} ({', '.join(filter(None, selectors))}) -> "
+                        f"{', '.join(u.name for u in pool.upstreams)}")
+        elif len(pool.upstreams) > 1:
+            mode = "broadcast" if route.broadcast_executor is not None else cfg.target_strategy
+            logger.info(f"Forwarding to {', '.join(u.name for u in pool.upstreams)} ({mode})")
+
+    # 各组件依赖的配置项，热重载时只重建相关配置有变化的组件
+    RELOAD_GROUPS = {
+        "logging": ("log_level", "log_compact", "log_file", "log_file_max_bytes", "log_file_backups", "log_queue_size"),
+        "upstreams": ("local_host", "local_port", "local_token", "target_host", "target_port", "target_token",
+                      "targets", "target_strategy", "target_broadcast", "health_check_interval", "target_transport",
+                      "target_ws_path", "callback_host", "callback_port", "max_workers", "upstream_connect_timeout",
+                      "upstream_read_timeout", "breaker_failure_threshold", "breaker_reset_timeout",
+                      "pool_size", "pool_idle_timeout"),
+        "scheduler": ("rate_limit_global", "rate_limit_global_burst", "rate_limit_group", "rate_limit_group_burst",
+                      "rate_limit_user", "rate_limit_user_burst", "rate_limit_max_wait", "rate_limit_private_first"),
+        "coalescer": ("coalesce_window_ms", "coalesce_max_messages", "coalesce_max_chars"),
+        "transforms": ("action_transforms",),
+        "deduplicator": ("dedup_enabled", "dedup_window", "dedup_max_entries", "dedup_actions", "dedup_by_content"),
+        "response_cache": ("response_cache_enabled", "response_cache_ttls", "response_cache_max_entries",
+                           "response_cache_max_bytes", "targets", "target_host", "target_port", "target_token"),
+        "callbacks": ("callback_workers", "callback_queue_size", "callback_retries", "callback_retry_backoff",
+                      "callback_overflow", "pool_size", "pool_idle_timeout"),
+        "events": ("event_enabled", "event_host", "event_port", "event_token", "event_secret", "olivos_event_host",
+                   "olivos_event_port", "olivos_event_token", "olivos_event_secret", "event_workers",
+                   "event_queue_size", "event_backpressure_timeout", "local_reuse_port", "callback_retries", "callback_retry_backoff",
+                   "pool_size", "pool_idle_timeout"),
+        "outbox": ("outbox_enabled", "outbox_path", "outbox_actions", "outbox_workers", "outbox_flush_interval_ms",
+                   "outbox_max_bytes", "outbox_max_age", "upstream_retry_backoff", "breaker_reset_timeout"),
+    }
+    # 按路由分别创建的组件
+    ROUTE_GROUPS = ("upstreams", "scheduler", "coalescer", "transforms", "deduplicator", "response_cache")
+
+    def reload(self, config):
+        """不停止服务切换到新配置，返回有变化的配置项
+
+        只重建相关配置有变化的组件（各路由按合并覆盖项后的配置分别比较）：新组件全部建好后才替换，
+        建立失败时抛出异常且继续使用旧配置。新增的路由直接创建，删除的路由排空后关闭。
+        已经开始的请求在旧的目标池、连接池上完成，旧组件在后台排空后关闭；回调队列中剩余的回调照常发送。
+        监听地址不变时不关闭监听端口，只在 max_workers 变化时替换处理线程池；
+        监听地址变化时先绑定新地址再关闭旧监听，路由单独监听的端口则关闭后重新绑定。上报事件监听与待发送队列有变化时会短暂重启
+        （待发送的消息保留在文件中）。服务未运行时只保存配置，下次 start() 时生效。
+        """
+        with self._lock:
+            old = self.config
+            changed = {key for key in DEFAULT_CONFIG if getattr(old, key) != getattr(config, key)}
+            if self.server is None or not changed:
+                self.config = config
+                return changed
+            groups = {name for name, keys in self.RELOAD_GROUPS.items() if changed.intersection(keys)}
+            listen_changed = {"local_host", "local_port", "local_reuse_port"} & changed
+
+            # 每条路由（默认路由名称为空）合并覆盖项后的新配置，以及需要重建的组件
+            specs = {"": (None, config)}
+            specs.update((spec["name"], (spec, config.route_config(spec))) for spec in config.routes)
+            current = {"": self.route, **self.routes}
+            # 连接池参数变化时换用新连接池，所有路由的目标池随之重建
+            session = self.upstream_session
+            if {"pool_size", "pool_idle_timeout"} & changed:
+                session = PooledSession(config.pool_size, config.pool_idle_timeout, hosts=self._session_hosts(config))
+            plans = {}
+            for name, (spec, route_config) in specs.items():
+                route = current.get(name)
+                if route is None:
+                    plans[name] = (None, spec, route_config, set(self.ROUTE_GROUPS))
+                    continue
+                route_changed = {key for key in DEFAULT_CONFIG
+                                 if getattr(route.config, key) != getattr(route_config, key)}
+                route_groups = {group for group in self.ROUTE_GROUPS
+                                if route_changed.intersection(self.RELOAD_GROUPS[group])}
+                plans[name] = (route, spec, route_config, route_groups)
+
+            # 先建好需要替换的组件，失败时关闭已建好的部分并保持原状
+            built = {"pools": {}, "routes": {}, "components": {}, "route_servers": {}}
+            if session is not self.upstream_session:
+                built["session"] = session
+            try:
+                if "logging" in groups:
+                    built["logging"] = self._setup_logging(config, install=False)
+                for name, (route, spec, route_config, route_groups) in plans.items():
+                    if route is None:
+                        built["routes"][name] = self._build_route(route_config, spec, session)
+                        continue
+                    if "upstreams" in route_groups:
+                        built["pools"][name] = self._build_upstreams(route, route_config, session)
+                    built["components"][name] = self._build_route_components(route, route_config, route_groups)
+                if "callbacks" in groups:
+                    built["callbacks"] = self._build_callbacks(config)
+                if listen_changed:
+                    built["server"] = self._build_server(config, config.local_port)
+                executor = built["server"].executor if "server" in built else self.server.executor
+                for port in self._route_ports(config) - set(self.route_servers):
+                    built["route_servers"][port] = self._build_server(config, port, executor=executor)
+            except Exception:
+                self._discard_built(built)
+                raise
+
+            # 替换
+            self.config = config
+            retired = []
+            if "logging" in groups:
+                retired.append((stop_logging, self.log_listener))
+                self.log_listener = built["logging"]
+                install_logging(self.log_listener, config.log_level)
+            routes = {}
+            for name, (route, spec, route_config, route_groups) in plans.items():
+                if route is None:
+                    route = built["routes"][name]
+                    route.upstreams.start()
+                    routes[name] = route
+                    continue
+                routes[name] = route
+                if spec is not None:
+                    route.update(spec)
+                route.config = route_config
+                for attr, component in built["components"][name].items():
+                    setattr(route, attr, component)
+                if "upstreams" in route_groups:
+                    retired.append((self._drain_upstreams, (route.upstreams, route.broadcast_executor, old)))
+                    route.upstreams, route.broadcast_executor = built["pools"][name]
+                    route.rewriter = route.upstreams.primary.rewriter
+                    route.upstreams.start()
+            for name, route in current.items():
+                if name not in routes:
+                    retired.append((self._drain_upstreams, (route.upstreams, route.broadcast_executor, old)))
+            self.route = routes.pop("")
+            self.routes = routes
+            if "session" in built:
+                # 旧目标池都排空后再关闭旧连接池
+                retired.append((self._close_session, self.upstream_session))
+                self.upstream_session = session
+            else:
+                # 新连接数上限在连接池下次重建时生效
+                session.hosts = self._session_hosts(config)
+
+            if "callbacks" in groups:
+                old_dispatcher, old_session = self.callback_dispatcher, self.callback_session
+                self.callback_session, self.callback_dispatcher = built["callbacks"]
+                self.callback_dispatcher.start()
+                retired.append((self._drain_callbacks, (old_dispatcher, old_session)))
+            if "local_transport" in changed:
+                old_ws = self.ws_executor
+                self.ws_executor = None
+                if config.local_transport == "ws":
+                    self.ws_executor = ThreadPoolExecutor(max_workers=max(1, config.max_workers),
+                                                          thread_name_prefix="ws-action")
+                if old_ws is not None:
+                    for conn in list(self.ws_connections):
+                        conn.close(1001)
+                    retired.append((self._shutdown_executor, old_ws))
+            if "events" in groups:
+                self._restart_event_relay(config)
+            if "outbox" in groups:
+                self._restart_outbox(config)
+
+            if "server" in built:
+                old_server = self.server
+                with self._serve_lock:
+                    self.server = built["server"]
+                    active = self._active_server
+                # 旧监听的 serve_forever 返回后，服务线程接着处理新监听
+                if active is old_server:
+                    old_server.shutdown()
+                retired.append((self._drain_server, old_server))
+            elif "max_workers" in changed:
+                old_executor = self.server.executor
+                self.server.max_workers = max(1, int(config.max_workers))
+                self.server.executor = ThreadPoolExecutor(max_workers=self.server.max_workers,
+                                                          thread_name_prefix="forwarder")
+                retired.append((self._shutdown_executor, old_executor))
+            route_ports = self._route_ports(config)
+            rebind = {"local_host", "local_reuse_port"} & changed
+            for port, (route_server, _) in list(self.route_servers.items()):
+                if port in route_ports and not rebind:
+                    route_server.executor = self.server.executor
+                    continue
+                del self.route_servers[port]
+                route_server.shutdown()
+                route_server.server_close()
+                if port in route_ports:
+                    # 同一端口不能先绑定新地址，关闭旧监听后再绑定，失败时该端口上的路由暂停服务
+                    try:
+                        built["route_servers"][port] = self._build_server(config, port, executor=self.server.executor)
+                    except OSError:
+                        logger.exception(f"路由端口 {port} 重新监听失败")
+            for port, route_server in built["route_servers"].items():
+                self._start_route_server(port, route_server)
+            self._assign_routes()
+
+            if retired:
+                threading.Thread(target=self._drain, args=(retired,), name="reload-drain", daemon=True).start()
+            logger.info(f"配置已重新加载: {', '.join(sorted(changed))}")
+            for name, (route, _, _, route_groups) in plans.items():
+                if route is None or "upstreams" in route_groups:
+                    self._log_route(self.route_named(name))
+            self.emit("reloaded", changed=sorted(changed))
+            return changed
+
+    def _build_route_components(self, route, cfg, route_groups):
+        """建好已有路由中需要替换的组件（转发目标池除外），返回 {属性名: 新组件}"""
+        components = {}
+        if "transforms" in route_groups:
+            components["transforms"] = ActionTransforms(cfg.action_transforms)
+        if "scheduler" in route_groups:
+            components["scheduler"] = self._build_scheduler(cfg)
+        if "coalescer" in route_groups:
+            components["coalescer"] = self._build_coalescer(route, cfg)
+        if "deduplicator" in route_groups:
+            components["deduplicator"] = self._build_deduplicator(route, cfg)
+        if "response_cache" in route_groups:
+            components["response_cache"] = self._build_response_cache(route, cfg)
+        return components
+
+    @staticmethod
+    def _discard_built(built):
+        if "logging" in built:
+            # 未启用的日志管线没有输出线程，直接关闭输出
+            for handler in built["logging"].handlers:
+                handler.close()
+        for route in built["routes"].values():
+            ForwarderEngine._close_pool(route.upstreams, route.broadcast_executor)
+        for pool, broadcast_executor in built["pools"].values():
+            ForwarderEngine._close_pool(pool, broadcast_executor)
+        if "session" in built:
+            built["session"].close()
+        if "callbacks" in built:
+            built["callbacks"][0].close()
+        for server in built["route_servers"].values():
+            server.server_close()
+        if "server" in built:
+            built["server"].server_close()
+
+    @staticmethod
+    def _close_pool(pool, broadcast_executor):
+        pool.stop()
+        if broadcast_executor is not None:
+            broadcast_executor.shutdown(wait=False)
+
+    def _restart_event_relay(self, config):
+        if self.event_relay is not None:
+            self.event_relay.stop()
+            self.event_session.close()
+        self.event_session, self.event_relay = self._build_event_relay(config)
+        if self.event_relay is not None:
+            try:
+                self.event_relay.start(self)
+            except Exception:
+                logger.exception("上报事件转发启动失败")
+                self.event_session.close()
+                self.event_session, self.event_relay = None, None
+
+    def _restart_outbox(self, config):
+        # 旧队列的发送线程停止后新队列才打开同一文件，避免同一消息被两组线程发送
+        if self.outbox is not None:
+            self.outbox.stop()
+            self.outbox = None
+        if config.outbox_enabled:
+            outbox = Outbox(config, self)
+            try:
+                outbox.open()
+            except Exception:
+                logger.exception("待发送队列打开失败")
+                return
+            outbox.start()
+            self.outbox = outbox
+
+    @staticmethod
+    def _drain(retired):
+        for release, resource in retired:
+            try:
+                release(resource)
+            except Exception:
+                logger.exception("关闭旧组件失败")
+
+    @staticmethod
+    def _drain_upstreams(args):
+        """等待旧目标池上进行中的请求完成（最多一个完整的请求超时），再关闭目标池"""
+        pool, broadcast_executor, cfg = args
+        deadline = time.monotonic() + (cfg.upstream_connect_timeout + cfg.upstream_read_timeout) * (cfg.upstream_retries + 1)
+        while any(u.inflight for u in pool.upstreams) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        pool.stop()
+        if broadcast_executor is not None:
+            broadcast_executor.shutdown(wait=True)
+
+    @staticmethod
+    def _close_session(session):
+        session.close()
+
+    @staticmethod
+    def _drain_callbacks(args):
+        """旧回调队列发送完（或等待超时）后再停止"""
+        dispatcher, session = args
+        dispatcher.join(30)
+        dispatcher.stop()
+        session.close()
+
+    @staticmethod
+    def _shutdown_executor(executor):
+        executor.shutdown(wait=True)
+
+    @staticmethod
+    def _drain_server(server):
+        # 等旧监听上已接受的请求处理完再关闭
+        server.executor.shutdown(wait=True)
+        server.server_close()
+
+    def serve_forever(self):
+        """在当前线程中启动并运行转发服务，直到 stop() 或 KeyboardInterrupt"""
+        self.start(background=False)
+        try:
+            self._serve()
+        finally:
+            self.stop()
+
+    def _serve(self):
+        while True:
+            with self._serve_lock:
+                server = self._active_server = self.server
+            if server is None:
+                return
+            try:
+                server.serve_forever()
+            except Exception:
+                logger.exception("转发服务错误")
+                with self._serve_lock:
+                    self._active_server = None
+                return
+            with self._serve_lock:
+                self._active_server = None
+                # 被 stop() 关闭时结束；热重载换了新监听时继续
+                if self.server is server:
+                    return
+
+    def stop(self):
+        """停止监听并释放连接池、回调队列与日志线程，可重复调用
+
+        停止接受新连接后，至多等待 shutdown_timeout 秒让进行中的请求处理完、回调与上报事件发送完。
+        """
+        with self._lock:
+            with self._serve_lock:
+                server, self.server = self.server, None
+                active = self._active_server
+            if server is None:
+                return
+            if active is server:
+                server.shutdown()
+            server.server_close()
+            route_servers = [route_server for route_server, _ in self.route_servers.values()]
+            for route_server in route_servers:
+                route_server.shutdown()
+                route_server.server_close()
+            self.route_servers = {}
+            if self._thread is not None and self._thread is not threading.current_thread():
+                self._thread.join(5)
+            self._thread = None
+
+            # 接入的WebSocket连接在断开前一直占用处理线程，先关闭再等待
+            for conn in list(self.ws_connections):
+                conn.close(1001)
+            deadline = time.monotonic() + self.config.shutdown_timeout
+            active_requests = server.active + sum(route_server.active for route_server in route_servers)
+            if active_requests:
+                logger.info(f"等待 {active_requests} 个进行中的请求完成")
+            for waiting in [server] + route_servers:
+                if not waiting.wait_idle(max(0, deadline - time.monotonic())):
+                    logger.warning(f"停止时仍有 {waiting.active} 个请求未完成")
+            # 与路由监听共用的处理线程池在所有监听都处理完后再关闭
+            server.executor.shutdown(wait=False)
+            if self.callback_dispatcher is not None:
+                self.callback_dispatcher.join(max(0, deadline - time.monotonic()))
+            if self.event_relay is not None:
+                self.event_relay.stop(max(0, deadline - time.monotonic()))
+                self.event_relay = None
+            logger.info("转发服务已停止")
+            self.emit("stopped")
+            self._release()
+
+    def _release(self):
+        # 先停止待发送队列，未发出的消息留在文件中，下次启动时继续发送
+        if self.outbox is not None:
+            self.outbox.stop()
+            self.outbox = None
+        if self.callback_dispatcher is not None:
+            self.callback_dispatcher.stop()
+            self.callback_dispatcher = None
+        for route in self.all_routes():
+            self._close_pool(route.upstreams, route.broadcast_executor)
+        self.route = None
+        self.routes = {}
+        if self.event_relay is not None:
+            self.event_relay.stop()
+            self.event_relay = None
+        if self.event_session is not None:
+            self.event_session.close()
+            self.event_session = None
+        # 关闭接入的WebSocket连接，让占用的处理线程退出
+        for conn in list(self.ws_connections):
+            conn.close(1001)
+        if self.ws_executor is not None:
+            self.ws_executor.shutdown(wait=False)
+            self.ws_executor = None
+        for session in (self.upstream_session, self.callback_session):
+            if session is not None:
+                session.close()
+        self.upstream_session = None
+        self.callback_session = None
+
+        # 写完剩余日志后停止写日志线程
+        if self.log_listener is not None:
+            stop_logging(self.log_listener)
+            self.log_listener = None
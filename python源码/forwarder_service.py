@@ -0,0 +1,192 @@
+"""无界面转发服务
+
+供服务器与容器中长期运行：读取与GUI相同格式的 config.txt，环境变量与命令行参数覆盖其中的配置项
+（优先级: 命令行 > 环境变量 FORWARDER_<配置项大写> > config.txt > 默认值），运行中不会等待键盘输入。
+
+SIGTERM / SIGINT 停止接受新连接，等待进行中的请求与回调发送完（至多 shutdown_timeout 秒）后退出；
+SIGHUP 重新读取 config.txt 并热重载，不中断服务。
+
+--workers N 大于1时启动N个工作进程，各自通过 SO_REUSEPORT 监听同一端口，由系统在进程间分配连接
+（仅Linux/BSD）。主进程只负责转发信号与重启异常退出的工作进程。每个进程的指标、响应缓存与重复请求识别
+相互独立；日志文件与待发送队列文件按进程编号分开，例如 outbox.1.db。
+
+用法示例:
+    python forwarder_service.py --config /etc/forwarder/config.txt
+    FORWARDER_TARGET_PORT=9785 python forwarder_service.py --workers 4 --local-host 0.0.0.0
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from forwarder_core import DEFAULT_CONFIG, ConfigWatcher, ForwarderConfig, ForwarderEngine, expand_extra_targets, logger
+
+ENV_PREFIX = "FORWARDER_"
+
+# 工作进程启动后这么多秒内退出视为启动失败，连续失败这么多次后不再重启
+FAST_EXIT_SECONDS = 5
+MAX_FAST_EXITS = 5
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OlivOS到Lagrange转发服务（无界面）")
+    parser.add_argument("--config", default=os.environ.get(ENV_PREFIX + "CONFIG") or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "config.txt"), help="config.txt路径（不存在时只使用默认值与覆盖项）")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get(ENV_PREFIX + "WORKERS") or 1),
+                        help="工作进程数，大于1时通过 SO_REUSEPORT 共用监听端口")
+    parser.add_argument("--watch", type=float, default=0,
+                        help="每隔多少秒检查config.txt，修改后自动热重载，0 表示只在收到 SIGHUP 时重载")
+    group = parser.add_argument_group("配置项", "覆盖config.txt与环境变量中的同名配置项，字典与列表使用JSON")
+    for key, default in DEFAULT_CONFIG.items():
+        group.add_argument("--" + key.replace("_", "-"), dest=key, default=None, metavar="VALUE",
+                           help=f"默认 {json.dumps(default, ensure_ascii=False)}")
+    return parser.parse_args(argv)
+
+def _worker_path(path, index):
+    """多进程时每个进程使用单独的文件，outbox.db -> outbox.1.db"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+def load_config(args, index=None):
+    """合并config.txt、环境变量与命令行参数，index 为工作进程编号（多进程时）"""
+    options = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            options = json.load(f)
+        if not isinstance(options, dict):
+            raise ValueError(f"{args.config} 的内容应为JSON对象")
+        options = expand_extra_targets(options)
+        # 与GUI一致，相对路径以config.txt所在目录为基准
+        for key in ("log_file", "outbox_path"):
+            path = options.get(key, "")
+            if path and not os.path.isabs(path):
+                options[key] = os.path.join(os.path.dirname(os.path.abspath(args.config)), path)
+    for key in DEFAULT_CONFIG:
+        value = os.environ.get(ENV_PREFIX + key.upper())
+        if value is not None:
+            options[key] = value
+    for key in DEFAULT_CONFIG:
+        value = getattr(args, key)
+        if value is not None:
+            options[key] = value
+
+    if args.workers > 1:
+        options["local_reuse_port"] = True
+        for key in ("log_file", "outbox_path"):
+            path = options.get(key, DEFAULT_CONFIG[key])
+            if path and index is not None:
+                options[key] = _worker_path(path, index)
+    return ForwarderConfig.from_dict(options)
+
+def run(args, index=None):
+    """在当前进程中运行转发服务，直到收到 SIGTERM / SIGINT，返回退出码"""
+    stop_requested = threading.Event()
+    reload_requested = threading.Event()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+
+    try:
+        engine = ForwarderEngine(load_config(args, index))
+        engine.start()
+    except (OSError, ValueError) as e:
+        print(f"转发服务启动失败: {e}", file=sys.stderr)
+        return 1
+
+    watcher = None
+    if args.watch > 0:
+        watcher = ConfigWatcher(args.config, lambda data: reload_requested.set(), interval=args.watch)
+        watcher.start()
+    try:
+        # 带超时等待，让主线程能及时处理信号
+        while not stop_requested.wait(0.5):
+            if reload_requested.is_set():
+                reload_requested.clear()
+                try:
+                    engine.reload(load_config(args, index))
+                except (OSError, ValueError) as e:
+                    logger.error(f"重新加载配置失败，继续使用原配置: {e}")
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        engine.stop()
+    return 0
+
+def _worker_main(args, index):
+    sys.exit(run(args, index))
+
+def supervise(args):
+    """启动 args.workers 个工作进程并等待它们退出，返回退出码"""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("多进程模式需要 SO_REUSEPORT，当前系统不支持", file=sys.stderr)
+        return 1
+    stop_requested = threading.Event()
+    workers = {}
+    fast_exits = 0
+
+    def spawn(index):
+        process = multiprocessing.Process(target=_worker_main, args=(args, index), name=f"forwarder-{index}")
+        process.start()
+        workers[index] = (process, time.monotonic())
+
+    def forward(signum):
+        for process, _ in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGHUP, lambda signum, frame: forward(signal.SIGHUP))
+
+    for index in range(1, args.workers + 1):
+        spawn(index)
+    print(f"已启动 {args.workers} 个工作进程", file=sys.stderr)
+
+    exit_code = 0
+    while not stop_requested.wait(0.5):
+        for index, (process, started) in list(workers.items()):
+            if process.is_alive():
+                continue
+            if time.monotonic() - started < FAST_EXIT_SECONDS:
+                fast_exits += 1
+            else:
+                fast_exits = 0
+            if fast_exits >= MAX_FAST_EXITS:
+                print("工作进程连续启动失败，停止服务", file=sys.stderr)
+                exit_code = 1
+                stop_requested.set()
+                break
+            print(f"工作进程 {index} 已退出（退出码 {process.exitcode}），重新启动", file=sys.stderr)
+            spawn(index)
+
+    forward(signal.SIGTERM)
+    try:
+        shutdown_timeout = load_config(args).shutdown_timeout
+    except (OSError, ValueError):
+        shutdown_timeout = DEFAULT_CONFIG["shutdown_timeout"]
+    for process, _ in workers.values():
+        process.join(shutdown_timeout + 5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+    return exit_code
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        load_config(args)
+    except (OSError, ValueError) as e:
+        print(f"配置错误: {e}", file=sys.stderr)
+        return 2
+    if args.workers > 1:
+        return supervise(args)
+    return run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,12 @@
+import os
 import sys
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime
-from urllib.parse import urlencode
+import importlib.util
+
+def pause():
+    # 只在交互终端中等待按键，作为服务或在容器中运行时直接退出
+    if sys.stdin is not None and sys.stdin.isatty():
+        input("按任意键退出...")
 
 def check_environment():
     """检查Python版本和必要依赖"""
@@ -11,22 +15,22 @@ def check_environment():
         print("\n错误：需要Python 3.6或更高版本")
         print(f"当前Python版本: {sys.version}")
         print("请从 https://www.python.org/downloads/ 下载最新版本")
-        input("按任意键退出...")
+        pause()
         sys.exit(1)
     
-    # 检查requests包
-    try:
-        import requests
-    except ImportError:
+    # 检查requests包（只查找不导入，转发服务启动时才导入）
+    if importlib.util.find_spec("requests") is None:
         print("\n错误：缺少必要依赖包 'requests'")
         print("请通过以下命令安装:")
         print("pip3 install requests")
-        input("按任意键退出...")
+        pause()
         sys.exit(1)
 
 # 在脚本开始处运行环境检查
 check_environment()
 
+from forwarder_core import ConfigWatcher, ForwarderConfig, ForwarderEngine, expand_extra_targets
+
 # 配置信息
 config = {
     "Host": "127.0.0.1",
@@ -39,144 +43,105 @@ target_config = {
     "Port": 9785,
     "AccessToken": "114514"  # 发送端验证令牌
 }
+# 转发到多个Lagrange时改为列表，按 options 中的 target_strategy 选择目标，例如:
+# target_config = [
+#     {"Host": "127.0.0.1", "Port": 9785, "AccessToken": "114514"},
+#     {"Host": "127.0.0.1", "Port": 9795, "AccessToken": "114514"}
+# ]
+
+# 高级选项，键名与GUI的config.txt一致，完整列表与默认值见 forwarder_core.DEFAULT_CONFIG
+options = {
+    "max_workers": 16,  # 并发处理请求的最大线程数
+    "shutdown_timeout": 5,  # 停止时（Ctrl+C）等待进行中的请求与回调发送完的最长秒数
+    "local_transport": "http",  # 接收端传输方式: http 只接受HTTP POST / ws 同时接受OneBot正向WebSocket连接
+    "target_transport": "http",  # 发送端传输方式: http 每条消息一次HTTP POST / ws 与Lagrange保持正向WebSocket长连接
+    "target_strategy": "round_robin",  # 多目标选择策略: round_robin 轮询 / least_inflight 进行中请求最少 / sticky_group 同一群或私聊固定目标
+    "target_broadcast": False,  # True 时每条消息同时发送到所有可用目标
+    "health_check_interval": 10,  # 多目标时的健康检查间隔秒数，0 表示不检查
+    "upstream_connect_timeout": 3,  # 连接Lagrange的超时秒数
+    "upstream_read_timeout": 5,  # 等待Lagrange响应的超时秒数
+    "upstream_retries": 2,  # 连接失败（消息确定未送达）时的最大重试次数
+    "breaker_failure_threshold": 5,  # 连续失败多少次后熔断，0 表示不熔断
+    "pool_size": 16,  # 每个目标的keep-alive连接池大小
+    "pool_idle_timeout": 60,  # 连接池空闲多少秒后关闭重建
+    "coalesce_window_ms": 0,  # 合并同一会话连续文本消息的等待窗口（毫秒），0 表示不合并
+    "rate_limit_global": 0,  # 发往Lagrange的总速率（条/秒），0 表示不限速
+    "rate_limit_group": 0,  # 每个群的速率（条/秒），0 表示不限速
+    "rate_limit_max_wait": 10,  # 超出速率时最多排队等待的秒数
+    "event_enabled": False,  # True 时在 event_port 上接收Lagrange的HTTP上报事件并转发给OlivOS
+    "event_port": 9786,  # 接收Lagrange上报事件的端口（Lagrange的HTTP上报地址指向这里）
+    "event_token": "",  # Lagrange上报使用的令牌，留空不校验
+    "olivos_event_port": 55001,  # OlivOS接收上报事件的端口
+    "olivos_event_token": "",  # 转发给OlivOS时使用的令牌
+    "event_backpressure_timeout": 2,  # 事件队列满时上报请求最多等待的秒数，仍然满则返回503
+    "action_transforms": {},  # 按动作名覆盖请求体改写规则，例如 {"send_group_msg": {"fields": ["group_id", "message"]}}，未列出的动作原样透传
+    "dedup_enabled": False,  # True 时窗口内重复的发送请求（同一echo，或同一目标的相同内容）不再发送，直接返回第一次的响应
+    "dedup_window": 10,  # 重复请求的识别窗口（秒）
+    "response_cache_enabled": False,  # True 时缓存 get_group_list、get_group_member_info 等只读查询的响应
+    "response_cache_ttls": {},  # 按动作名覆盖缓存秒数，例如 {"get_group_member_list": 10}，0 表示不缓存
+    "routes": [],  # 多账号路由，按监听端口、路径前缀或接收令牌选择各自的Lagrange，例如
+    # [{"name": "bot2", "path_prefix": "/bot2", "target_port": 9795}, {"name": "bot3", "port": 9884, "target_port": 9805}]
+    # 每条路由可覆盖 forwarder_core.ROUTE_KEYS 中的配置项，不匹配任何路由的请求按上面的配置转发
+    "outbox_enabled": False,  # True 时消息先写入本地待发送队列再由后台发送，Lagrange重启期间不丢消息（立即返回 status: async）
+    "outbox_path": "outbox.db",  # 待发送队列文件路径
+    "outbox_max_age": 86400,  # 超过该秒数仍未发出的消息被丢弃
+    "callback_workers": 2,  # 后台回调投递线程数
+    "callback_queue_size": 1000,  # 回调队列最大长度
+    "callback_retries": 3,  # 回调失败后的最大重试次数
+    "callback_overflow": "drop_oldest",  # 队列满时的策略: drop_oldest 丢弃最旧 / drop_new 丢弃新回调
+    "log_level": "DEBUG",  # DEBUG 输出完整收发数据，INFO 及以上只记录运行状态与错误
+    "log_compact": False,  # True 时每条日志输出为单行JSON
+    "log_file": ""  # 日志文件路径，留空则只输出到控制台
+}
 
-def print_log(title, data):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-    print(f"\n[{timestamp}] \n=== {title} ===")
-    print(json.dumps(data, indent=2, ensure_ascii=False))
-
-class RequestHandler(BaseHTTPRequestHandler):
-    def _send_response(self, code, data):
-        self.send_response(code)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
-
-    def _parse_body(self):
-        content_length = int(self.headers.get('Content-Length', 0))
-        raw_body = self.rfile.read(content_length).decode('utf-8')
-        try:
-            return json.loads(raw_body)
-        except:
-            return raw_body
-
-    def do_POST(self):
-        # 获取并记录原始数据
-        body = self._parse_body()
-        print_log("收到原始数据", body)
-
-        # 认证验证
-        if self.headers.get('Authorization') != f"Bearer {config['AccessToken']}":
-            self._send_response(401, {"status": "unauthorized"})
-            return
-        
-        # 处理数据
-        if not isinstance(body, dict):
-            self._send_response(400, {"status": "invalid JSON"})
-            return
-        
-        # 保存原始路径和参数
-        original_path = self.path
-        clean_path = original_path.split('?')[0]
-
-        # 构造转发路径
-        forward_path = original_path.replace(
-            f"access_token={config['AccessToken']}",
-            f"access_token={target_config['AccessToken']}",
-            1
-        ) if f"access_token={config['AccessToken']}" in original_path else (
-            clean_path + "?" + urlencode({"access_token": target_config['AccessToken']})
-        )
-
-        # 构建转发数据（保持原有逻辑不变）
-        modified_data = {
-            "message_type": body.get("message_type"),
-            "message": body.get("message"),
-            "auto_escape": body.get("auto_escape", False)
-        }
-
-        if "user_id" in body:
-            modified_data["user_id"] = body["user_id"]
-            
-        if "group_id" in body:
-            modified_data["group_id"] = body["group_id"]
-        
-        if modified_data["message_type"] == "group":
-            modified_data["group_id"] = body.get("group_id")
-            modified_data.pop("user_id", None)
-
-        # 记录转发信息
-        print_log("转发构造数据", {
-            "path": forward_path,
-            "data": modified_data
-        })
-        # 发送转发请求
-
-        try:
-            response = requests.post(
-                url=f"http://{target_config['Host']}:{target_config['Port']}{forward_path}",
-                json=modified_data,
-                headers={'Content-Type': 'application/json'},
-                timeout=5
-            )
-            response_data = response.json()
-            print_log("转发响应", {
-                "status": response.status_code,
-                "data": response_data
-            })
-            # 检查是否有返回数据需要回调
-            if response_data.get("status") == "ok" and response_data.get("data"):
-                # 构造回调路径（保持原路径结构，使用原始token）
-                callback_path = original_path if f"access_token={config['AccessToken']}" in original_path else (
-                    clean_path + "?" + urlencode({"access_token": config['AccessToken']})
-                )
-                # 构造回调数据
-                callback_data = {
-                    "status": "ok",
-                    "retcode": 0,
-                    "data": response_data["data"],
-                    "echo": body.get("echo")
-                }
-                # 发送回调（使用原始接收配置）
-                try:
-                    requests.post(
-                        url=f"http://{config['Host']}:{config['Port']}{callback_path}",
-                        json=callback_data,
-                        headers={'Content-Type': 'application/json'},
-                        timeout=5
-                    )
-                    print_log("回调发送", {
-                        "path": callback_path,
-                        "data": callback_data
-                    })
-                except Exception as e:
-                    print_log("回调发送失败", {
-                        "error": str(e),
-                        "path": callback_path
-                    })
-            # 返回原始响应
-            self._send_response(200, response_data)
-        except Exception as e:
-            error_response = {
-                "status": "failed",
-                "retcode": 1000,
-                "data": None,
-                "message": str(e),
-                "echo": body.get("echo")
-            }
-            print_log("转发异常", {
-                "error": str(e),
-                "target": f"{target_config['Host']}:{target_config['Port']}{forward_path}"
-            })
-            self._send_response(502, error_response)
+# 与本脚本同目录的config.txt（格式与GUI相同）存在时，其中的配置项覆盖上面的设置；
+# 运行中修改并保存该文件会自动重新加载，不需要重启
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.txt")
+
+def load_config_file():
+    if not os.path.exists(CONFIG_FILE):
+        return {}
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def build_config(file_options=None):
+    targets = target_config if isinstance(target_config, list) else [target_config]
+    forwarder_config = ForwarderConfig(
+        local_host=config['Host'],
+        local_port=config['Port'],
+        local_token=config['AccessToken'],
+        target_host=targets[0]['Host'],
+        target_port=targets[0]['Port'],
+        target_token=targets[0]['AccessToken'],
+        targets=[
+            {"host": target['Host'], "port": target['Port'], "token": target['AccessToken']}
+            for target in targets
+        ] if len(targets) > 1 else [],
+        **options
+    )
+    if not file_options:
+        return forwarder_config
+    file_options = dict(expand_extra_targets(file_options))
+    # 与GUI一致，相对路径以config.txt所在目录为基准
+    for key in ("log_file", "outbox_path"):
+        path = file_options.get(key, "")
+        if path and not os.path.isabs(path):
+            file_options[key] = os.path.join(os.path.dirname(CONFIG_FILE), path)
+    merged = forwarder_config.to_dict()
+    merged.update(file_options)
+    return ForwarderConfig.from_dict(merged)
 
 def run_server():
-    server = HTTPServer((config['Host'], config['Port']), RequestHandler)
-    print(f"Server running on {config['Host']}:{config['Port']}")
-    server.serve_forever()
+    engine = ForwarderEngine(build_config(load_config_file()))
+    watcher = ConfigWatcher(CONFIG_FILE, lambda data: engine.reload(build_config(data)))
+    watcher.start()
+    try:
+        engine.serve_forever()
+    finally:
+        watcher.stop()
 
 if __name__ == '__main__':
     try:
         run_server()
     except KeyboardInterrupt:
-        print("\nServer stopped by user")
\ No newline at end of file
+        print("\nServer stopped by user")
@@ -0,0 +1,348 @@
+"""forwarder_core 中不依赖网络的组件的单元测试
+
+运行: python -m unittest discover -s python源码/tests（或 python -m pytest python源码/tests）
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+# 与CLI一致，转发引擎位于上一级的 python源码 目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from forwarder_core import (ActionTransforms, CircuitBreaker, DuplicateFilter, ForwarderConfig, OutboundScheduler,
+                            PathRewriter, RateLimitExceeded, RequestHandler, ResponseCache, Route,
+                            _session_fields, _strip_access_token, parse_action_transforms)
+
+
+class PathRewriterTest(unittest.TestCase):
+    def setUp(self):
+        self.config = ForwarderConfig(local_token="in", target_host="10.0.0.1", target_port=9785, target_token="out")
+        self.rewriter = PathRewriter(self.config)
+
+    def test_without_token_appends_target_token(self):
+        clean, forward, callback = self.rewriter.rewrite("/send_msg")
+        self.assertEqual(clean, "/send_msg")
+        self.assertEqual(forward, "/send_msg?access_token=out")
+        self.assertEqual(callback, "/send_msg?access_token=in")
+        self.assertEqual(self.rewriter.target_prefix, "http://10.0.0.1:9785")
+
+    def test_replaces_only_matching_access_token(self):
+        path = "/send_msg?a=1&access_token=in&b=2"
+        _, forward, callback = self.rewriter.rewrite(path)
+        self.assertEqual(forward, "/send_msg?a=1&access_token=out&b=2")
+        # 带有接收端令牌时回调沿用原路径
+        self.assertEqual(callback, path)
+
+    def test_token_is_url_encoded(self):
+        rewriter = PathRewriter(ForwarderConfig(local_token="a b", target_token="c&d"))
+        _, forward, _ = rewriter.rewrite("/x?access_token=a%20b")
+        self.assertEqual(forward, "/x?access_token=c%26d")
+
+    def test_authorized_by_header_or_query(self):
+        self.assertTrue(self.rewriter.authorized("Bearer in", "/send_msg"))
+        self.assertTrue(self.rewriter.authorized(None, "/send_msg?access_token=in"))
+        self.assertFalse(self.rewriter.authorized("Bearer out", "/send_msg"))
+        self.assertFalse(self.rewriter.authorized(None, "/send_msg?access_token=inx"))
+
+    def test_strip_access_token(self):
+        self.assertEqual(_strip_access_token("/?access_token=abc"), "/")
+        self.assertEqual(_strip_access_token("/x?a=1&access_token=abc&b=2"), "/x?a=1&b=2")
+        self.assertEqual(_strip_access_token("/x?a=1"), "/x?a=1")
+
+
+class ActionTransformsTest(unittest.TestCase):
+    def test_default_send_msg_group(self):
+        transform = ActionTransforms().get("/send_msg?access_token=x")
+        data = transform({"message_type": "group", "group_id": 1, "user_id": 2, "message": "hi", "extra": 3})
+        self.assertEqual(data, {"message_type": "group", "message": "hi", "auto_escape": False, "group_id": 1})
+
+    def test_default_send_msg_private(self):
+        transform = ActionTransforms().get("send_msg")
+        data = transform({"message_type": "private", "user_id": 2, "message": "hi"})
+        self.assertEqual(data, {"message_type": "private", "message": "hi", "auto_escape": False, "user_id": 2})
+
+    def test_actions_without_rule_pass_through(self):
+        transforms = ActionTransforms()
+        self.assertIsNone(transforms.get("/send_group_msg"))
+        self.assertIsNone(transforms.get("/get_group_list"))
+
+    def test_overrides(self):
+        transforms = ActionTransforms({
+            "send_group_msg": {"fields": ["group_id", "message"], "rename": {"message": "content"}},
+            "send_msg": {}
+        })
+        self.assertEqual(transforms.get("/send_group_msg")({"group_id": 1, "message": "hi", "echo": 5}),
+                         {"group_id": 1, "content": "hi"})
+        # 值为空时改为透传
+        self.assertIsNone(transforms.get("/send_msg"))
+
+    def test_invalid_rule_rejected_by_config(self):
+        with self.assertRaises(ValueError):
+            parse_action_transforms({"send_msg": {"fields": 5}})
+        with self.assertRaises(ValueError):
+            ForwarderConfig(action_transforms={"send_msg": {"when": [{"equals": 1}]}})
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def test_disabled_without_rates(self):
+        self.assertFalse(OutboundScheduler().enabled)
+
+    def test_group_buckets_are_independent(self):
+        scheduler = OutboundScheduler(group_rate=0.001, group_burst=1, max_wait=0.05)
+        scheduler.acquire({"message_type": "group", "group_id": 1})
+        with self.assertRaises(RateLimitExceeded):
+            scheduler.acquire({"message_type": "group", "group_id": 1})
+        scheduler.acquire({"message_type": "group", "group_id": 2})
+        # 私聊不受群速率限制
+        scheduler.acquire({"message_type": "private", "user_id": 1})
+        scheduler.acquire({"message_type": "private", "user_id": 1})
+
+    def test_requests_without_session_only_use_global_rate(self):
+        scheduler = OutboundScheduler(group_rate=0.001, group_burst=1, user_rate=0.001, user_burst=1, max_wait=0.05)
+        for _ in range(3):
+            scheduler.acquire({})
+            scheduler.acquire({"message_type": "group"})
+
+    def test_global_rate(self):
+        scheduler = OutboundScheduler(global_rate=0.001, global_burst=2, max_wait=0.05)
+        scheduler.acquire({})
+        scheduler.acquire({"message_type": "private", "user_id": 1})
+        with self.assertRaises(RateLimitExceeded):
+            scheduler.acquire({})
+
+    def test_passthrough_send_actions_use_session_buckets(self):
+        scheduler = OutboundScheduler(group_rate=0.001, group_burst=1, user_rate=0.001, user_burst=1, max_wait=0.05)
+        scheduler.acquire(_session_fields("/send_group_msg", b'{"group_id": 1, "message": "a"}'))
+        with self.assertRaises(RateLimitExceeded):
+            scheduler.acquire(_session_fields("/send_group_msg?access_token=x", b'{"group_id": 1, "message": "b"}'))
+        scheduler.acquire(_session_fields("/send_private_msg", b'{"user_id": 1, "message": "a"}'))
+        with self.assertRaises(RateLimitExceeded):
+            scheduler.acquire(_session_fields("/send_private_msg", b'{"user_id": 1, "message": "b"}'))
+
+    def test_session_fields(self):
+        self.assertEqual(_session_fields("/send_group_msg", b'{"group_id": 5}'),
+                         {"message_type": "group", "group_id": 5, "user_id": None})
+        self.assertEqual(_session_fields("/send_msg", {"message_type": "private", "user_id": 7}),
+                         {"message_type": "private", "group_id": None, "user_id": 7})
+        self.assertEqual(_session_fields("/send_group_msg", b"{oops"), {})
+        self.assertEqual(_session_fields("/send_group_msg", b"[1]"), {})
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.ready())
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_allows_single_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0.05)
+        for _ in range(5):
+            breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_cancel_releases_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.cancel()
+        self.assertTrue(breaker.allow())
+
+    def test_emits_state_changes(self):
+        events = []
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0, name="t",
+                                 emit=lambda event, **fields: events.append(fields["state"]))
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(events, ["open", "half_open", "closed"])
+
+
+class DuplicateFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.dedup = DuplicateFilter("send_msg,send_group_msg", window=60)
+
+    def test_fingerprint(self):
+        fingerprint = self.dedup.fingerprint
+        self.assertIsNone(fingerprint("/get_group_list", {"echo": 1}))
+        self.assertEqual(fingerprint("/send_msg", {"echo": 1, "message": "a"}),
+                         fingerprint("/send_msg?access_token=x", b'{"echo": 1, "message": "b"}'))
+        self.assertNotEqual(fingerprint("/send_msg", {"echo": 1}), fingerprint("/send_msg", {"echo": 2}))
+        # 没有echo时按内容识别，数字字符串的群号与整数视为同一目标
+        self.assertEqual(fingerprint("/send_group_msg", {"group_id": "1", "message": "hi"}),
+                         fingerprint("/send_group_msg", b'{"group_id": 1, "message": "hi"}'))
+        self.assertNotEqual(fingerprint("/send_group_msg", {"group_id": 1, "message": "hi"}),
+                            fingerprint("/send_group_msg", {"group_id": 2, "message": "hi"}))
+        self.assertIsNone(fingerprint("/send_msg", b"{oops"))
+        self.assertIsNone(DuplicateFilter("send_msg", by_content=False).fingerprint("/send_msg", {"message": "hi"}))
+
+    def test_duplicate_returns_first_result(self):
+        fingerprint = self.dedup.fingerprint("/send_msg", {"echo": 1})
+        sent = []
+
+        def sender():
+            sent.append(1)
+            return 200, {"status": "ok", "echo": 1}
+        self.assertEqual(self.dedup.run(fingerprint, "/send_msg", sender), (200, {"status": "ok", "echo": 1}))
+        self.assertEqual(self.dedup.run(fingerprint, "/send_msg", sender), (200, {"status": "ok", "echo": 1}))
+        self.assertEqual(len(sent), 1)
+
+    def test_failed_send_is_not_remembered(self):
+        fingerprint = self.dedup.fingerprint("/send_msg", {"echo": 1})
+        self.dedup.run(fingerprint, "/send_msg", lambda: (502, {"status": "failed"}))
+        self.dedup.run(fingerprint, "/send_msg", lambda: (200, {"status": "failed", "retcode": 100}))
+        self.assertEqual(len(self.dedup), 0)
+        self.dedup.run(fingerprint, "/send_msg", lambda: (200, {"status": "async"}))
+        self.assertEqual(len(self.dedup), 1)
+
+    def test_sender_error_reaches_waiting_duplicates(self):
+        fingerprint = self.dedup.fingerprint("/send_msg", {"echo": 1})
+        started = threading.Event()
+        errors = []
+
+        def sender():
+            started.set()
+            time.sleep(0.1)
+            raise RuntimeError("boom")
+
+        def first():
+            try:
+                self.dedup.run(fingerprint, "/send_msg", sender)
+            except RuntimeError as e:
+                errors.append(("first", str(e)))
+        thread = threading.Thread(target=first)
+        thread.start()
+        started.wait()
+        with self.assertRaises(RuntimeError):
+            self.dedup.run(fingerprint, "/send_msg", lambda: (200, {"status": "ok"}))
+        thread.join()
+        self.assertEqual(errors, [("first", "boom")])
+        self.assertEqual(len(self.dedup), 0)
+
+    def test_entries_expire(self):
+        dedup = DuplicateFilter("send_msg", window=0)
+        fingerprint = dedup.fingerprint("/send_msg", {"echo": 1})
+        sent = []
+        for _ in range(2):
+            dedup.run(fingerprint, "/send_msg", lambda: sent.append(1) or (200, {"status": "ok"}))
+        self.assertEqual(len(sent), 2)
+
+
+class ResponseCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache()
+
+    def test_key_is_normalized(self):
+        key = self.cache.key("/get_group_member_info", {"group_id": 1, "user_id": 2, "echo": "a"})
+        self.assertEqual(key, self.cache.key("/get_group_member_info?access_token=x",
+                                             b'{"user_id": "2", "group_id": "1", "echo": "b"}'))
+        self.assertEqual(key[:2], ("get_group_member_info", 1))
+        self.assertNotEqual(key, self.cache.key("/get_group_member_info", {"group_id": 1, "user_id": 3}))
+
+    def test_empty_body(self):
+        self.assertEqual(self.cache.key("/get_login_info", b""), self.cache.key("/get_login_info", {}))
+
+    def test_not_cacheable(self):
+        self.assertIsNone(self.cache.key("/send_msg", {"message": "hi"}))
+        self.assertIsNone(self.cache.key("/get_group_list", {"no_cache": True}))
+        self.assertIsNone(self.cache.key("/get_group_list", b"{oops"))
+        self.assertIsNone(ResponseCache({"get_group_list": 0}).key("/get_group_list", {}))
+
+    def test_get_or_load_caches_ok_responses(self):
+        key = self.cache.key("/get_group_list", {})
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return 200, {"status": "ok", "data": []}
+        self.cache.get_or_load(key, loader)
+        self.cache.get_or_load(key, loader)
+        self.assertEqual(len(loads), 1)
+        failed_key = self.cache.key("/get_friend_list", {})
+        for _ in range(2):
+            self.cache.get_or_load(failed_key, lambda: loads.append(1) or (200, {"status": "failed"}))
+        self.assertEqual(len(loads), 3)
+
+
+class RouteMatchTest(unittest.TestCase):
+    def setUp(self):
+        self.config = ForwarderConfig(routes=[
+            {"name": "prefix", "path_prefix": "/bot2", "target_port": 9795},
+            {"name": "token", "token": "tok2", "target_port": 9805},
+        ])
+        self.routes = {}
+        for spec in self.config.routes:
+            route_config = self.config.route_config(spec)
+            route = Route(None, route_config, spec)
+            route.rewriter = PathRewriter(route_config)
+            self.routes[spec["name"]] = route
+
+    def test_prefix(self):
+        route = self.routes["prefix"]
+        self.assertEqual(route.match("/bot2/send_msg", None), "/send_msg")
+        self.assertEqual(route.match("/bot2?access_token=x", None), "/?access_token=x")
+        self.assertIsNone(route.match("/bot2x/send_msg", None))
+        self.assertIsNone(route.match("/send_msg", None))
+
+    def test_token_by_header_or_query(self):
+        route = self.routes["token"]
+        self.assertEqual(route.config.local_token, "tok2")
+        self.assertEqual(route.match("/send_msg", "Bearer tok2"), "/send_msg")
+        self.assertEqual(route.match("/send_msg?access_token=tok2", None), "/send_msg?access_token=tok2")
+        self.assertIsNone(route.match("/send_msg", "Bearer 114514"))
+
+    def test_matched_token_route_is_authorized(self):
+        # 按查询串令牌选中的路由，在请求处理时同样要通过认证
+        route = self.routes["token"]
+        path = route.match("/send_msg?access_token=tok2", None)
+        self.assertTrue(route.rewriter.authorized(None, path))
+
+    def test_specificity(self):
+        self.assertLess(self.routes["prefix"].specificity(), self.routes["token"].specificity())
+
+    def test_invalid_routes(self):
+        with self.assertRaises(ValueError):
+            ForwarderConfig(routes=[{"name": "a"}])
+        with self.assertRaises(ValueError):
+            ForwarderConfig(routes=[{"name": "a", "token": "x"}, {"name": "a", "token": "y"}])
+        with self.assertRaises(ValueError):
+            ForwarderConfig(routes=[{"name": "a", "port": 9784}])
+
+
+class RequestBodyTest(unittest.TestCase):
+    def test_passthrough_body_must_be_json_object(self):
+        self.assertTrue(RequestHandler._is_json_object(b'{"group_id": 1}'))
+        self.assertFalse(RequestHandler._is_json_object(b"{oops"))
+        self.assertFalse(RequestHandler._is_json_object(b"[1, 2]"))
+        self.assertFalse(RequestHandler._is_json_object(b"\xff"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,281 @@
+"""OneBot WebSocket传输
+
+只依赖标准库的最小RFC 6455实现，供转发引擎在接收端接受OlivOS的正向WebSocket连接，
+以及在发送端与Lagrange的正向WebSocket保持长连接。只处理文本帧、ping/pong与关闭帧。
+"""
+import os
+import json
+import base64
+import socket
+import struct
+import hashlib
+import itertools
+import threading
+from urllib.parse import quote
+
+_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+# 单条消息的最大长度，超出时关闭连接
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+class WebSocketClosed(ConnectionError):
+    """连接已断开，已发出的请求是否送达未知"""
+
+class WebSocketConnectError(ConnectionError):
+    """连接没有建立成功，请求确定没有发出"""
+
+def _apply_mask(payload, key):
+    """按4字节掩码异或，整段转成大整数一次完成，避免逐字节循环"""
+    length = len(payload)
+    if not length:
+        return payload
+    repeated = (key * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + _GUID).encode('ascii')).digest()).decode('ascii')
+
+class WebSocketConnection:
+    """一条已完成握手的WebSocket连接
+
+    send_text() 可在多个线程中同时调用，recv() 只应在一个线程中调用。
+    客户端发出的帧需要掩码（mask=True），服务端发出的帧不加掩码。
+    """
+    def __init__(self, sock, reader, mask):
+        self.sock = sock
+        self.reader = reader
+        self.mask = mask
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def _read_exact(self, size):
+        data = self.reader.read(size)
+        if data is None or len(data) < size:
+            raise WebSocketClosed("连接已断开")
+        return data
+
+    def send_frame(self, opcode, payload=b""):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        mask_bit = 0x80 if self.mask else 0
+        if length < 126:
+            header.append(mask_bit | length)
+        elif length < 65536:
+            header.append(mask_bit | 126)
+            header += struct.pack("!H", length)
+        else:
+            header.append(mask_bit | 127)
+            header += struct.pack("!Q", length)
+        if self.mask:
+            key = os.urandom(4)
+            header += key
+            payload = _apply_mask(payload, key)
+        with self._send_lock:
+            if self.closed:
+                raise WebSocketClosed("连接已关闭")
+            try:
+                self.sock.sendall(bytes(header) + payload)
+            except OSError as e:
+                self.closed = True
+                raise WebSocketClosed(str(e))
+
+    def send_text(self, text):
+        self.send_frame(OP_TEXT, text.encode('utf-8'))
+
+    def recv(self):
+        """读取下一条文本消息，连接关闭时返回None"""
+        fragments = []
+        size = 0
+        while True:
+            try:
+                first, second = self._read_exact(2)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self._read_exact(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self._read_exact(8))[0]
+                key = self._read_exact(4) if second & 0x80 else None
+                if size + length > MAX_MESSAGE_SIZE:
+                    self.close(1009)
+                    return None
+                payload = self._read_exact(length) if length else b""
+            except (WebSocketClosed, OSError, ValueError):
+                self.closed = True
+                return None
+            if key:
+                payload = _apply_mask(payload, key)
+
+            if opcode == OP_PING:
+                try:
+                    self.send_frame(OP_PONG, payload)
+                except WebSocketClosed:
+                    return None
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                self.close()
+                return None
+            fragments.append(payload)
+            size += length
+            if first & 0x80:
+                return b"".join(fragments).decode('utf-8', errors='replace')
+
+    def close(self, code=1000):
+        if not self.closed:
+            try:
+                self.send_frame(OP_CLOSE, struct.pack("!H", code))
+            except WebSocketClosed:
+                pass
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+def is_upgrade_request(headers):
+    return (headers.get('Upgrade', '').lower() == "websocket"
+            and "upgrade" in headers.get('Connection', '').lower())
+
+def server_handshake(handler):
+    """在 BaseHTTPRequestHandler 中完成服务端握手，返回连接；请求不合法时返回None"""
+    key = handler.headers.get('Sec-WebSocket-Key')
+    if not key:
+        return None
+    handler.send_response(101, "Switching Protocols")
+    handler.send_header('Upgrade', 'websocket')
+    handler.send_header('Connection', 'Upgrade')
+    handler.send_header('Sec-WebSocket-Accept', accept_key(key))
+    handler.end_headers()
+    handler.wfile.flush()
+    handler.close_connection = True
+    return WebSocketConnection(handler.connection, handler.rfile, mask=False)
+
+def connect(host, port, path="/", headers=None, timeout=5.0):
+    """作为客户端连接 ws://host:port/path，返回连接；连接或握手失败时抛出 WebSocketConnectError"""
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError as e:
+        raise WebSocketConnectError(f"连接 {host}:{port} 失败: {e}")
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        lines = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {host}:{port}",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            f"Sec-WebSocket-Key: {key}",
+            "Sec-WebSocket-Version: 13",
+        ]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode('utf-8'))
+
+        reader = sock.makefile('rb')
+        status = reader.readline().decode('latin-1')
+        response_headers = {}
+        while True:
+            line = reader.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        if " 101 " not in status + " " or response_headers.get('sec-websocket-accept') != accept_key(key):
+            raise WebSocketConnectError(f"WebSocket握手失败: {status.strip()}")
+    except WebSocketConnectError:
+        sock.close()
+        raise
+    except OSError as e:
+        sock.close()
+        raise WebSocketConnectError(f"WebSocket握手失败: {e}")
+    # 握手完成后由读取线程阻塞等待，不再使用超时
+    sock.settimeout(None)
+    return WebSocketConnection(sock, reader, mask=True)
+
+class OneBotWebSocketClient:
+    """到一个OneBot正向WebSocket接口的长连接
+
+    call() 发送一个动作并阻塞等待 echo 相同的响应，多个线程可同时调用，共用同一条连接；
+    params 为bytes时视为已序列化的JSON对象，原样拼入请求帧。
+    连接在第一次调用时建立，断开后下一次调用时重连；断开时所有等待中的调用抛出 WebSocketClosed。
+    不带 echo 的上报事件交给 on_event 处理。
+    """
+    def __init__(self, host, port, token, path="/", connect_timeout=5.0, on_event=None):
+        self.host = host
+        self.port = port
+        self.path = path if not token else f"{path}{'&' if '?' in path else '?'}access_token={quote(token, safe='')}"
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.connect_timeout = connect_timeout
+        self.on_event = on_event
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pending = {}
+        self._echo = itertools.count(1)
+
+    def _connection(self):
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                conn = connect(self.host, self.port, self.path, self.headers, self.connect_timeout)
+                self._conn = conn
+                threading.Thread(target=self._reader, args=(conn,), name=f"ws-{self.host}:{self.port}",
+                                 daemon=True).start()
+            return self._conn
+
+    def call(self, action, params, timeout=5.0):
+        """发送动作，返回响应数据（已去掉内部使用的echo），超时抛出 TimeoutError"""
+        conn = self._connection()
+        echo = f"forwarder-{next(self._echo)}"
+        slot = [threading.Event(), None, conn]
+        self._pending[echo] = slot
+        try:
+            if isinstance(params, bytes):
+                # 原始请求体直接拼入帧，不解析再序列化
+                conn.send_text('{"action":%s,"params":%s,"echo":%s}' % (
+                    json.dumps(action), params.decode('utf-8').strip() or "{}", json.dumps(echo)))
+            else:
+                conn.send_text(json.dumps({"action": action, "params": params, "echo": echo}, ensure_ascii=False))
+            if not slot[0].wait(timeout):
+                raise TimeoutError(f"等待 {action} 响应超时")
+        finally:
+            self._pending.pop(echo, None)
+        if isinstance(slot[1], Exception):
+            raise slot[1]
+        response = slot[1]
+        response.pop("echo", None)
+        return response
+
+    def _reader(self, conn):
+        while True:
+            text = conn.recv()
+            if text is None:
+                break
+            try:
+                data = json.loads(text)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            slot = self._pending.get(data.get("echo")) if "echo" in data else None
+            if slot is not None:
+                slot[1] = data
+                slot[0].set()
+            elif self.on_event is not None and "post_type" in data:
+                self.on_event(data)
+        # 连接断开，让等待中的调用立即失败
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+        for echo, slot in list(self._pending.items()):
+            if slot[2] is conn and slot[1] is None:
+                slot[1] = WebSocketClosed(f"与 {self.host}:{self.port} 的WebSocket连接已断开")
+                slot[0].set()
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()